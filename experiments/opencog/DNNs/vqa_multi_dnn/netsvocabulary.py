@@ -41,6 +41,165 @@ class INetsVocab(nn.Module):
         else:
             return None
 
+    def has_model(self, word):
+        try:
+            return self.get_model_by_word(word) is not None
+        except KeyError:
+            return False
+
+    def get_models_output(self, x, words):
+        """
+        Run models of words on batch of features
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            features, nBBox x featureVectorSize
+        words : list
+            words to run models for, each word should have model
+
+        Returns
+        -------
+        torch.Tensor
+            models outputs, nBBox x len(words)
+        """
+        if isinstance(self.models, StackedModels):
+            return self.models(x, [self.modelIndexByWord[word] for word in words])
+        return torch.cat([self.get_model_by_word(word)(x) for word in words], dim=1)
+
+
+class StackedWordModel:
+    """
+    Model of a single word from StackedModels, can be used in place
+    of separate nn.Sequential word model
+    """
+
+    def __init__(self, stackedModels, key):
+        self.stackedModels = stackedModels
+        self.key = key
+
+    def __call__(self, x):
+        output = self.stackedModels(x.view(-1, x.shape[-1]), [self.key])
+        return output.view(x.shape[:-1] + (1,))
+
+
+class StackedModels(nn.Module):
+    """
+    Word models with the same structure (Linear, ReLU, ..., Linear) kept as
+    stacked weight tensors: nWords x in x out for each linear layer.
+
+    Models of any subset of words are computed on batch of features
+    by one batched matrix multiplication per layer instead of running
+    separate module for each word. Models are indexed by key which is
+    either model index (NetsVocab) or word id (SplitNetsVocab).
+    """
+
+    def __init__(self, keys, weights, biases, sigmoid=False):
+        super().__init__()
+        self.keys_list = list(keys)
+        self.index_by_key = {key: index for index, key in enumerate(self.keys_list)}
+        self.weights = nn.ParameterList([nn.Parameter(w) for w in weights])
+        self.biases = nn.ParameterList([nn.Parameter(b) for b in biases])
+        self.sigmoid = sigmoid
+
+    @classmethod
+    def fromStateDicts(cls, stateDictByKey, sigmoid=False):
+        """
+        Stack weights of nn.Sequential word models
+
+        Parameters
+        ----------
+        stateDictByKey : dict
+            state dict of nn.Sequential word model by model key
+        sigmoid : bool
+            apply sigmoid to the output of the last layer
+
+        Returns
+        -------
+        StackedModels
+        """
+        keys = list(stateDictByKey.keys())
+        if not keys:
+            raise ValueError('No models to stack')
+        layers = sorted(int(name.split('.')[0])
+                        for name in stateDictByKey[keys[0]]
+                        if name.endswith('.weight'))
+        weights = []
+        biases = []
+        for layer in layers:
+            # nn.Linear keeps weight as out x in
+            weights.append(torch.stack([stateDictByKey[key]['{}.weight'.format(layer)].t()
+                                        for key in keys]).contiguous())
+            biases.append(torch.stack([stateDictByKey[key]['{}.bias'.format(layer)]
+                                       for key in keys]))
+        return cls(keys, weights, biases, sigmoid)
+
+    @classmethod
+    def fromNetsVocabStateDict(cls, pytorchStateDict, sigmoid=False):
+        """
+        Stack weights of NetsVocab models
+
+        Parameters
+        ----------
+        pytorchStateDict : dict
+            'pytorch_state_dict' item of NetsVocab.state_dict()
+
+        Returns
+        -------
+        StackedModels
+            models with NetsVocab model indexes as keys
+        """
+        stateDictByKey = {}
+        for name, tensor in pytorchStateDict.items():
+            # models.<model index>.<layer index>.<weight|bias>
+            _, index, parameter = name.split('.', 2)
+            stateDictByKey.setdefault(int(index), {})[parameter] = tensor
+        return cls.fromStateDicts(dict(sorted(stateDictByKey.items())), sigmoid)
+
+    def keys(self):
+        return list(self.keys_list)
+
+    def __contains__(self, key):
+        return key in self.index_by_key
+
+    def __len__(self):
+        return len(self.keys_list)
+
+    def __getitem__(self, key):
+        if key not in self.index_by_key:
+            raise KeyError(key)
+        return StackedWordModel(self, key)
+
+    def forward(self, x, keys):
+        """
+        Run models of keys on batch of features
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            features, nBBox x in
+        keys : list
+            keys of models to run
+
+        Returns
+        -------
+        torch.Tensor
+            nBBox x len(keys), float32 even if weights have reduced precision
+        """
+        x = x.to(self.weights[0].dtype)
+        index = torch.tensor([self.index_by_key[key] for key in keys],
+                             dtype=torch.long, device=x.device)
+        output = None
+        for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            if output is None:
+                output = torch.einsum('ni,kio->kno', x, weight[index])
+            else:
+                output = torch.bmm(F.relu(output), weight[index])
+            output = output + bias[index].unsqueeze(1)
+        if self.sigmoid:
+            output = torch.sigmoid(output)
+        return output.squeeze(2).t().float()
+
 
 class NetsVocab(INetsVocab):
 
@@ -61,11 +220,17 @@ class NetsVocab(INetsVocab):
         return netsVocab
 
     @classmethod
-    def fromStateDict(cls, device, stateDict):
+    def fromStateDict(cls, device, stateDict, stacked=False):
         netsVocab = cls(device)
 
         netsVocab.vocabulary = stateDict['vocabulary']
         netsVocab.featureVectorSize = stateDict['featureVectorSize']
+        if stacked:
+            netsVocab.models = StackedModels.fromNetsVocabStateDict(
+                stateDict['pytorch_state_dict']).to(device)
+            netsVocab.modelIndexByWord = {word: index for index, word
+                                          in enumerate(netsVocab.vocabulary)}
+            return netsVocab
         netsVocab.initializeModels()
 
         netsVocab.load_state_dict(stateDict['pytorch_state_dict'])
@@ -80,19 +245,22 @@ class NetsVocab(INetsVocab):
             'pytorch_state_dict': super().state_dict()
             }
 
+    def createModel(self):
+        return nn.Sequential(
+            nn.Linear(self.featureVectorSize, 64),
+            nn.ReLU(),
+            nn.Linear(64, 32),
+            nn.ReLU(),
+            nn.Linear(32, 1)
+            # TODO: why it is not included into model but
+            # applied in feed_forward()
+            # nn.Sigmoid()
+            ).to(self.device)
+
     def initializeModels(self):
         modelIndex = 0
         for word in self.vocabulary:
-            self.models.append(nn.Sequential(
-                nn.Linear(self.featureVectorSize, 64),
-                nn.ReLU(),
-                nn.Linear(64, 32),
-                nn.ReLU(),
-                nn.Linear(32, 1)
-                # TODO: why it is not included into model but
-                # applied in feed_forward()
-                # nn.Sigmoid()
-                ).to(self.device))
+            self.models.append(self.createModel())
             self.modelIndexByWord[word] = modelIndex
             modelIndex += 1
 
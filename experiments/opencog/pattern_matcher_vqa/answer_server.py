@@ -0,0 +1,358 @@
+"""
+HTTP server which answers questions about images keeping JVM, atomspace
+and models loaded
+
+Requests are answered by single worker thread because atomspace, JVM
+converter and Caffe net are not thread safe. Worker takes up to
+--max-batch-size requests which came within --max-batch-wait-ms and
+answers them together: questions about the same image share bounding
+boxes and all bounding boxes of the batch are scored by single neural
+network runner call, see PatternMatcherVqaPipeline.answerImageQuestionGroups().
+
+Endpoints:
+    POST /answer - JSON {"question": str, "image": base64 encoded image
+        file or "imageId": image id for features extractor, "use_pm": bool}
+        answers 504 if query is out of --question-timeout budget
+    GET /metrics - JSON with server counters and pipeline latencies
+    GET /health - 200 when models are loaded
+
+Usage:
+
+    python answer_server.py --model-kind SPLITMULTIDNN --multidnn-model models \\
+        --features-extractor-kind IMAGE --atomspace atomspace.scm --port 8080
+"""
+
+import json
+import time
+import queue
+import base64
+import hashlib
+import logging
+import threading
+import collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import network_runner
+from interface import AnswerHandler
+from instrumentation import metrics
+from prefetch import attachThreadToJVM
+from pattern_matcher_vqa import (buildArgumentParser, buildPipeline, shutdownJVM,
+                                 initializeRootAndOpencogLogger, QueryTimeout)
+
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class AnswerRequest:
+    __slots__ = ["question", "image", "imageId", "imageKey", "use_pm", "future", "received"]
+
+    def __init__(self, question, image, imageId, use_pm):
+        self.question = question
+        self.image = image
+        self.imageId = imageId
+        # requests with the same key share bounding boxes
+        if image is not None:
+            self.imageKey = hashlib.sha1(np.ascontiguousarray(image).data).hexdigest()
+        else:
+            self.imageKey = 'id:' + str(imageId)
+        self.use_pm = use_pm
+        self.future = Future()
+        self.received = time.perf_counter()
+
+    @classmethod
+    def fromJson(cls, data):
+        if not isinstance(data, dict) or not isinstance(data.get('question'), str):
+            raise BadRequest('"question" string is required')
+        image = None
+        imageId = data.get('imageId')
+        if 'image' in data:
+            image = decodeImage(data['image'])
+        elif imageId is None:
+            raise BadRequest('either "image" or "imageId" is required')
+        return cls(data['question'], image, imageId, bool(data.get('use_pm', True)))
+
+
+def decodeImage(encodedImage):
+    """
+    :return: numpy.array
+        RGB image as PatternMatcherVqaPipeline.answerQuestionByImage() expects
+    """
+    import cv2
+    try:
+        data = np.frombuffer(base64.b64decode(encodedImage), dtype=np.uint8)
+    except (TypeError, ValueError) as e:
+        raise BadRequest('cannot decode base64 image: {}'.format(e))
+    image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if image is None:
+        raise BadRequest('cannot decode image')
+    return image[..., ::-1]
+
+
+def resultToJson(result):
+    if result is None:
+        return {'answer': None}
+    boxes = result.boundingBoxes
+    answerBox = result.answerBox
+    box = None
+    if answerBox is not None and boxes is not None and answerBox < len(boxes):
+        box = [float(coordinate) for coordinate in boxes[answerBox]]
+    return {'answer': result.answer,
+            'query': str(result.query),
+            'boundingBox': answerBox,
+            'box': box}
+
+
+class VqaAnswerServer:
+
+    def __init__(self, args, maxBatchSize=8, maxBatchWaitSeconds=0.01):
+        self.args = args
+        self.maxBatchSize = maxBatchSize
+        self.maxBatchWaitSeconds = maxBatchWaitSeconds
+        self.requests = queue.Queue()
+        self.ready = threading.Event()
+        self.stopped = False
+        self.pipeline = None
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.requestCount = 0
+        self.failedCount = 0
+        self.batchCount = 0
+        self.maxBatch = 0
+
+    def submit(self, request):
+        if self.stopped:
+            raise RuntimeError('Server is stopped')
+        self.requests.put(request)
+        return request.future
+
+    def nextBatch(self):
+        """
+        Wait for the first request and then for more requests until batch
+        is full or maxBatchWaitSeconds passed
+        """
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.maxBatchWaitSeconds
+        while len(batch) < self.maxBatchSize and batch[-1] is not None:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=max(timeout, 0))
+                             if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        """
+        Worker loop, pipeline is built in worker thread because Caffe
+        mode and JVM attachment are per thread
+        """
+        try:
+            self.pipeline = buildPipeline(self.args, AnswerHandler())
+            self.ready.set()
+            while True:
+                batch = self.nextBatch()
+                stop = None in batch
+                batch = [request for request in batch if request is not None]
+                if batch:
+                    self.answerBatch(batch)
+                if stop:
+                    break
+        except BaseException as e:
+            logger.exception('Unexpected exception in answer worker %s', e)
+        finally:
+            self.stopped = True
+            self.ready.set()
+            self.failPending()
+            shutdownJVM()
+
+    def stop(self):
+        self.requests.put(None)
+
+    def failPending(self):
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                request.future.set_exception(RuntimeError('Server is stopped'))
+
+    def answerBatch(self, batch):
+        attachThreadToJVM()
+        with metrics.timer('server_batch'):
+            for use_pm in (True, False):
+                requests = [request for request in batch if request.use_pm == use_pm]
+                if requests:
+                    self.answerRequests(requests, use_pm)
+        with self.lock:
+            self.batchCount += 1
+            self.maxBatch = max(self.maxBatch, len(batch))
+
+    def answerRequests(self, requests, use_pm):
+        requestsByImage = collections.OrderedDict()
+        for request in requests:
+            requestsByImage.setdefault(request.imageKey, []).append(request)
+        groups = []
+        groupRequests = []
+        for imageRequests in requestsByImage.values():
+            try:
+                features, boxes = self.getFeatures(imageRequests[0])
+            except BaseException as e:
+                for request in imageRequests:
+                    self.finish(request, exception=e)
+                continue
+            groups.append((features, boxes, [request.question for request in imageRequests]))
+            groupRequests.append(imageRequests)
+        try:
+            results = self.pipeline.answerImageQuestionGroups(groups, use_pm)
+        except BaseException as e:
+            results = [[e] * len(imageRequests) for imageRequests in groupRequests]
+        for imageRequests, imageResults in zip(groupRequests, results):
+            for request, result in zip(imageRequests, imageResults):
+                if isinstance(result, BaseException):
+                    self.finish(request, exception=result)
+                else:
+                    self.finish(request, result=result)
+
+    def getFeatures(self, request):
+        with metrics.timer('feature_load'):
+            if request.image is not None:
+                return self.pipeline.featureExtractor.getFeaturesByImage(request.image)
+            return self.pipeline.featureExtractor.getFeaturesByImageId(request.imageId), None
+
+    def finish(self, request, result=None, exception=None):
+        metrics.add('server_request', time.perf_counter() - request.received)
+        with self.lock:
+            self.requestCount += 1
+            if exception is not None:
+                self.failedCount += 1
+        if exception is not None:
+            logger.error('Cannot answer question "%s": %s', request.question, exception)
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(result)
+
+    def getStatistics(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            return {'uptime_seconds': uptime,
+                    'requests': self.requestCount,
+                    'failed_requests': self.failedCount,
+                    'batches': self.batchCount,
+                    'mean_batch_size': self.requestCount / self.batchCount
+                                       if self.batchCount else 0.0,
+                    'max_batch_size': self.maxBatch,
+                    'queued_requests': self.requests.qsize(),
+                    'throughput_per_second': self.requestCount / uptime if uptime else 0.0,
+                    'pipeline': metrics.asDict()['stages'],
+                    'runner': network_runner.runner.getStatistics()
+                              if network_runner.runner is not None else {}}
+
+
+def buildRequestHandler(server, requestTimeout):
+
+    class AnswerRequestHandler(BaseHTTPRequestHandler):
+
+        def sendJson(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.sendJson(200, server.getStatistics())
+            elif self.path == '/health':
+                if server.ready.is_set() and not server.stopped:
+                    self.sendJson(200, {'status': 'ok'})
+                else:
+                    self.sendJson(503, {'status': 'loading' if not server.stopped
+                                        else 'stopped'})
+            else:
+                self.sendJson(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            if self.path != '/answer':
+                self.sendJson(404, {'error': 'unknown path'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = AnswerRequest.fromJson(json.loads(self.rfile.read(length)))
+            except (BadRequest, ValueError) as e:
+                self.sendJson(400, {'error': str(e)})
+                return
+            start = time.perf_counter()
+            try:
+                result = server.submit(request).result(timeout=requestTimeout)
+            except QueryTimeout as e:
+                self.sendJson(504, {'error': str(e)})
+                return
+            except BaseException as e:
+                self.sendJson(500, {'error': str(e)})
+                return
+            response = resultToJson(result)
+            response['latency_seconds'] = time.perf_counter() - start
+            self.sendJson(200, response)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return AnswerRequestHandler
+
+
+def parse_args():
+    parser = buildArgumentParser(description='Keep models loaded and answer '
+        'questions about images sent by HTTP', questionsRequired=False)
+    parser.add_argument('--host', dest='host', action='store', type=str,
+                        default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', dest='port', action='store', type=int,
+                        default=8080, help='port to listen on')
+    parser.add_argument('--max-batch-size', dest='maxBatchSize', action='store',
+                        type=int, default=8,
+                        help='maximal number of requests answered together')
+    parser.add_argument('--max-batch-wait-ms', dest='maxBatchWaitMs', action='store',
+                        type=float, default=10.0,
+                        help='time to wait for more requests after the first one')
+    parser.add_argument('--request-timeout', dest='requestTimeout', action='store',
+                        type=float, default=60.0,
+                        help='seconds to wait for answer before failing request')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    initializeRootAndOpencogLogger(args.opencogLogLevel, args.pythonLogLevel)
+
+    server = VqaAnswerServer(args, args.maxBatchSize, args.maxBatchWaitMs / 1000)
+    worker = threading.Thread(target=server.run, name='answer-worker')
+    worker.start()
+    server.ready.wait()
+    if server.stopped:
+        logger.error('Pipeline cannot be loaded')
+        worker.join()
+        return
+
+    httpServer = ThreadingHTTPServer((args.host, args.port),
+                                     buildRequestHandler(server, args.requestTimeout))
+    logger.info('Answer server is listening on %s:%s', args.host, args.port)
+    try:
+        httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpServer.server_close()
+        server.stop()
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+Binary snapshot of atomspace facts file
+
+Facts files like train_tv_atomspace.scm contain only atoms, for example
+(InheritanceLink (stv 0.8 0.9) (ConceptNode "red") (ConceptNode "color")).
+Such file is compiled once into columnar snapshot (node names, link
+outgoing sets and truth values) which is added into atomspace by Python
+API without Guile reading and evaluating each expression. Snapshot keeps
+modification time and size of the source file and it is recompiled when
+source changes. Files with any other Scheme code (define, load, etc) are
+not supported and are loaded by Guile.
+
+Usage:
+
+    python atomspace_snapshot.py train_tv_atomspace.scm
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import numpy
+
+from opencog.atomspace import types, TruthValue
+from opencog.scheme_wrapper import scheme_eval
+
+
+SNAPSHOT_SUFFIX = '.snapshot.npz'
+SNAPSHOT_FORMAT_VERSION = 1
+
+tokenRegex = re.compile(r'(?P<space>\s+|;[^\n]*)|(?P<open>\()|(?P<close>\))'
+                        r'|(?P<string>"(?:[^"\\]|\\.)*")|(?P<symbol>[^\s()";]+)')
+
+# escapes of Guile string reader
+ESCAPED_CHARACTERS = {'a': '\a', 'b': '\b', 't': '\t', 'n': '\n', 'r': '\r',
+                      'f': '\f', 'v': '\v', '0': '\0'}
+escapeRegex = re.compile(r'\\(x[0-9a-fA-F]+;|\n[ \t]*|.)', re.DOTALL)
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedExpression(ValueError):
+    pass
+
+
+def unescapeCharacter(match):
+    escape = match.group(1)
+    if escape.startswith('x') and len(escape) > 1:
+        return chr(int(escape[1:-1], 16))
+    if escape.startswith('\n'):
+        # line continuation, leading whitespace of next line is skipped
+        return ''
+    return ESCAPED_CHARACTERS.get(escape, escape)
+
+
+def unescape(string):
+    return escapeRegex.sub(unescapeCharacter, string[1:-1])
+
+
+def readExpressions(text):
+    """
+    Read top level lists of Scheme text, strings are unescaped and
+    symbols are kept as is
+
+    :return: Iterator[list]
+    """
+    stack = []
+    position = 0
+    for match in tokenRegex.finditer(text):
+        if match.start() != position:
+            raise UnsupportedExpression('Unexpected text at {}'.format(position))
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        if kind == 'open':
+            stack.append([])
+        elif kind == 'close':
+            if not stack:
+                raise UnsupportedExpression('Unbalanced ) at {}'.format(match.start()))
+            expression = stack.pop()
+            if stack:
+                stack[-1].append(expression)
+            else:
+                yield expression
+        elif not stack:
+            raise UnsupportedExpression('Top level atom {} at {}'.format(match.group(), match.start()))
+        elif kind == 'string':
+            stack[-1].append(('string', unescape(match.group())))
+        else:
+            stack[-1].append(match.group())
+    if position != len(text) or stack:
+        raise UnsupportedExpression('Unexpected end of file')
+
+
+class SnapshotBuilder:
+    """
+    Collects unique atoms of facts file in order in which they can be
+    added into atomspace: outgoing atoms before links
+    """
+
+    def __init__(self):
+        self.typeNames = []
+        self.typeIndexByName = {}
+        self.atomIdByKey = {}
+        self.atomTypes = []
+        self.nodeNames = []
+        # index in nodeNames for nodes, -1 for links
+        self.nameIndexes = []
+        self.outgoing = []
+        self.outgoingOffsets = [0]
+        self.strengths = []
+        self.confidences = []
+
+    def getTypeIndex(self, typeName):
+        if typeName not in self.typeIndexByName:
+            if not isinstance(typeName, str) or not hasattr(types, typeName):
+                raise UnsupportedExpression('Unknown atom type {}'.format(typeName))
+            self.typeIndexByName[typeName] = len(self.typeNames)
+            self.typeNames.append(typeName)
+        return self.typeIndexByName[typeName]
+
+    def addAtom(self, key, typeIndex, name, outgoing, truthValue):
+        atomId = self.atomIdByKey.get(key)
+        if atomId is None:
+            atomId = len(self.atomTypes)
+            self.atomIdByKey[key] = atomId
+            self.atomTypes.append(typeIndex)
+            if name is None:
+                self.nameIndexes.append(-1)
+            else:
+                self.nameIndexes.append(len(self.nodeNames))
+                self.nodeNames.append(name)
+            self.outgoing += outgoing
+            self.outgoingOffsets.append(len(self.outgoing))
+            self.strengths.append(numpy.nan)
+            self.confidences.append(numpy.nan)
+        if truthValue is not None:
+            self.strengths[atomId], self.confidences[atomId] = truthValue
+        return atomId
+
+    def addExpression(self, expression):
+        if not expression or not isinstance(expression[0], str):
+            raise UnsupportedExpression('Unexpected expression {}'.format(expression))
+        typeIndex = self.getTypeIndex(expression[0])
+        truthValue = None
+        name = None
+        outgoing = []
+        for argument in expression[1:]:
+            if isinstance(argument, tuple):
+                if name is not None or outgoing:
+                    raise UnsupportedExpression('Unexpected name in {}'.format(expression))
+                name = argument[1]
+            elif isinstance(argument, list) and argument and argument[0] == 'stv':
+                truthValue = self.parseTruthValue(argument)
+            elif isinstance(argument, list):
+                if name is not None:
+                    raise UnsupportedExpression('Node with outgoing set {}'.format(expression))
+                outgoing.append(self.addExpression(argument))
+            else:
+                raise UnsupportedExpression('Unexpected argument {} in {}'
+                                            .format(argument, expression[0]))
+        if name is not None:
+            return self.addAtom((typeIndex, name), typeIndex, name, [], truthValue)
+        return self.addAtom((typeIndex, tuple(outgoing)), typeIndex, None, outgoing, truthValue)
+
+    def parseTruthValue(self, expression):
+        try:
+            strength, confidence = (float(number) for number in expression[1:])
+        except (TypeError, ValueError):
+            raise UnsupportedExpression('Unexpected truth value {}'.format(expression))
+        return strength, confidence
+
+    def save(self, fileName, sourceStat):
+        header = {'version': SNAPSHOT_FORMAT_VERSION,
+                  'source_mtime_ns': sourceStat.st_mtime_ns,
+                  'source_size': sourceStat.st_size,
+                  'types': self.typeNames}
+        names = [name.encode('utf-8') for name in self.nodeNames]
+        temporaryFileName = fileName + '.tmp'
+        with open(temporaryFileName, 'wb') as file:
+            numpy.savez(file,
+                        header=numpy.array(json.dumps(header)),
+                        atom_types=numpy.array(self.atomTypes, dtype=numpy.int32),
+                        name_indexes=numpy.array(self.nameIndexes, dtype=numpy.int64),
+                        names=numpy.frombuffer(b''.join(names), dtype=numpy.uint8),
+                        name_offsets=numpy.cumsum([0] + [len(name) for name in names],
+                                                  dtype=numpy.int64),
+                        outgoing=numpy.array(self.outgoing, dtype=numpy.int64),
+                        outgoing_offsets=numpy.array(self.outgoingOffsets, dtype=numpy.int64),
+                        strengths=numpy.array(self.strengths, dtype=numpy.float64),
+                        confidences=numpy.array(self.confidences, dtype=numpy.float64))
+        os.replace(temporaryFileName, fileName)
+
+
+def getSnapshotFileName(factsFileName):
+    return factsFileName + SNAPSHOT_SUFFIX
+
+
+def compileSnapshot(factsFileName, snapshotFileName=None):
+    """
+    Compile facts file into snapshot
+
+    :raise UnsupportedExpression: if file contains anything except atoms
+    """
+    if snapshotFileName is None:
+        snapshotFileName = getSnapshotFileName(factsFileName)
+    sourceStat = os.stat(factsFileName)
+    with open(factsFileName, 'r') as file:
+        text = file.read()
+    builder = SnapshotBuilder()
+    for expression in readExpressions(text):
+        builder.addExpression(expression)
+    builder.save(snapshotFileName, sourceStat)
+    logger.info('Atomspace snapshot %s is compiled, %s atoms',
+                snapshotFileName, len(builder.atomTypes))
+    return snapshotFileName
+
+
+def isSnapshotUpToDate(factsFileName, snapshotFileName):
+    try:
+        with numpy.load(snapshotFileName) as snapshot:
+            header = json.loads(str(snapshot['header']))
+    except (OSError, ValueError, KeyError):
+        return False
+    sourceStat = os.stat(factsFileName)
+    return (header.get('version') == SNAPSHOT_FORMAT_VERSION
+            and header.get('source_mtime_ns') == sourceStat.st_mtime_ns
+            and header.get('source_size') == sourceStat.st_size)
+
+
+def loadSnapshot(atomspace, snapshotFileName):
+    """
+    Add atoms of snapshot into atomspace
+    """
+    with numpy.load(snapshotFileName) as snapshot:
+        header = json.loads(str(snapshot['header']))
+        atomTypes = snapshot['atom_types'].tolist()
+        nameIndexes = snapshot['name_indexes'].tolist()
+        names = snapshot['names'].tobytes()
+        nameOffsets = snapshot['name_offsets'].tolist()
+        outgoing = snapshot['outgoing'].tolist()
+        outgoingOffsets = snapshot['outgoing_offsets'].tolist()
+        strengths = snapshot['strengths'].tolist()
+        confidences = snapshot['confidences'].tolist()
+    typeByIndex = [getattr(types, typeName) for typeName in header['types']]
+    atoms = []
+    for atomId, typeIndex in enumerate(atomTypes):
+        strength = strengths[atomId]
+        truthValue = None if strength != strength else TruthValue(strength, confidences[atomId])
+        nameIndex = nameIndexes[atomId]
+        if nameIndex >= 0:
+            name = names[nameOffsets[nameIndex]:nameOffsets[nameIndex + 1]].decode('utf-8')
+            atom = atomspace.add_node(typeByIndex[typeIndex], name, truthValue)
+        else:
+            atom = atomspace.add_link(typeByIndex[typeIndex],
+                [atoms[i] for i in outgoing[outgoingOffsets[atomId]:outgoingOffsets[atomId + 1]]],
+                truthValue)
+        atoms.append(atom)
+    logger.info('%s atoms are loaded from snapshot %s', len(atoms), snapshotFileName)
+
+
+def resolveFactsFileName(atomspace, factsFileName):
+    """
+    Find facts file in the same way as Guile (load-from-path) does:
+    by %load-path for relative names
+
+    :return: str
+        full file name, None if file is not found
+    """
+    quoted = factsFileName.replace('\\', '\\\\').replace('"', '\\"')
+    result = str(scheme_eval(atomspace, '(%search-load-path "{}")'.format(quoted))).strip()
+    if result.startswith('"'):
+        return unescape(result)
+    if os.path.isfile(factsFileName):
+        return factsFileName
+    return None
+
+
+def loadFactsUsingSnapshot(atomspace, factsFileName):
+    """
+    Load facts file via snapshot compiling it when snapshot is missing or
+    outdated
+
+    :return: bool
+        False if file cannot be loaded via snapshot and should be loaded
+        by Guile
+    """
+    fileName = resolveFactsFileName(atomspace, factsFileName)
+    if fileName is None:
+        logger.warning('%s is not found in Guile load path, snapshot is not used', factsFileName)
+        return False
+    factsFileName = fileName
+    snapshotFileName = getSnapshotFileName(factsFileName)
+    try:
+        if not isSnapshotUpToDate(factsFileName, snapshotFileName):
+            compileSnapshot(factsFileName, snapshotFileName)
+    except UnsupportedExpression as e:
+        logger.info('%s cannot be compiled into snapshot: %s', factsFileName, e)
+        return False
+    except OSError as e:
+        logger.warning('Cannot write atomspace snapshot %s: %s', snapshotFileName, e)
+        return False
+    loadSnapshot(atomspace, snapshotFileName)
+    return True
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2:
+        print('usage: {} <facts .scm file>'.format(sys.argv[0]))
+        sys.exit(1)
+    compileSnapshot(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
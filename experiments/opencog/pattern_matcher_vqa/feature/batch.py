@@ -0,0 +1,257 @@
+"""
+Bulk extraction of image features
+
+Faster R-CNN test net of bottom-up-attention accepts single image per
+forward pass (proposal layer handles one image), so images are processed
+by pool of worker processes each of them keeping its own Caffe net. Each
+worker decodes next images in thread pool while net runs forward pass.
+Features are written into binary features store (see feature.store) or
+into .tsv files which TsvFileFeatureLoader reads.
+
+Usage:
+
+    python -m feature.batch --prototxt test.prototxt --weights model.caffemodel \\
+        --images val2014.zip --feature-store val2014_store --workers 4
+"""
+
+import os
+import queue
+import logging
+import itertools
+import collections
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+
+from util import *
+from feature.store import FeatureStoreWriter, listFilesByPrefix
+
+
+TSV_HEADER = '\t'.join(['roi_x', 'roi_y', 'roi_width', 'roi_height',
+                        'spatial_feature_6d', 'img_feature_d2048'])
+
+logger = logging.getLogger(__name__)
+
+
+def spatialFeatures(boxes, imageWidth, imageHeight):
+    """
+    Build leading columns of .tsv features file: roi_x, roi_y, roi_width,
+    roi_height and 6d spatial feature x1/w, y1/h, x2/w, y2/h, width/w,
+    height/h
+
+    :param boxes: numpy.array
+        numBoxes x 4 array of x1, y1, x2, y2
+    :return: numpy.array
+        numBoxes x feature.store.NUM_SPATIAL_COLUMNS array
+    """
+    boxes = numpy.asarray(boxes, dtype=numpy.float32).reshape(-1, 4)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    width = x2 - x1
+    height = y2 - y1
+    return numpy.stack([x1, y1, width, height,
+                        x1 / imageWidth, y1 / imageHeight,
+                        x2 / imageWidth, y2 / imageHeight,
+                        width / imageWidth, height / imageHeight], axis=1)
+
+
+class ExtractedFeatures:
+    __slots__ = ["imageId", "features", "spatial"]
+
+    def __init__(self, imageId, features, spatial):
+        self.imageId = imageId
+        self.features = features
+        self.spatial = spatial
+
+
+def extractFeatures(extractor, images, decodeThreads=2):
+    """
+    Extract features of images by single extractor decoding next images
+    in background threads
+
+    :param extractor: feature.image.ImageFeatureExtractor
+    :param images: Iterable[tuple(imageId, image)]
+        image is either file name in extractor.imagesPath or numpy.array
+        in BGR format as cv2 decodes it
+    :param decodeThreads: int
+    :return: Iterator[ExtractedFeatures]
+        features of images in the same order, features are None if
+        image cannot be processed
+    """
+    def decode(image):
+        if isinstance(image, str):
+            return extractor.loadImageByFileName(image)
+        return image
+
+    images = iter(images)
+    with ThreadPoolExecutor(decodeThreads) as pool:
+        # keep only few decoded images ahead to limit memory usage
+        pending = collections.deque((imageId, pool.submit(decode, image)) for imageId, image
+                                    in itertools.islice(images, 2 * decodeThreads))
+        while pending:
+            imageId, future = pending.popleft()
+            for nextImageId, nextImage in itertools.islice(images, 1):
+                pending.append((nextImageId, pool.submit(decode, nextImage)))
+            try:
+                image = future.result()
+                features, boxes = extractor.extractFeaturesByBRGImage(image)
+                spatial = spatialFeatures(boxes, image.shape[1], image.shape[0])
+                yield ExtractedFeatures(imageId, features, spatial)
+            except BaseException as e:
+                logger.exception('Cannot extract features of image %s: %s', imageId, e)
+                yield ExtractedFeatures(imageId, None, None)
+
+
+def extractionWorker(args, chunkQueue, resultQueue):
+    """
+    Worker process which extracts features of chunks of images from
+    chunkQueue until it gets None, puts None into resultQueue on exit
+    """
+    logging.basicConfig(level=logging.INFO)
+    try:
+        from feature.image import ImageFeatureExtractor
+        extractor = ImageFeatureExtractor(args.prototxt, args.weights,
+                                          args.imagesPath, args.imagesPrefix)
+        while True:
+            chunk = chunkQueue.get()
+            if chunk is None:
+                break
+            for result in extractFeatures(extractor, chunk, args.decodeThreads):
+                resultQueue.put(result)
+    except BaseException as e:
+        logger.exception('Unexpected exception in extraction worker %s', e)
+    finally:
+        resultQueue.put(None)
+
+
+def collectResults(workers, resultQueue):
+    running = len(workers)
+    while running:
+        try:
+            result = resultQueue.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                logger.error('Extraction workers exited unexpectedly')
+                return
+            continue
+        if result is None:
+            running -= 1
+            continue
+        yield result
+
+
+def extractFeaturesByWorkers(args, images):
+    """
+    Extract features by args.workers processes
+
+    :param images: list[tuple(imageId, fileName)]
+    :return: Iterator[ExtractedFeatures]
+        features in order of completion
+    """
+    context = multiprocessing.get_context('spawn')
+    chunkQueue = context.Queue()
+    resultQueue = context.Queue()
+    for start in range(0, len(images), args.chunkSize):
+        chunkQueue.put(images[start:start + args.chunkSize])
+    for _ in range(args.workers):
+        chunkQueue.put(None)
+    workers = [context.Process(target=extractionWorker, args=(args, chunkQueue, resultQueue))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        yield from collectResults(workers, resultQueue)
+    finally:
+        for worker in workers:
+            worker.join()
+
+
+def writeTsvFeatures(fileName, result):
+    with open(fileName, 'w') as file:
+        file.write(TSV_HEADER + '\n')
+        for spatial, features in zip(result.spatial, result.features):
+            file.write('\t'.join(repr(float(number)) for number
+                                 in numpy.concatenate([spatial, features])) + '\n')
+
+
+def writeResults(args, numImages, results):
+    writer = None
+    processed = 0
+    failed = 0
+    for result in results:
+        processed += 1
+        if result.features is None:
+            failed += 1
+            continue
+        if args.featureStorePath is not None:
+            if writer is None:
+                writer = FeatureStoreWriter(args.featureStorePath, numImages, args.maxBoxes,
+                                            result.features.shape[1])
+            writer.add(result.imageId, result.features, result.spatial)
+        else:
+            fileName = os.path.join(args.tsvPath, args.tsvPrefix
+                                    + addLeadingZeros(result.imageId, 12) + '.tsv')
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            writeTsvFeatures(fileName, result)
+        if processed % 100 == 0:
+            logger.info('%s of %s images processed', processed, numImages)
+    if writer is not None:
+        writer.close()
+    logger.info('%s images processed, %s failed', processed, failed)
+
+
+def listImages(args):
+    if args.imageIdsFileName is None:
+        return listFilesByPrefix(args.imagesPath, args.imagesPrefix, '.jpg')
+    with open(args.imageIdsFileName, 'r') as file:
+        imageIds = [int(line) for line in file if line.strip()]
+    return [(imageId, args.imagesPrefix + addLeadingZeros(imageId, 12) + '.jpg')
+            for imageId in imageIds]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Extract features of images '
+        'into binary features store or .tsv files')
+    parser.add_argument('--prototxt', dest='prototxt', action='store', type=str,
+        required=True, help='Faster R-CNN test net definition')
+    parser.add_argument('--weights', dest='weights', action='store', type=str,
+        required=True, help='Faster R-CNN .caffemodel file')
+    parser.add_argument('--images', '-i', dest='imagesPath', action='store', type=str,
+        required=True, help='path to images (it can be either zip archive or folder name)')
+    parser.add_argument('--images-prefix', dest='imagesPrefix', action='store', type=str,
+        default='val2014/COCO_val2014_',
+        help='image file prefix to be merged with path to open image')
+    parser.add_argument('--image-ids', dest='imageIdsFileName', action='store', type=str,
+        help='file with image id per line, all images by prefix are processed '
+        'if not set')
+    parser.add_argument('--feature-store', '-o', dest='featureStorePath', action='store',
+        type=str, help='folder to write features store to')
+    parser.add_argument('--tsv', dest='tsvPath', action='store', type=str,
+        help='folder to write .tsv features files to')
+    parser.add_argument('--tsv-prefix', dest='tsvPrefix', action='store', type=str,
+        default='val2014_parsed_features/COCO_val2014_',
+        help='prefix of .tsv features files')
+    parser.add_argument('--max-boxes', dest='maxBoxes', action='store', type=int,
+        default=36, help='maximal number of bounding boxes per image in store')
+    parser.add_argument('--workers', dest='workers', action='store', type=int, default=1,
+        help='number of processes each running its own Caffe net')
+    parser.add_argument('--decode-threads', dest='decodeThreads', action='store', type=int,
+        default=2, help='number of threads decoding images in each worker')
+    parser.add_argument('--chunk-size', dest='chunkSize', action='store', type=int,
+        default=16, help='number of images which are passed to worker at once')
+    args = parser.parse_args()
+    if (args.featureStorePath is None) == (args.tsvPath is None):
+        parser.error('exactly one of --feature-store and --tsv is required')
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    images = listImages(args)
+    logger.info('Extracting features of %s images', len(images))
+    writeResults(args, len(images), extractFeaturesByWorkers(args, images))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Persistent cache of image features
+
+Cache is a folder with one uncompressed .npz file per image which keeps
+float32 features and boxes arrays. Entry is found either by hash of image
+content or by image file name, modification time and size, so features
+of image loaded by id are found without reading and hashing the image.
+Key includes namespace which identifies feature extracting model.
+
+Entries are written into temporary file and renamed, so processes sharing
+the cache never read partially written entry. Modification time of entry
+is updated on each hit. Each process keeps estimate of total size of
+entries: folder is scanned when estimate exceeds the limit or after
+REFRESH_PUTS writes (other processes write into it too), and least
+recently used entries are removed until size is under low-water mark,
+so folder is not scanned on each write.
+"""
+
+import os
+import fcntl
+import hashlib
+import logging
+import threading
+import tempfile
+import zipfile
+import numpy
+
+
+ENTRY_SUFFIX = '.npz'
+LOCK_FILE_NAME = '.lock'
+LOW_WATER_RATIO = 0.9
+REFRESH_PUTS = 256
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureCache:
+
+    def __init__(self, cachePath, maxBytes=1 << 30, namespace=''):
+        """
+        :param cachePath: str
+            cache folder, it is created if it doesn't exist
+        :param maxBytes: int
+            maximal total size of cache entries
+        :param namespace: str
+            identity of model and parameters which features depend on
+        """
+        os.makedirs(cachePath, exist_ok=True)
+        self.cachePath = cachePath
+        self.maxBytes = maxBytes
+        self.lowWaterBytes = int(maxBytes * LOW_WATER_RATIO)
+        self.namespace = namespace
+        # estimate is updated by feature threads concurrently
+        self.lock = threading.Lock()
+        # None until folder is scanned first time
+        self.estimatedBytes = None
+        self.putsSinceScan = 0
+        self.hits = 0
+        self.misses = 0
+
+    def hashKey(self, *parts):
+        sha1 = hashlib.sha1(self.namespace.encode('utf-8'))
+        for part in parts:
+            sha1.update(b'\0')
+            sha1.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def keyByContent(self, image):
+        """
+        :param image: numpy.array
+        """
+        image = numpy.ascontiguousarray(image)
+        return self.hashKey('content', image.shape, image.dtype.str, image.data)
+
+    def keyByFile(self, fileName, mtime, size):
+        return self.hashKey('file', fileName, mtime, size)
+
+    def getEntryPath(self, key):
+        return os.path.join(self.cachePath, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """
+        :return: tuple(numpy.array, numpy.array)
+            features and boxes, None if key is not cached
+        """
+        entryPath = self.getEntryPath(key)
+        try:
+            with numpy.load(entryPath) as entry:
+                result = entry['features'], entry['boxes']
+            os.utime(entryPath)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning('Removing broken feature cache entry %s: %s', entryPath, e)
+            self.remove(entryPath)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, features, boxes):
+        file = tempfile.NamedTemporaryFile(dir=self.cachePath, suffix='.tmp', delete=False)
+        try:
+            with file:
+                numpy.savez(file, features=numpy.asarray(features, dtype=numpy.float32),
+                            boxes=numpy.asarray(boxes, dtype=numpy.float32))
+            size = os.path.getsize(file.name)
+            os.replace(file.name, self.getEntryPath(key))
+        except BaseException:
+            self.remove(file.name)
+            raise
+        self.addEntryBytes(size)
+
+    def addEntryBytes(self, size):
+        with self.lock:
+            self.putsSinceScan += 1
+            if self.estimatedBytes is not None:
+                self.estimatedBytes += size
+            if (self.estimatedBytes is None or self.estimatedBytes > self.maxBytes
+                    or self.putsSinceScan >= REFRESH_PUTS):
+                self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """
+        Scan folder and if total size exceeds limit remove least recently
+        used entries until it is under low-water mark, self.lock should be
+        held by caller
+        """
+        with open(os.path.join(self.cachePath, LOCK_FILE_NAME), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            entries = []
+            totalBytes = 0
+            for dirEntry in os.scandir(self.cachePath):
+                if not dirEntry.name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    stat = dirEntry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, dirEntry.path))
+                totalBytes += stat.st_size
+            self.putsSinceScan = 0
+            self.estimatedBytes = totalBytes
+            if totalBytes <= self.maxBytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if totalBytes <= self.lowWaterBytes:
+                    break
+                self.remove(path)
+                totalBytes -= size
+            self.estimatedBytes = totalBytes
+            logger.debug('Feature cache is reduced to %s bytes', totalBytes)
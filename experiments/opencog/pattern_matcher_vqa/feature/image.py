@@ -1,5 +1,7 @@
+import os
 import sys
 import hashlib
+import threading
 import functools
 import numpy as np
 import numpy
@@ -12,6 +14,7 @@ from fast_rcnn.config import cfg
 
 from util import *
 from interface import FeatureExtractor
+from feature.cache import FeatureCache
 
 
 def numpyImageToBRG(rgb):
@@ -46,6 +49,77 @@ class ArrayHash():
        return not ((self < other) or (other < self))
 
 
+def boxOverlaps(boxes):
+    """
+    Compute IoU of each pair of boxes in the same way as fast_rcnn nms()
+    does: in float32 and with +1 pixel width and height
+    :param boxes: numpy.array
+        numBoxes x 4 array of x1, y1, x2, y2
+    :return: numpy.array
+        numBoxes x numBoxes array of IoU
+    """
+    boxes = boxes.astype(np.float32)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    width = np.maximum(np.float32(0.0), np.minimum(x2[:, None], x2[None, :])
+                       - np.maximum(x1[:, None], x1[None, :]) + 1)
+    height = np.maximum(np.float32(0.0), np.minimum(y2[:, None], y2[None, :])
+                        - np.maximum(y1[:, None], y1[None, :]) + 1)
+    intersection = width * height
+    return intersection / (areas[:, None] + areas[None, :] - intersection)
+
+
+def maxConfidenceByClassNms(boxes, scores, threshold):
+    """
+    Run nms() for each class except background and compute maximal
+    score of each box among classes in which the box is kept
+    :param boxes: numpy.array
+        numBoxes x 4 boxes shared by all classes
+    :param scores: numpy.array
+        numBoxes x numClasses scores
+    :return: numpy.array
+        numBoxes maximal scores
+    """
+    max_conf = np.zeros((boxes.shape[0]))
+    for cls_ind in range(1,scores.shape[1]):
+        cls_scores = scores[:, cls_ind]
+        dets = np.hstack((boxes, cls_scores[:, np.newaxis])).astype(np.float32)
+        keep = np.array(nms(dets, threshold))
+        max_conf[keep] = np.where(cls_scores[keep] > max_conf[keep], cls_scores[keep], max_conf[keep])
+    return max_conf
+
+
+def maxConfidenceByBatchedNms(boxes, scores, threshold, strict):
+    """
+    Vectorized version of maxConfidenceByClassNms()
+
+    Boxes are the same for all classes, so IoU matrix is computed once
+    and greedy suppression is run for all classes at once: on each step
+    every class takes its next box in the order of decreasing score, keeps
+    it if it is not suppressed yet and suppresses boxes overlapping it.
+    :param strict: bool
+        suppress boxes with IoU > threshold like gpu_nms() does if True,
+        with IoU >= threshold like cpu_nms() does otherwise
+    """
+    classScores = scores[:, 1:]
+    numBoxes, numClasses = classScores.shape
+    overlaps = boxOverlaps(boxes)
+    suppressing = overlaps > threshold if strict else overlaps >= threshold
+    # the same order as nms() gets by scores.argsort()[::-1]
+    order = np.argsort(classScores.astype(np.float32), axis=0)[::-1].T
+    classes = np.arange(numClasses)
+    suppressed = np.zeros((numClasses, numBoxes), dtype=bool)
+    kept = np.zeros((numClasses, numBoxes), dtype=bool)
+    for rank in range(numBoxes):
+        boxIndexes = order[:, rank]
+        alive = ~suppressed[classes, boxIndexes]
+        aliveClasses = classes[alive]
+        aliveBoxes = boxIndexes[alive]
+        kept[aliveClasses, aliveBoxes] = True
+        suppressed[aliveClasses] |= suppressing[aliveBoxes]
+    return np.where(kept.T, classScores, 0.0).max(axis=1, initial=0.0)
+
+
 def array_cache(function, maxsize=10):
 
     @functools.lru_cache(maxsize=maxsize)
@@ -60,15 +134,37 @@ def array_cache(function, maxsize=10):
 
 class ImageFeatureExtractor(FeatureExtractor):
     
-    def __init__(self, prototxt, weights, imagesPath=None, imagePrefix=None):
+    def __init__(self, prototxt, weights, imagesPath=None, imagePrefix=None,
+                 batchedNms=True, featureCachePath=None, featureCacheBytes=1 << 30):
+        """
+        :param featureCachePath: str
+            folder of persistent features cache, see feature.cache
+        :param featureCacheBytes: int
+            maximal size of persistent features cache
+        """
         self.prototxt = prototxt
         self.weights = weights
         self.imagesPath = imagesPath
         self.imagePrefix = imagePrefix
+        self.batchedNms = batchedNms
         self.net = self.initFeatureExtractingNetwork()
+        # Caffe net keeps blobs of the last forward pass, so it is used
+        # by one thread at a time (see --prefetch-feature-threads)
+        self.netLock = threading.Lock()
         self.conf_thresh = 0.2
         self.MIN_BOXES = 36
         self.MAX_BOXES = 36
+        self.featureCache = None
+        if featureCachePath is not None:
+            self.featureCache = FeatureCache(featureCachePath, featureCacheBytes,
+                                             self.getFeatureCacheNamespace())
+
+    def getFeatureCacheNamespace(self):
+        weightsStat = os.stat(self.weights)
+        return ':'.join(str(part) for part in (
+            os.path.abspath(self.prototxt), os.path.abspath(self.weights),
+            weightsStat.st_mtime_ns, weightsStat.st_size, self.conf_thresh,
+            self.MIN_BOXES, self.MAX_BOXES))
     
     def initFeatureExtractingNetwork(self):
         if torch.cuda.device_count():
@@ -89,41 +185,58 @@ class ImageFeatureExtractor(FeatureExtractor):
             lambda fileHandle: self.loadImageUsingFileHandle(fileHandle))
         
     def getFeaturesByImageId(self, imageId):
-        return self.getFeaturesByImagePath(self.getImageFileName(imageId))
+        features, _ = self.getFeaturesByImagePath(self.getImageFileName(imageId))
+        return features
     
     def getFeaturesByImage(self, image):
-        return self.getFeaturesByBRGImage(numpyImageToBRG(image))
+        if self.featureCache is None:
+            return self.getFeaturesByBRGImage(numpyImageToBRG(image))
+        return self.getCachedFeatures(self.featureCache.keyByContent(image),
+            lambda: self.getFeaturesByBRGImage(numpyImageToBRG(image)))
 
     def getFeaturesByImagePath(self, imagePath):
-        image = self.loadImageByFileName(imagePath)
-        return self.getFeaturesByBRGImage(image)
-
-    @array_cache
-    def getFeaturesByBRGImage(self, image):
+        if self.featureCache is None:
+            return self.getFeaturesByBRGImage(self.loadImageByFileName(imagePath))
+        # image is not read when its features are cached
+        key = self.featureCache.keyByFile(
+            *getFileVersionInZipOrFolder(self.imagesPath, imagePath))
+        return self.getCachedFeatures(key,
+            lambda: self.getFeaturesByBRGImage(self.loadImageByFileName(imagePath)))
+
+    def getCachedFeatures(self, key, computeFeatures):
+        result = self.featureCache.get(key)
+        if result is None:
+            result = computeFeatures()
+            self.featureCache.put(key, *result)
+        return result
+
+    def extractFeaturesByBRGImage(self, image):
         """
         Compute features for regions in the image
         :param image: numpy.array
-        :return: tuple(list[features], list[bounding boxes])
+        :return: tuple(numpy.array, numpy.array)
+            features and bounding boxes
         """
-        scores, boxes, attr_scores, rel_scores = im_detect(self.net, image)
-        
-        # Keep the original boxes, don't worry about the regresssion bbox outputs
-        rois = self.net.blobs['rois'].data.copy()
+        with self.netLock:
+            scores, boxes, attr_scores, rel_scores = im_detect(self.net, image)
+
+            # Keep the original boxes, don't worry about the regresssion bbox outputs
+            rois = self.net.blobs['rois'].data.copy()
+            # blobs are copied before net is released to other threads
+            cls_prob = self.net.blobs['cls_prob'].data.copy()
+            pool5 = self.net.blobs['pool5_flat'].data.copy()
         # unscale back to raw image space
         _, im_scales = _get_blobs(image, None)
     
         cls_boxes = rois[:, 1:5] / im_scales[0]
-        cls_prob = self.net.blobs['cls_prob'].data
-        pool5 = self.net.blobs['pool5_flat'].data
     
         # Keep only the best detections
-        max_conf = np.zeros((rois.shape[0]))
-        for cls_ind in range(1,cls_prob.shape[1]):
-            cls_scores = scores[:, cls_ind]
-            dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])).astype(np.float32)
-            keep = np.array(nms(dets, cfg.TEST.NMS))
-            max_conf[keep] = np.where(cls_scores[keep] > max_conf[keep], cls_scores[keep], max_conf[keep])
-
+        if self.batchedNms:
+            max_conf = maxConfidenceByBatchedNms(cls_boxes, scores[:, :cls_prob.shape[1]],
+                                                 cfg.TEST.NMS, cfg.USE_GPU_NMS)
+        else:
+            max_conf = maxConfidenceByClassNms(cls_boxes, scores[:, :cls_prob.shape[1]],
+                                               cfg.TEST.NMS)
 
         keep_boxes = np.where(max_conf >= self.conf_thresh)[0]
 
@@ -132,8 +245,8 @@ class ImageFeatureExtractor(FeatureExtractor):
         elif len(keep_boxes) > self.MAX_BOXES:
             keep_boxes = np.argsort(max_conf)[::-1][:self.MAX_BOXES]
         
-        features = []
-        for box in pool5[keep_boxes]:
-            features.append(box.tolist())
-        
-        return features, cls_boxes[keep_boxes]
+        return pool5[keep_boxes].copy(), cls_boxes[keep_boxes]
+
+    # in-memory cache of recent images, batch extraction calls
+    # extractFeaturesByBRGImage() to skip hashing of images
+    getFeaturesByBRGImage = array_cache(extractFeaturesByBRGImage)
@@ -0,0 +1,239 @@
+"""
+Binary store of precalculated image features
+
+Store is a folder which contains:
+    features.npy - numImages x maxBoxes x featureVectorSize array of features
+    spatial.npy - numImages x maxBoxes x numSpatial array of leading columns
+        of .tsv features file (bounding box coordinates etc)
+    counts.npy - number of bounding boxes of each image
+    index.json - row of each image by image id
+
+Arrays are memory-mapped on load, so getting features of an image
+returns view of the file data without parsing or copying it.
+"""
+
+import os
+import json
+import logging
+import zipfile
+import argparse
+import numpy
+
+from util import *
+from interface import FeatureExtractor
+
+
+FEATURES_FILE_NAME = 'features.npy'
+SPATIAL_FILE_NAME = 'spatial.npy'
+COUNTS_FILE_NAME = 'counts.npy'
+INDEX_FILE_NAME = 'index.json'
+
+# number of leading columns of .tsv features file which are not features
+NUM_SPATIAL_COLUMNS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureStoreLoader(FeatureExtractor):
+
+    def __init__(self, storePath):
+        self.storePath = storePath
+        self.features = numpy.load(os.path.join(storePath, FEATURES_FILE_NAME), mmap_mode='r')
+        self.spatial = numpy.load(os.path.join(storePath, SPATIAL_FILE_NAME), mmap_mode='r')
+        self.counts = numpy.load(os.path.join(storePath, COUNTS_FILE_NAME))
+        with open(os.path.join(storePath, INDEX_FILE_NAME), 'r') as indexFile:
+            self.rowByImageId = {int(imageId): row for (imageId, row)
+                                 in json.load(indexFile).items()}
+
+    def getRow(self, imageId):
+        return self.rowByImageId[int(imageId)]
+
+    def getFeaturesByImageId(self, imageId):
+        """
+        Get features of image bounding boxes
+
+        :param imageId: int or str
+        :return: numpy.array
+            numBoxes x featureVectorSize view of the store data
+        """
+        row = self.getRow(imageId)
+        return self.features[row, :self.counts[row]]
+
+    def getSpatialByImageId(self, imageId):
+        """
+        Get leading columns of .tsv features file (bounding box coordinates etc)
+
+        :param imageId: int or str
+        :return: numpy.array
+            numBoxes x NUM_SPATIAL_COLUMNS view of the store data
+        """
+        row = self.getRow(imageId)
+        return self.spatial[row, :self.counts[row]]
+
+
+class FeatureStoreWriter:
+    """
+    Writes features into binary store one image after another
+    """
+
+    def __init__(self, storePath, numImages, maxBoxes, featureVectorSize,
+                 dtype=numpy.float32):
+        os.makedirs(storePath, exist_ok=True)
+        self.storePath = storePath
+        self.maxBoxes = maxBoxes
+        self.features = numpy.lib.format.open_memmap(
+            os.path.join(storePath, FEATURES_FILE_NAME), mode='w+', dtype=dtype,
+            shape=(numImages, maxBoxes, featureVectorSize))
+        self.spatial = numpy.lib.format.open_memmap(
+            os.path.join(storePath, SPATIAL_FILE_NAME), mode='w+', dtype=numpy.float32,
+            shape=(numImages, maxBoxes, NUM_SPATIAL_COLUMNS))
+        self.counts = numpy.zeros(numImages, dtype=numpy.int32)
+        self.rowByImageId = {}
+
+    def add(self, imageId, features, spatial):
+        row = len(self.rowByImageId)
+        if len(features) > self.maxBoxes:
+            logger.warning('Image %s has %s bounding boxes, only first %s are kept',
+                           imageId, len(features), self.maxBoxes)
+        count = min(len(features), self.maxBoxes)
+        if count:
+            self.features[row, :count] = numpy.asarray(features[:count])
+            self.spatial[row, :count] = numpy.asarray(spatial[:count])
+        self.counts[row] = count
+        self.rowByImageId[int(imageId)] = row
+
+    def close(self):
+        self.features.flush()
+        self.spatial.flush()
+        numpy.save(os.path.join(self.storePath, COUNTS_FILE_NAME), self.counts)
+        with open(os.path.join(self.storePath, INDEX_FILE_NAME), 'w') as indexFile:
+            json.dump(self.rowByImageId, indexFile)
+        del self.features
+        del self.spatial
+
+
+def loadTsvFeaturesUsingFileHandle(fileHandle):
+    """
+    Parse .tsv features file
+
+    :return: tuple(list[features], list[spatial])
+    """
+    features = []
+    spatial = []
+    next(fileHandle)
+    for line in fileHandle:
+        numbers = numpy.array([float(number) for number in line.split()],
+                              dtype=numpy.float32)
+        spatial.append(numbers[:NUM_SPATIAL_COLUMNS])
+        features.append(numbers[NUM_SPATIAL_COLUMNS:])
+    return features, spatial
+
+
+def listFilesByPrefix(path, prefix, suffix):
+    """
+    List files named <prefix><imageId><suffix> from folder or zip archive
+
+    :return: list[tuple(imageId, fileName)]
+    """
+    if os.path.isdir(path):
+        folder = os.path.join(path, os.path.dirname(prefix))
+        fileNames = [os.path.join(os.path.dirname(prefix), name)
+                     for name in os.listdir(folder)]
+    else:
+        with zipfile.ZipFile(path, 'r') as archive:
+            fileNames = archive.namelist()
+    result = []
+    for fileName in fileNames:
+        if fileName.startswith(prefix) and fileName.endswith(suffix):
+            result.append((int(fileName[len(prefix):-len(suffix)]), fileName))
+    return sorted(result)
+
+
+def listTsvFeatureFiles(featuresPath, featuresPrefix):
+    """
+    List .tsv features files from folder or zip archive
+
+    :return: list[tuple(imageId, fileName)]
+    """
+    return listFilesByPrefix(featuresPath, featuresPrefix, '.tsv')
+
+
+def convertTsvFeatures(featuresPath, featuresPrefix, storePath, maxBoxes=36,
+                       dtype=numpy.float32, featureVectorSize=None):
+    """
+    Convert folder or zip archive of .tsv features files into binary store
+
+    :param featureVectorSize: int
+        size of features vector, if None it is taken from the first image
+        which has bounding boxes; images without bounding boxes are kept
+        with zero count
+    """
+    files = listTsvFeatureFiles(featuresPath, featuresPrefix)
+    if not files:
+        raise ValueError('No features files found in {} by prefix {}'
+                         .format(featuresPath, featuresPrefix))
+    writer = None
+    if featureVectorSize is not None:
+        writer = FeatureStoreWriter(storePath, len(files), maxBoxes, featureVectorSize, dtype)
+    # images without bounding boxes which are read before writer is created
+    emptyImageIds = []
+    for number, (imageId, fileName) in enumerate(files):
+        features, spatial = loadDataFromZipOrFolder(featuresPath, fileName,
+            loadTsvFeaturesUsingFileHandle)
+        if writer is None:
+            if not features:
+                emptyImageIds.append(imageId)
+                continue
+            writer = FeatureStoreWriter(storePath, len(files), maxBoxes,
+                                        len(features[0]), dtype)
+            for emptyImageId in emptyImageIds:
+                writer.add(emptyImageId, [], [])
+        writer.add(imageId, features, spatial)
+        if number % 1000 == 0:
+            logger.info('%s of %s images converted', number, len(files))
+    if writer is None:
+        raise ValueError('No bounding boxes found in {}, set feature vector size explicitly'
+                         .format(featuresPath))
+    writer.close()
+    logger.info('%s images converted', len(files))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert precalculated .tsv '
+        'features into binary features store')
+    parser.add_argument('--precalculated-features', '-f', dest='precalculatedFeaturesPath',
+        action='store', type=str, required=True,
+        help='precalculated features path (it can be either zip archive or folder name)')
+    parser.add_argument('--precalculated-features-prefix', dest='precalculatedFeaturesPrefix',
+        action='store', type=str, default='val2014_parsed_features/COCO_val2014_',
+        help='precalculated features prefix to be merged with path to open feature')
+    parser.add_argument('--feature-store', '-o', dest='featureStorePath',
+        action='store', type=str, required=True,
+        help='folder to write features store to')
+    parser.add_argument('--max-boxes', dest='maxBoxes',
+        action='store', type=int, default=36,
+        help='maximal number of bounding boxes per image')
+    parser.add_argument('--dtype', dest='dtype',
+        action='store', type=str, default='float32',
+        choices=['float32', 'float16'],
+        help='type to keep features in store')
+    parser.add_argument('--feature-vector-size', dest='featureVectorSize',
+        action='store', type=int,
+        help='size of features vector, by default it is taken from the first '
+        'image which has bounding boxes')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    convertTsvFeatures(args.precalculatedFeaturesPath,
+                       args.precalculatedFeaturesPrefix,
+                       args.featureStorePath,
+                       args.maxBoxes,
+                       numpy.dtype(args.dtype),
+                       args.featureVectorSize)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,13 +10,44 @@ from interface import NeuralNetworkRunner
 #pathToGlove = '/mnt/fileserver/shared/datasets/at-on-at-data/glove6b_init_300d.npy'
 #pathToModel = '/mnt/fileserver/users/daddywesker/work/TaigaExperiments/32/03_experiment_with_more_layers/01_plus1_prob_layer/model_01_max_score_val.pth.tar'
 
+def removeWeightNorm(module):
+    """
+    Fold weight_norm reparametrization of all submodules into plain weights
+    """
+    for submodule in module.modules():
+        if hasattr(submodule, 'weight_g'):
+            torch.nn.utils.remove_weight_norm(submodule)
+    return module
+
+
+def stripDataParallelPrefix(stateDict):
+    prefix = 'module.'
+    return {(key[len(prefix):] if key.startswith(prefix) else key): value
+            for key, value in stateDict.items()}
+
+
 class HyperNetNeuralNetworkRunner(NeuralNetworkRunner):
     
-    def __init__(self, pathToDictionary, pathToGlove, pathToModel):
+    def __init__(self, pathToDictionary, pathToGlove, pathToModel, inferenceMode=False):
+        """
+        :param inferenceMode: bool
+            load model without DataParallel wrapper and weight_norm
+            reparametrization and run it under torch.inference_mode(),
+            intended for CPU-only hosts
+        """
         self.logger = logging.getLogger('HyperNetNeuralNetworkRunner')
         self.device = device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.dictionary = Dictionary.load_from_file(pathToDictionary)
-        self.model = self.loadModel(pathToGlove, pathToModel)
+        self.inferenceMode = inferenceMode
+        if inferenceMode:
+            self.model = self.loadInferenceModel(pathToModel)
+            self.net = self.model
+        else:
+            self.model = self.loadModel(pathToGlove, pathToModel)
+            self.net = self.model.module
+        # word branch of the model depends on word only, so its output
+        # is computed once per word
+        self.questionVectorByWord = {}
 
     def loadModel(self, pathToGlove, pathToModel):
         model = build_baseline_model(19901, [300, 1280], [2048, 1280], 
@@ -31,18 +62,87 @@ class HyperNetNeuralNetworkRunner(NeuralNetworkRunner):
         
         return model
 
+    def loadInferenceModel(self, pathToModel):
+        model = build_baseline_model(19901, [300, 1280], [2048, 1280],
+              [1280, 1280, 500, 100, 1], [2, 2, 5], [0.5, 'weight', 'ReLU'])
+        # embeddings are part of checkpoint, so GloVe is not loaded
+        checkpoint = torch.load(pathToModel, map_location=self.device.type)
+        model.load_state_dict(stripDataParallelPrefix(checkpoint))
+        model = removeWeightNorm(model).to(self.device)
+        model.train(False)
+        return model
+
+    def noGrad(self):
+        if self.inferenceMode and hasattr(torch, 'inference_mode'):
+            return torch.inference_mode()
+        return torch.no_grad()
+
     def getTensorByWord(self, word):
-        try:
-            index = self.dictionary.idx2word.index(word.lower())
-            tensor = torch.LongTensor([index])
-            return Variable(tensor).to(self.device)
-        except ValueError:
+        index = self.dictionary.word2idx.get(word.lower())
+        if index is None:
             return None
+        tensor = torch.LongTensor([index])
+        return Variable(tensor).to(self.device)
 
-    def runNeuralNetwork(self, features, word):
+    def getQuestionVector(self, word):
+        """
+        Get q_fc_net(w_embed(word)) from cache or compute it
+
+        :return: torch.Tensor
+            1 x hidden size tensor, None if word is unknown
+        """
+        if word in self.questionVectorByWord:
+            return self.questionVectorByWord[word]
         wordTensor = self.getTensorByWord(word)
         if wordTensor is None:
+            questionVector = None
+        else:
+            with self.noGrad():
+                questionVector = self.net.q_fc_net(self.net.w_embed(wordTensor))
+        self.questionVectorByWord[word] = questionVector
+        return questionVector
+
+    def runNeuralNetwork(self, features, word):
+        questionVector = self.getQuestionVector(word)
+        if questionVector is None:
             self.logger.debug("Unknown word: %s", word)
             return torch.zeros(1);
-        featuresTensor = torch.Tensor(features)
-        return self.model(wordTensor, featuresTensor)
\ No newline at end of file
+        featuresTensor = torch.as_tensor(features, dtype=torch.float32).to(self.device)
+        with self.noGrad():
+            return self.net.prob_net(questionVector * self.net.v_fc_net(featuresTensor))
+
+    def runBatch(self, features, words):
+        """
+        Score all bounding boxes for all words by single forward pass
+
+        :param features: numpy.array or torch.Tensor
+            numBoxes x featureVectorSize features of bounding boxes
+        :param words: List[str]
+        :return: torch.Tensor
+            numBoxes x len(words) scores, scores of unknown words are zeros
+        """
+        featuresTensor = torch.as_tensor(features, dtype=torch.float32).to(self.device)
+        scores = torch.zeros(len(featuresTensor), len(words))
+        knownIndexes = []
+        questionVectors = []
+        for i, word in enumerate(words):
+            questionVector = self.getQuestionVector(word)
+            if questionVector is None:
+                self.logger.debug("Unknown word: %s", word)
+            else:
+                knownIndexes.append(i)
+                questionVectors.append(questionVector)
+        if not knownIndexes:
+            return scores
+        with self.noGrad():
+            # bounding boxes branch is computed once for all words
+            boxVectors = self.net.v_fc_net(featuresTensor)
+            # numWords x 1 x hidden size * numBoxes x hidden size
+            joint = torch.stack(questionVectors) * boxVectors
+            knownScores = self.net.prob_net(joint).view(len(knownIndexes), -1)
+        scores[:, knownIndexes] = knownScores.t().cpu()
+        return scores
+
+    def runNeuralNetworkBatch(self, features, words):
+        scores = self.runBatch(features, words)
+        return {word: wordScores for word, wordScores in zip(words, scores.t().tolist())}
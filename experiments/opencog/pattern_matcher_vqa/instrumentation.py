@@ -0,0 +1,161 @@
+"""
+Latency counters and histograms of pipeline stages
+
+Module keeps global metrics object which is used by pipeline code and
+callbacks from atomspace, like network_runner keeps neural network runner.
+Usage:
+
+    with metrics.timer('feature_load'):
+        features = featureExtractor.getFeaturesByImageId(imageId)
+"""
+
+import json
+import math
+import time
+import random
+import threading
+import contextlib
+import collections
+
+
+class LatencyHistogram:
+    """
+    Histogram with logarithmic buckets, quantiles are estimated with
+    relative error less than (BASE - 1)
+    """
+
+    BASE = 1.1
+    MIN_SECONDS = 1e-6
+
+    def __init__(self):
+        self.count = 0
+        self.totalSeconds = 0.0
+        self.maxSeconds = 0.0
+        self.countByBucket = collections.Counter()
+
+    def bucket(self, seconds):
+        if seconds <= self.MIN_SECONDS:
+            return 0
+        return int(math.log(seconds / self.MIN_SECONDS, self.BASE)) + 1
+
+    def add(self, seconds):
+        self.count += 1
+        self.totalSeconds += seconds
+        self.maxSeconds = max(self.maxSeconds, seconds)
+        self.countByBucket[self.bucket(seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.totalSeconds += other.totalSeconds
+        self.maxSeconds = max(self.maxSeconds, other.maxSeconds)
+        self.countByBucket.update(other.countByBucket)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.countByBucket):
+            seen += self.countByBucket[bucket]
+            if seen >= rank:
+                return min(self.MIN_SECONDS * self.BASE ** bucket, self.maxSeconds)
+        return self.maxSeconds
+
+    def asDict(self):
+        return {'count': self.count,
+                'total_seconds': self.totalSeconds,
+                'mean_seconds': self.totalSeconds / self.count if self.count else 0.0,
+                'p50_seconds': self.quantile(0.5),
+                'p95_seconds': self.quantile(0.95),
+                'p99_seconds': self.quantile(0.99),
+                'max_seconds': self.maxSeconds}
+
+
+class Metrics:
+    """
+    Latency histograms by stage name and optional per-question samples
+
+    Durations of stages executed while question is processed are
+    collected per question (see question()), they are kept as
+    separate record when question is sampled (see sampleRate).
+    """
+
+    def __init__(self, sampleRate=0.0, maxSamples=10000):
+        self.lock = threading.Lock()
+        self.histogramByStage = collections.OrderedDict()
+        self.sampleRate = sampleRate
+        self.maxSamples = maxSamples
+        self.samples = []
+        self.local = threading.local()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            histogram = self.histogramByStage.get(stage)
+            if histogram is None:
+                histogram = self.histogramByStage[stage] = LatencyHistogram()
+            histogram.add(seconds)
+        stages = getattr(self.local, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def question(self, record):
+        """
+        Measure whole question processing and sample it with sampleRate
+        probability
+
+        :return: Dict[str, float]
+            durations of stages of question, dict is complete when block
+            is exited
+        """
+        sampled = (self.sampleRate > 0 and len(self.samples) < self.maxSamples
+                   and random.random() < self.sampleRate)
+        stages = collections.OrderedDict()
+        self.local.stages = stages
+        try:
+            with self.timer('question'):
+                yield stages
+        finally:
+            self.local.stages = None
+            if sampled:
+                with self.lock:
+                    self.samples.append({'questionId': record.questionId,
+                                         'imageId': record.imageId,
+                                         'stages': stages})
+
+    def getState(self):
+        with self.lock:
+            return {'histograms': dict(self.histogramByStage),
+                    'samples': list(self.samples)}
+
+    def merge(self, state):
+        """
+        Merge state of metrics from another process, see getState()
+        """
+        with self.lock:
+            for stage, histogram in state['histograms'].items():
+                if stage not in self.histogramByStage:
+                    self.histogramByStage[stage] = LatencyHistogram()
+                self.histogramByStage[stage].merge(histogram)
+            self.samples += state['samples']
+
+    def asDict(self):
+        with self.lock:
+            return {'stages': {stage: histogram.asDict() for stage, histogram
+                               in self.histogramByStage.items()},
+                    'samples': list(self.samples)}
+
+    def dump(self, fileName):
+        with open(fileName, 'w') as file:
+            json.dump(self.asDict(), file, indent=2)
+
+
+metrics = Metrics()
@@ -6,13 +6,62 @@ class NeuralNetworkRunner(ABC):
     def runNeuralNetwork(self, features, word):
         pass
 
+    def runNeuralNetworkBatch(self, features, words):
+        """
+        Run word networks on all bounding boxes at once
+
+        Default implementation falls back to runNeuralNetwork() call per
+        bounding box, runners override it to compute scores by single call.
+
+        :param features: numpy.array
+            bounding boxes features, nBoxes x nFeatures
+        :param words: Iterable[str]
+            words to compute scores for
+        :return: Dict[str, List[float]]
+            scores of bounding boxes by word, words without model
+            (see NoModelException) are not included
+        """
+        result = {}
+        for word in words:
+            try:
+                result[word] = [self.runNeuralNetwork(boxFeatures, word).item()
+                                for boxFeatures in features]
+            except NoModelException:
+                continue
+        return result
+
+    def getStatistics(self):
+        """
+        :return: dict
+            runner counters, for instance word models residency
+        """
+        return {}
+
 
 class AnswerHandler(ABC):
 
     def onNewQuestion(self, record):
         pass
 
-    def onAnswer(self, record, answer):
+    def onAnswer(self, record, answer, details=None):
+        """
+        :param details: dict
+            optional details of answer: boundingBox, query and timings
+            of pipeline stages
+        """
+        pass
+
+    def onTimeout(self, record):
+        pass
+
+    def onNotParsed(self, record):
+        pass
+
+    def onFailure(self, record, error=None):
+        """
+        :param error: BaseException
+            exception raised while answering, None if it is unknown
+        """
         pass
 
     def getUnanswered(self):
@@ -27,11 +76,21 @@ class ChainAnswerHandler(AnswerHandler):
     def onNewQuestion(self, record):
         self.notifyAll(lambda handler: handler.onNewQuestion(record))
 
-    def onAnswer(self, record, answer):
-        self.notifyAll(lambda handler: handler.onAnswer(record, answer))
+    def onAnswer(self, record, answer, details=None):
+        self.notifyAll(lambda handler: handler.onAnswer(record, answer, details))
+
+    def onTimeout(self, record):
+        self.notifyAll(lambda handler: handler.onTimeout(record))
+
+    def onNotParsed(self, record):
+        self.notifyAll(lambda handler: handler.onNotParsed(record))
+
+    def onFailure(self, record, error=None):
+        self.notifyAll(lambda handler: handler.onFailure(record, error))
 
     def notifyAll(self, methodToCall):
-        map(methodToCall, answerHandlerList)
+        for handler in self.answerHandlerList:
+            methodToCall(handler)
 
 
 class FeatureExtractor(ABC):
@@ -0,0 +1,294 @@
+"""
+Export of word models into TorchScript artifact
+
+Builds MULTIDNN, SPLITMULTIDNN or HYPERNET runner from its checkpoint,
+converts it into TorchScript module which keeps vocabulary lookup and
+scores computation together and saves it into single file. Artifact is
+run by scripted_runner.ScriptedModelRunner (--model-kind SCRIPTED) which
+imports neither training code nor checkpoints loading code.
+
+Usage:
+
+    python model_export.py --model-kind SPLITMULTIDNN --multidnn-model models \\
+        --output split_models.pt
+"""
+
+import time
+import random
+import logging
+import argparse
+from typing import Dict, List
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+SCRIPTED_FORMAT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class StackedWordScores(nn.Module):
+    """
+    Scores of word models kept as stacked weights (see
+    netsvocabulary.StackedModels) with thresholds applied as in
+    SplitMultidnnRunner
+    """
+
+    weights: List[torch.Tensor]
+    biases: List[torch.Tensor]
+    sigmoid: bool
+
+    def __init__(self, stackedModels, sigmoid, deltas):
+        """
+        :param stackedModels: netsvocabulary.StackedModels
+        :param sigmoid: bool
+            apply sigmoid to the output of the last layer
+        :param deltas: torch.Tensor
+            threshold - 0.5 for each stacked model
+        """
+        super().__init__()
+        self.weights = [weight.detach().float().cpu().contiguous()
+                        for weight in stackedModels.weights]
+        self.biases = [bias.detach().float().cpu().contiguous()
+                       for bias in stackedModels.biases]
+        self.sigmoid = sigmoid
+        self.register_buffer('deltas', deltas.float())
+
+    def forward(self, features: torch.Tensor, indexes: torch.Tensor) -> torch.Tensor:
+        output = torch.einsum('ni,kio->kno', [features, self.weights[0][indexes]])
+        output = output + self.biases[0][indexes].unsqueeze(1)
+        for layer in range(1, len(self.weights)):
+            output = torch.bmm(torch.relu(output), self.weights[layer][indexes])
+            output = output + self.biases[layer][indexes].unsqueeze(1)
+        if self.sigmoid:
+            output = torch.sigmoid(output)
+        output = output.squeeze(2).t()
+        # take max to keep values in valid range (0, 1)
+        return torch.clamp(output - self.deltas[indexes], min=0.0)
+
+
+class HyperNetWordScores(nn.Module):
+    """
+    Scores of HyperNet model, bounding boxes branch is computed once
+    for all words
+    """
+
+    def __init__(self, net):
+        super().__init__()
+        self.w_embed = net.w_embed
+        self.q_fc_net = net.q_fc_net
+        self.v_fc_net = net.v_fc_net
+        self.prob_net = net.prob_net
+
+    def forward(self, features: torch.Tensor, indexes: torch.Tensor) -> torch.Tensor:
+        questionVectors = self.q_fc_net(self.w_embed(indexes))
+        boxVectors = self.v_fc_net(features)
+        # numWords x 1 x hidden size * numBoxes x hidden size
+        joint = questionVectors.unsqueeze(1) * boxVectors
+        return self.prob_net(joint).view(indexes.size(0), -1).t()
+
+
+class ScriptedWordModels(nn.Module):
+    """
+    Vocabulary lookup and scores of word models in one module
+    """
+
+    modelKind: str
+    formatVersion: int
+    indexByWord: Dict[str, int]
+    lowercase: bool
+    unknownWordsScoredZero: bool
+
+    def __init__(self, modelKind, indexByWord, scores, lowercase=False,
+                 unknownWordsScoredZero=True):
+        """
+        :param indexByWord: Dict[str, int]
+            index of word in scores module
+        :param scores: torch.nn.Module
+            module which computes numBoxes x numWords scores by features
+            and word indexes
+        :param lowercase: bool
+            words are lower cased before lookup
+        :param unknownWordsScoredZero: bool
+            unknown words get zero scores, otherwise they have no scores
+        """
+        super().__init__()
+        self.modelKind = modelKind
+        self.formatVersion = SCRIPTED_FORMAT_VERSION
+        self.indexByWord = dict(indexByWord)
+        self.lowercase = lowercase
+        self.unknownWordsScoredZero = unknownWordsScoredZero
+        self.scores = scores
+
+    @torch.jit.export
+    def getWordIndexes(self, words: List[str]) -> List[int]:
+        """
+        :return: List[int]
+            index of each word, -1 for unknown words
+        """
+        indexes: List[int] = []
+        for word in words:
+            key = word
+            if self.lowercase:
+                key = word.lower()
+            indexes.append(self.indexByWord.get(key, -1))
+        return indexes
+
+    def forward(self, features: torch.Tensor, indexes: torch.Tensor) -> torch.Tensor:
+        """
+        :param features: torch.Tensor
+            numBoxes x featureVectorSize
+        :param indexes: torch.Tensor
+            indexes of known words
+        :return: torch.Tensor
+            numBoxes x len(indexes) scores
+        """
+        return self.scores(features, indexes)
+
+
+def convertMultidnn(runner):
+    """
+    :param runner: multidnn.NetsVocabularyNeuralNetworkRunner
+        runner with stacked word models
+    """
+    netsVocabulary = runner.netsVocabulary
+    models = netsVocabulary.models
+    indexByWord = {word: models.index_by_key[index]
+                   for word, index in netsVocabulary.modelIndexByWord.items()
+                   if index in models.index_by_key}
+    # runner applies sigmoid after word model
+    scores = StackedWordScores(models, True, torch.zeros(len(models)))
+    return ScriptedWordModels('MULTIDNN', indexByWord, scores)
+
+
+def convertSplitMultidnn(runner):
+    """
+    :param runner: splitnet.splitmultidnnmodel.SplitMultidnnRunner
+        runner with stacked word models
+    """
+    netsVocabulary = runner.nets_vocabulary
+    models = netsVocabulary.models
+    indexByWord = {word: models.index_by_key[wordId]
+                   for word, wordId in netsVocabulary.dictionary.word2idx.items()
+                   if wordId in models.index_by_key}
+    deltas = torch.tensor([netsVocabulary.thresholds_by_id[key] - 0.5
+                           for key in models.keys_list])
+    scores = StackedWordScores(models, models.sigmoid, deltas)
+    return ScriptedWordModels('SPLITMULTIDNN', indexByWord, scores,
+                              unknownWordsScoredZero=False)
+
+
+def convertHyperNet(runner):
+    """
+    :param runner: hypernet.HyperNetNeuralNetworkRunner
+        runner in inference mode
+    """
+    scores = HyperNetWordScores(runner.net)
+    return ScriptedWordModels('HYPERNET', runner.dictionary.word2idx, scores,
+                              lowercase=True)
+
+
+def buildRunner(args):
+    # training code is imported by export only
+    if args.kindOfModel == 'MULTIDNN':
+        from multidnn import NetsVocabularyNeuralNetworkRunner
+        return NetsVocabularyNeuralNetworkRunner(args.multidnnModelFileName, stacked=True)
+    elif args.kindOfModel == 'SPLITMULTIDNN':
+        from splitnet.splitmultidnnmodel import SplitMultidnnRunner
+        return SplitMultidnnRunner(args.multidnnModelFileName, stacked=True)
+    elif args.kindOfModel == 'HYPERNET':
+        from hypernet import HyperNetNeuralNetworkRunner
+        return HyperNetNeuralNetworkRunner(args.hypernetWordsFileName, None,
+                                           args.hypernetModelFileName, inferenceMode=True)
+    raise ValueError('Unexpected args.kindOfModel value: {}'.format(args.kindOfModel))
+
+
+def exportModel(runner, kindOfModel, outputFileName):
+    """
+    Script word models of runner and save them into outputFileName
+
+    :return: torch.jit.ScriptModule
+    """
+    convert = {'MULTIDNN': convertMultidnn,
+               'SPLITMULTIDNN': convertSplitMultidnn,
+               'HYPERNET': convertHyperNet}[kindOfModel]
+    module = convert(runner).cpu()
+    module.train(False)
+    scriptedModule = torch.jit.script(module)
+    torch.jit.save(scriptedModule, outputFileName)
+    logger.info('%s model with %s words is saved into %s', kindOfModel,
+                len(module.indexByWord), outputFileName)
+    return scriptedModule
+
+
+def checkExport(runner, outputFileName, featureVectorSize, numWords, numBoxes=10):
+    """
+    Compare scores of saved artifact with scores of runner on random
+    features for random words
+
+    :return: float
+        maximal absolute difference of scores
+    """
+    from scripted_runner import ScriptedModelRunner
+
+    scriptedRunner = ScriptedModelRunner(outputFileName)
+    words = list(scriptedRunner.model.indexByWord.keys())
+    words = random.sample(words, min(numWords, len(words)))
+    features = np.random.rand(numBoxes, featureVectorSize).astype(np.float32)
+    with torch.no_grad():
+        expected = runner.runNeuralNetworkBatch(features, words)
+    actual = scriptedRunner.runNeuralNetworkBatch(features, words)
+    difference = 0.0
+    for word, scores in expected.items():
+        difference = max(difference, float(np.abs(np.asarray(scores)
+                                                  - np.asarray(actual[word])).max()))
+    return difference
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export word models into TorchScript '
+                                     'artifact which is run by --model-kind SCRIPTED')
+    parser.add_argument('--model-kind', '-k', dest='kindOfModel',
+        action='store', type=str, required=True,
+        choices=['MULTIDNN', 'HYPERNET', 'SPLITMULTIDNN'],
+        help='kind of exported model, HYPERNET requires --hypernet-model and '
+        '--hypernet-words parameters')
+    parser.add_argument('--multidnn-model', dest='multidnnModelFileName',
+        action='store', type=str,
+        help='Multi DNN model file name')
+    parser.add_argument('--hypernet-model', dest='hypernetModelFileName',
+        action='store', type=str,
+        help='Hypernet model file name')
+    parser.add_argument('--hypernet-words', '-w', dest='hypernetWordsFileName',
+        action='store', type=str,
+        help='words dictionary')
+    parser.add_argument('--output', '-o', dest='outputFileName',
+        action='store', type=str, required=True,
+        help='file to save TorchScript artifact to')
+    parser.add_argument('--check-words', dest='checkWords',
+        action='store', type=int, default=10,
+        help='number of random words which scores of artifact are compared '
+        'with scores of original model, 0 disables check')
+    parser.add_argument('--feature-vector-size', dest='featureVectorSize',
+        action='store', type=int, default=2048,
+        help='size of bounding box features used by check')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    start = time.perf_counter()
+    runner = buildRunner(args)
+    logger.info('%s model is loaded in %.3fs', args.kindOfModel, time.perf_counter() - start)
+    exportModel(runner, args.kindOfModel, args.outputFileName)
+    if args.checkWords > 0:
+        difference = checkExport(runner, args.outputFileName, args.featureVectorSize,
+                                 args.checkWords)
+        logger.info('maximal difference of scores with original model: %.7f', difference)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Bounded residency of per-word models
+
+Word models are loaded from checkpoint when they are used first time and
+least recently used ones are evicted when total size of loaded models
+exceeds memory budget. Pinned models (for instance colors or yes/no
+attributes) are loaded at start and never evicted.
+"""
+
+import logging
+import threading
+import collections
+import collections.abc
+
+
+logger = logging.getLogger(__name__)
+
+
+def getTensorBytes(value):
+    # quantized modules keep packed weights as tuples in state dict
+    if isinstance(value, (tuple, list)):
+        return sum(getTensorBytes(item) for item in value)
+    if hasattr(value, 'element_size'):
+        return value.numel() * value.element_size()
+    return 0
+
+
+def getModelBytes(model):
+    return sum(getTensorBytes(value) for value in model.state_dict().values())
+
+
+class ModelResidency(collections.abc.Mapping):
+    """
+    Word models by key which can be used in place of models list or dict
+    of nets vocabulary
+    """
+
+    def __init__(self, keys, loadModel, maxBytes=None, pinnedKeys=()):
+        """
+        :param keys: Iterable
+            keys of all models in checkpoint
+        :param loadModel: Callable[[key], torch.nn.Module]
+            loads model from checkpoint
+        :param maxBytes: int
+            memory budget for parameters of loaded models, None means
+            models are never evicted
+        :param pinnedKeys: Iterable
+            keys of models which are loaded immediately and never evicted
+        """
+        # not named keys, it would shadow Mapping.keys()
+        self.modelKeys = list(keys)
+        self.keySet = set(self.modelKeys)
+        self.loadModel = loadModel
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.modelByKey = collections.OrderedDict()
+        self.bytesByKey = {}
+        self.residentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pinnedKeys = set()
+        self.pin(pinnedKeys)
+
+    def pin(self, keys):
+        for key in keys:
+            if key not in self.keySet:
+                logger.warning('Cannot pin model %s, it is not in checkpoint', key)
+                continue
+            self.pinnedKeys.add(key)
+            self[key]
+
+    def __getitem__(self, key):
+        with self.lock:
+            model = self.modelByKey.get(key)
+            if model is not None:
+                self.hits += 1
+                self.modelByKey.move_to_end(key)
+                return model
+            if key not in self.keySet:
+                raise KeyError(key)
+            self.misses += 1
+            model = self.loadModel(key)
+            self.modelByKey[key] = model
+            self.bytesByKey[key] = getModelBytes(model)
+            self.residentBytes += self.bytesByKey[key]
+            self.evict()
+            return model
+
+    def evict(self):
+        if self.maxBytes is None or self.residentBytes <= self.maxBytes:
+            return
+        # the last model is just requested one, it is kept
+        for key in list(self.modelByKey)[:-1]:
+            if self.residentBytes <= self.maxBytes:
+                break
+            if key in self.pinnedKeys:
+                continue
+            del self.modelByKey[key]
+            self.residentBytes -= self.bytesByKey.pop(key)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.keySet
+
+    def __iter__(self):
+        return iter(self.modelKeys)
+
+    def __len__(self):
+        return len(self.modelKeys)
+
+    def getStatistics(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'resident_models': len(self.modelByKey),
+                    'pinned_models': len(self.pinnedKeys),
+                    'resident_bytes': self.residentBytes,
+                    'max_bytes': self.maxBytes}
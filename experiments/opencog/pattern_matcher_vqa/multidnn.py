@@ -1,26 +1,101 @@
 import sys
 import logging
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 
 from util import *
 from interface import NeuralNetworkRunner
+from model_residency import ModelResidency
+from reduced_precision import convertWordModel, convertStackedModels
 
 sys.path.insert(0, currentDir(__file__) + '/../DNNs/vqa_multi_dnn')
 from netsvocabulary import NetsVocab
 
+
+def loadCheckpointMapped(fileName):
+    """
+    Load checkpoint with tensors memory mapped, so only parameters which
+    are used are read from disk
+
+    :raise RuntimeError: if checkpoint cannot be memory mapped (torch < 2.1
+        or checkpoint in legacy format), fully loaded checkpoint would keep
+        all word models in memory regardless of memory budget
+    """
+    try:
+        return torch.load(fileName, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError) as e:
+        raise RuntimeError('Cannot memory map {} ({}), --word-models-memory requires '
+                           'torch >= 2.1 and checkpoint saved in zip format, resave it by '
+                           'torch.save(torch.load(file), file)'.format(fileName, e)) from e
+
+
 class NetsVocabularyNeuralNetworkRunner(NeuralNetworkRunner):
     
-    def __init__(self, modelsFileName):
+    def __init__(self, modelsFileName, stacked=False, maxResidentBytes=None, pinnedWords=(),
+                 precision='float32'):
+        """
+        :param maxResidentBytes: int
+            if set word models are loaded on first use and least recently
+            used ones are evicted, see model_residency.ModelResidency
+        :param pinnedWords: Iterable[str]
+            words which models are never evicted
+        :param precision: str
+            precision of word models, see reduced_precision.PRECISIONS
+        """
         self.logger = logging.getLogger('NetsVocabularyNeuralNetworkRunner')
-        self.netsVocabulary = self.loadNets(modelsFileName)
+        self.precision = precision
+        if maxResidentBytes is not None and not stacked:
+            self.netsVocabulary = self.loadNetsOnDemand(modelsFileName, maxResidentBytes,
+                                                        pinnedWords)
+        else:
+            self.netsVocabulary = self.loadNets(modelsFileName, stacked)
 
-    def loadNets(self, modelsFileName):
+    def loadNets(self, modelsFileName, stacked=False):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         checkpoint = torch.load(modelsFileName, map_location=device.type)
-        netsVocabulary = NetsVocab.fromStateDict(device, checkpoint['state_dict'])
+        netsVocabulary = NetsVocab.fromStateDict(device, checkpoint['state_dict'],
+                                                 stacked=stacked)
         netsVocabulary.train(False)
+        if stacked:
+            netsVocabulary.models = convertStackedModels(netsVocabulary.models, self.precision)
+        elif self.precision != 'float32':
+            netsVocabulary.models = nn.ModuleList([convertWordModel(model, self.precision)
+                                                   for model in netsVocabulary.models])
         return netsVocabulary
+
+    def loadNetsOnDemand(self, modelsFileName, maxResidentBytes, pinnedWords=()):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        stateDict = loadCheckpointMapped(modelsFileName)['state_dict']
+        netsVocabulary = NetsVocab(device)
+        netsVocabulary.vocabulary = stateDict['vocabulary']
+        netsVocabulary.featureVectorSize = stateDict['featureVectorSize']
+        netsVocabulary.modelIndexByWord = {word: index for index, word
+                                           in enumerate(netsVocabulary.vocabulary)}
+        parametersByIndex = {}
+        for name, tensor in stateDict['pytorch_state_dict'].items():
+            # models.<model index>.<layer index>.<weight|bias>
+            _, index, parameter = name.split('.', 2)
+            parametersByIndex.setdefault(int(index), {})[parameter] = tensor
+
+        def loadModel(index):
+            model = netsVocabulary.createModel()
+            model.load_state_dict(parametersByIndex[index])
+            model.train(False)
+            return convertWordModel(model, self.precision)
+
+        pinnedIndexes = [netsVocabulary.modelIndexByWord[word] for word in pinnedWords
+                         if word in netsVocabulary.modelIndexByWord]
+        # ModuleList is replaced by models which are not registered as submodules
+        del netsVocabulary.models
+        netsVocabulary.models = ModelResidency(sorted(parametersByIndex), loadModel,
+                                               maxResidentBytes, pinnedIndexes)
+        return netsVocabulary
+
+    def getStatistics(self):
+        if isinstance(self.netsVocabulary.models, ModelResidency):
+            return {'word_models': self.netsVocabulary.models.getStatistics()}
+        return {}
     
     def runNeuralNetwork(self, features, word):
         model = self.netsVocabulary.getModelByWord(word)
@@ -28,4 +103,16 @@ class NetsVocabularyNeuralNetworkRunner(NeuralNetworkRunner):
             self.logger.debug('no model found, return FALSE')
             return torch.zeros(1)
         # TODO: F.sigmoid should part of NN
-        return F.sigmoid(model(torch.Tensor(features)))
+        return F.sigmoid(model(torch.as_tensor(features, dtype=torch.float32)))
+
+    def runNeuralNetworkBatch(self, features, words):
+        featuresTensor = torch.as_tensor(features, dtype=torch.float32)
+        knownWords = [word for word in words if self.netsVocabulary.has_model(word)]
+        result = {word: [0.0] * len(featuresTensor) for word in words}
+        if not knownWords:
+            return result
+        with torch.no_grad():
+            scores = F.sigmoid(self.netsVocabulary.get_models_output(featuresTensor, knownWords))
+        for word, wordScores in zip(knownWords, scores.t().tolist()):
+            result[word] = wordScores
+        return result
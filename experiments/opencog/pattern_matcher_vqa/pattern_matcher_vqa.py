@@ -1,8 +1,12 @@
 import sys
+import time
 import logging
-import datetime
 import argparse
 import abc
+import queue
+import functools
+import collections
+import multiprocessing
 
 import jpype
 import numpy as np
@@ -14,10 +18,14 @@ from opencog.type_constructors import *
 from opencog.scheme_wrapper import *
 
 from util import *
-from interface import FeatureExtractor, AnswerHandler, NoModelException
-from multidnn import NetsVocabularyNeuralNetworkRunner
-from hypernet import HyperNetNeuralNetworkRunner
-from splitnet.splitmultidnnmodel import SplitMultidnnRunner
+from interface import FeatureExtractor, AnswerHandler, ChainAnswerHandler, NoModelException
+from prefetch import QuestionPrefetcher
+from query_cache import QueryCache, CachingQuestionConverter, fileVersion
+from query_template import QueryTemplateCache, conceptNodeRegex
+from instrumentation import metrics
+from tensor_registry import tensorRegistry, setTensorValue, getTensorValue
+from results_sink import JsonlResultsSink, readResults, restoreResults
+from reduced_precision import PRECISIONS
 
 
 sys.path.insert(0, currentDir(__file__) + '/../question2atomese')
@@ -38,17 +46,21 @@ def pushAtomspace(parentAtomspace):
     """Create child atomspace"""
     # TODO: cannot push/pop atomspace via Python API,
     # workarouding it using Scheme API
-    scheme_eval(parentAtomspace, '(cog-push-atomspace)')
-    childAtomspace = scheme_eval_as('(cog-atomspace)')
-    set_type_ctor_atomspace(childAtomspace)
+    with metrics.timer('atomspace_push'):
+        scheme_eval(parentAtomspace, '(cog-push-atomspace)')
+        childAtomspace = scheme_eval_as('(cog-atomspace)')
+        set_type_ctor_atomspace(childAtomspace)
+        tensorRegistry.pushScope()
     return childAtomspace
 
 
 def popAtomspace(childAtomspace):
     """Destroy child atomspace"""
-    scheme_eval(childAtomspace, '(cog-pop-atomspace)')
-    parentAtomspace = scheme_eval_as('(cog-atomspace)')
-    set_type_ctor_atomspace(parentAtomspace)
+    with metrics.timer('atomspace_pop'):
+        tensorRegistry.popScope()
+        scheme_eval(childAtomspace, '(cog-pop-atomspace)')
+        parentAtomspace = scheme_eval_as('(cog-atomspace)')
+        set_type_ctor_atomspace(parentAtomspace)
     return parentAtomspace
 
 
@@ -86,11 +98,13 @@ class StatisticsAnswerHandler(AnswerHandler):
         self.correctAnswers = 0
         self.dont_know = 0
         self._dont_know_queries = []
+        self.timeouts = 0
+        self._timeout_queries = []
 
     def onNewQuestion(self, record):
         self.processedQuestions += 1
 
-    def onAnswer(self, record, answer):
+    def onAnswer(self, record, answer, details=None):
         self.questionsAnswered += 1
         if answer == record.answer:
             self.correctAnswers += 1
@@ -99,6 +113,10 @@ class StatisticsAnswerHandler(AnswerHandler):
             self._dont_know_queries.append(record)
         self.logger.debug('Correct answers %s%%', self.correctAnswerPercent())
 
+    def onTimeout(self, record):
+        self.timeouts += 1
+        self._timeout_queries.append(record)
+
     def correctAnswerPercent(self):
         return self.correctAnswers / self.questionsAnswered * 100
 
@@ -108,9 +126,51 @@ class StatisticsAnswerHandler(AnswerHandler):
     def getUnanswered(self):
         return self._dont_know_queries
 
+    def getTimedOut(self):
+        return self._timeout_queries
+
 
 ### Pipeline code
 
+class QueryTimeout(RuntimeError):
+    pass
+
+
+class QueryWatchdog:
+    """
+    Deadline of the query which is being evaluated
+
+    Pattern matcher and URE cannot be interrupted from Python, but both
+    call runNeuralNetwork() for each grounding of bounding box, so the
+    callback checks deadline and raises QueryTimeout which aborts query
+    evaluation.
+    """
+
+    def __init__(self):
+        self.deadline = None
+        self.expired = False
+
+    def start(self, seconds):
+        """
+        :param seconds: float
+            query time budget, None means no limit
+        """
+        self.deadline = None if seconds is None else time.perf_counter() + seconds
+        self.expired = False
+
+    def stop(self):
+        self.deadline = None
+
+    def check(self):
+        if self.deadline is not None and (self.expired
+                                          or time.perf_counter() > self.deadline):
+            self.expired = True
+            raise QueryTimeout('Query evaluation is out of time budget')
+
+
+queryWatchdog = QueryWatchdog()
+
+
 def runNeuralNetwork(boundingBox, conceptNode):
     """
     Callback for running from within the atomspace from ground predicate
@@ -120,40 +180,51 @@ def runNeuralNetwork(boundingBox, conceptNode):
     :return: TruthValue
     """
     logger = logging.getLogger('runNeuralNetwork')
+    start = time.perf_counter()
     try:
         logger.debug('runNeuralNetwork: %s, %s', boundingBox.name, conceptNode.name)
-
-        featuresValue = boundingBox.get_value(PredicateNode('features'))
-        if featuresValue is None:
-            logger.error('no features found, return FALSE')
-            return TruthValue(0.0, 0.0)
-        features = np.array(featuresValue.to_list())
+        queryWatchdog.check()
         word = conceptNode.name
 
-        certainty = 1.0
-        neuralNetworkRunner = network_runner.runner
-        try:
-            resultTensor = neuralNetworkRunner.runNeuralNetwork(features, word)
-        except NoModelException as e:
-            import torch
-            resultTensor = torch.zeros(1)
-            certainty = 0.0
-        result = resultTensor.item()
+        # bounding box keeps [result, certainty] if it was prescored
+        # by PatternMatcherVqaPipeline.prescoreBoundingBoxes()
+        scoreValue = boundingBox.get_value(conceptNode)
+        if scoreValue is not None:
+            result, certainty = scoreValue.to_list()
+        else:
+            features = getTensorValue(boundingBox, PredicateNode('featuresHandle'))
+            if features is None:
+                logger.error('no features found, return FALSE')
+                return TruthValue(0.0, 0.0)
+
+            certainty = 1.0
+            neuralNetworkRunner = network_runner.runner
+            try:
+                resultTensor = neuralNetworkRunner.runNeuralNetwork(features, word)
+            except NoModelException as e:
+                import torch
+                resultTensor = torch.zeros(1)
+                certainty = 0.0
+            result = resultTensor.item()
 
         logger.debug('bb: %s, word: %s, result: %s', boundingBox.name, word, str(result))
         # Return matching values from PatternMatcher by adding
         # them to bounding box and concept node
         # TODO: how to return predicted values properly?
-        boundingBox.set_value(conceptNode, FloatValue(result))
-        conceptNode.set_value(boundingBox, FloatValue(result))
+        boundingBox.set_value(conceptNode, FloatValue([result, certainty]))
+        conceptNode.set_value(boundingBox, FloatValue([result, certainty]))
         groundedPredicate = GroundedPredicateNode("py:runNeuralNetwork")
         ev = EvaluationLink(groundedPredicate, ListLink(boundingBox, conceptNode))
         tv = TruthValue(result, certainty)
         ev.tv = tv
         return tv
+    except QueryTimeout:
+        raise
     except BaseException as e:
         logger.exception('Unexpected exception %s', e)
         return TruthValue(0.0, 1.0)
+    finally:
+        metrics.add('run_neural_network', time.perf_counter() - start)
 
 
 class OtherDetSubjObj:
@@ -248,6 +319,67 @@ class ConjunctionResult(OtherDetSubjObj):
         return self.atom
 
 
+# scores which differ less than tolerance are compared by secondary score,
+# see OtherDetSubjObjResult.__lt__() and ConjunctionResult.__lt__()
+SCORE_TOLERANCE = 0.000001
+
+
+def getResultScores(resultAtoms):
+    """
+    Read scores which results are ranked by without building result
+    objects
+
+    :param resultAtoms: List[Atom]
+        AndLink conjunctions or (bounding box, attribute, object) links
+    :return: Tuple[numpy.array, numpy.array]
+        primary and secondary scores as ConjunctionResult and
+        OtherDetSubjObjResult compare them
+    """
+    primary = np.empty(len(resultAtoms))
+    secondary = np.empty(len(resultAtoms))
+    for i, resultAtom in enumerate(resultAtoms):
+        if resultAtom.type == opencog.atomspace.types.AndLink:
+            tv = resultAtom.tv
+            primary[i] = tv.mean
+            secondary[i] = tv.confidence
+        else:
+            boundingBox, attribute, object = resultAtom.out[:3]
+            primary[i] = boundingBox.get_value(object).to_list()[0]
+            secondary[i] = boundingBox.get_value(attribute).to_list()[0]
+    return primary, secondary
+
+
+def selectTopResults(primary, secondary, k):
+    """
+    Select indexes of k best results by primary score comparing results
+    with nearly equal primary scores by secondary one
+
+    Only results which can be among k best are sorted: primary score of
+    candidate is not less than k-th largest primary score minus tolerance.
+
+    :return: List[int]
+        indexes of results in descending order
+    """
+    numResults = len(primary)
+    if numResults == 0 or k <= 0:
+        return []
+    if k < numResults:
+        kthScore = np.partition(primary, numResults - k)[numResults - k]
+        candidates = np.flatnonzero(primary >= kthScore - SCORE_TOLERANCE).tolist()
+    else:
+        candidates = list(range(numResults))
+
+    def compare(i, j):
+        if abs(primary[i] - primary[j]) > SCORE_TOLERANCE:
+            return -1 if primary[i] > primary[j] else 1
+        if secondary[i] != secondary[j]:
+            return -1 if secondary[i] > secondary[j] else 1
+        return 0
+
+    candidates.sort(key=functools.cmp_to_key(compare))
+    return candidates[:k]
+
+
 def extract_predicate(atoms):
     for atom in atoms:
         if atom.type == opencog.atomspace.types.InheritanceLink:
@@ -264,9 +396,84 @@ def extract_bb_id(atoms):
                 return int(predicate_name.split('-')[-1])
 
 
+def reportAnswer(answerHandler, record, answer, details=None):
+    answerHandler.onAnswer(record, answer, details)
+
+    print('{}::{}::{}::{}::{}'.format(record.questionId, record.question,
+        answer, record.answer, record.imageId))
+
+
+def reportTimeout(answerHandler, record):
+    logger.warning('Question %s is out of time budget: %s', record.questionId, record.question)
+    answerHandler.onTimeout(record)
+
+
+def reportResult(answerHandler, record, result):
+    """
+    Notify answer handler and print answer of question
+
+    :param result: Tuple[str, str, dict]
+        query, answer and its details, see
+        PatternMatcherVqaPipeline.answerQuestionByFeatures(),
+        QueryTimeout if question was out of time budget, None if answering
+        failed
+    """
+    answerHandler.onNewQuestion(record)
+    reportOutcome(answerHandler, record, result)
+
+
+def reportOutcome(answerHandler, record, result):
+    """
+    Notify answer handler about result of question which is already
+    reported as new one, see reportResult()
+    """
+    if isinstance(result, QueryTimeout):
+        reportTimeout(answerHandler, record)
+    elif result is None:
+        answerHandler.onFailure(record)
+    elif result[0] is None:
+        answerHandler.onNotParsed(record)
+    else:
+        reportAnswer(answerHandler, record, result[1], result[2])
+
+
+def addTimings(result, stages):
+    """
+    Add copy of durations of question stages into details of answer
+
+    :param stages: Dict[str, float]
+        stages returned by metrics.question() after question is finished
+    """
+    if isinstance(result, tuple) and result[2] is not None:
+        result[2]['timings'] = dict(stages)
+
+
+def reportResultsInOrder(answerHandler, records, indexedResults):
+    """
+    Report results which come in arbitrary order in the order of records
+
+    Result is reported as soon as results of all previous records are
+    reported. Records without result are reported as failed at the end.
+
+    :param records: List[Record]
+    :param indexedResults: Iterable[Tuple[int, Tuple[str, str, dict]]]
+        index of record and its result
+    """
+    resultByIndex = {}
+    nextIndex = 0
+    for index, result in indexedResults:
+        resultByIndex[index] = result
+        while nextIndex in resultByIndex:
+            reportResult(answerHandler, records[nextIndex], resultByIndex.pop(nextIndex))
+            nextIndex += 1
+    for index in range(nextIndex, len(records)):
+        reportResult(answerHandler, records[index], resultByIndex.pop(index, None))
+
+
 class PatternMatcherVqaPipeline:
 
-    def __init__(self, featureExtractor, questionConverter, atomspace, answerHandler):
+    def __init__(self, featureExtractor, questionConverter, atomspace, answerHandler,
+                 queryTemplates=None, questionTimeout=None):
         """
         Construct pattern matcher object
 
@@ -278,11 +485,18 @@ class PatternMatcherVqaPipeline:
             atomspace with background knowledge
         :param answerHandler: interface.AnswerHandler
             answer handler for statistics
+        :param queryTemplates: query_template.QueryTemplateCache
+            if passed queries are evaluated by calling compiled templates
+        :param questionTimeout: float
+            time budget of query evaluation in seconds, QueryTimeout is
+            raised when it is exceeded, None means no limit
         """
         self.featureExtractor = featureExtractor
         self.questionConverter = questionConverter
         self.atomspace = atomspace
         self.answerHandler = answerHandler
+        self.queryTemplates = queryTemplates
+        self.questionTimeout = questionTimeout
         self.logger = logging.getLogger('PatternMatcherVqaPipeline')
 
     # TODO: pass atomspace as parameter to exclude necessity of set_type_ctor_atomspace
@@ -290,28 +504,113 @@ class PatternMatcherVqaPipeline:
         """
         populate atomspace with bounding boxes, that is concept nodes
 
-        Each bounding box node holds FloatValue, which in turn holds array of float values -
-        activations of neural network on the corresponding image area.
+        Each bounding box node holds handle of features tensor in
+        tensor_registry.tensorRegistry, features are activations of neural
+        network on the corresponding image area. Tensors are released when
+        child atomspace is popped.
+
+        Parameters
+        ----------
+        features : Iterable
+            iterable with bounding box features, either lists or numpy arrays
+
+        Returns
+        -------
+        None
+        """
+        with metrics.timer('bbox_population'):
+            # rows of numpy array are registered as views without copying
+            features = np.asarray(features, dtype=np.float32)
+            featuresKey = PredicateNode('featuresHandle')
+            boundingBoxNumber = 0
+            for boundingBoxFeatures in features:
+                boundingBoxInstance = ConceptNode(
+                    'BoundingBox-' + str(boundingBoxNumber))
+                inh = InheritanceLink(boundingBoxInstance, ConceptNode('BoundingBox'))
+                tv = TruthValue(1.0, 1.0)
+                inh.tv = tv
+                setTensorValue(boundingBoxInstance, featuresKey, boundingBoxFeatures)
+                boundingBoxNumber += 1
+
+    def getQueryWords(self, queryInScheme):
+        """
+        Collect words which can be passed to runNeuralNetwork() while
+        query is executed
+
+        These are concept nodes mentioned in query and concept nodes
+        which inherit them, for instance "red" for "color" attribute.
+
+        :param queryInScheme: str
+            query to pattern matcher or ure
+        :return: List[str]
+        """
+        words = []
+        for name in conceptNodeRegex.findall(queryInScheme):
+            if name == 'BoundingBox' or name in words:
+                continue
+            words.append(name)
+            for inh in ConceptNode(name).incoming_by_type(opencog.atomspace.types.InheritanceLink):
+                if inh.out[1].name == name and inh.out[0].name not in words:
+                    words.append(inh.out[0].name)
+        return words
+
+    def prescoreBoundingBoxes(self, features, queryInScheme):
+        """
+        Compute scores of all bounding boxes for all words of the query
+        by single neural network runner call
+
+        Scores are kept in bounding box values, so runNeuralNetwork()
+        callback doesn't run network on each (bounding box, word) pair.
 
         Parameters
         ----------
         features : Iterable
-            iterable with bounding box features
+            iterable with bounding box features in the same order as
+            they were passed to addBoundingBoxesIntoAtomspace()
+        queryInScheme : str
+            query to pattern matcher or ure
 
         Returns
         -------
         None
         """
-        boundingBoxNumber = 0
-        for boundingBoxFeatures in features:
-            imageFeatures = FloatValue(boundingBoxFeatures)
-            boundingBoxInstance = ConceptNode(
-                'BoundingBox-' + str(boundingBoxNumber))
-            inh = InheritanceLink(boundingBoxInstance, ConceptNode('BoundingBox'))
-            tv = TruthValue(1.0, 1.0)
-            inh.tv = tv
-            boundingBoxInstance.set_value(PredicateNode('features'), imageFeatures)
-            boundingBoxNumber += 1
+        with metrics.timer('prescore'):
+            self.prescoreBoundingBoxesByWords(features, queryInScheme)
+
+    def prescoreBoundingBoxesByWords(self, features, queryInScheme):
+        features = np.asarray(features, dtype=np.float32)
+        boundingBoxes = [ConceptNode('BoundingBox-' + str(boundingBoxNumber))
+                         for boundingBoxNumber in range(len(features))]
+        if not boundingBoxes:
+            return
+        # skip words scored by previous questions about the same image
+        words = [word for word in self.getQueryWords(queryInScheme)
+                 if boundingBoxes[0].get_value(ConceptNode(word)) is None]
+        self.logger.debug('Prescoring words: %s', words)
+        scoresByWord = network_runner.runner.runNeuralNetworkBatch(features, words)
+        self.setBoundingBoxScores(boundingBoxes, words, scoresByWord)
+
+    def setBoundingBoxScores(self, boundingBoxes, words, scoresByWord):
+        """
+        Keep scores of bounding boxes in their values as [score, certainty]
+        for runNeuralNetwork() callback
+
+        :param boundingBoxes: List[Atom]
+        :param words: Iterable[str]
+        :param scoresByWord: Dict[str, List[float]]
+            scores of bounding boxes by word as
+            NeuralNetworkRunner.runNeuralNetworkBatch() returns
+        """
+        for word in words:
+            conceptNode = ConceptNode(word)
+            scores = scoresByWord.get(word)
+            for boundingBoxNumber, boundingBox in enumerate(boundingBoxes):
+                if scores is None:
+                    # no model for the word, see runNeuralNetwork()
+                    score = FloatValue([0.0, 0.0])
+                else:
+                    score = FloatValue([scores[boundingBoxNumber], 1.0])
+                boundingBox.set_value(conceptNode, score)
 
     def answerQuery(self, questionType, query):
         if questionType == 'yes/no':
@@ -334,19 +633,15 @@ class PatternMatcherVqaPipeline:
         """
         self.atomspace = pushAtomspace(self.atomspace)
         try:
-            features, boxes = self.featureExtractor.getFeaturesByImage(image)
+            with metrics.timer('feature_load'):
+                features, boxes = self.featureExtractor.getFeaturesByImage(image)
             self.addBoundingBoxesIntoAtomspace(features)
-            parsedQuestion = self.questionConverter.parseQuestionAndType(question)
-            relexFormula = parsedQuestion.relexFormula
-            if use_pm:
-                queryInScheme = self.questionConverter.convertToOpencogSchemePM(relexFormula)
-            else:
-                queryInScheme = self.questionConverter.convertToOpencogSchemeURE(relexFormula)
+            relexFormula, questionType, queryInScheme = self.parseQuestionToQuery(question, use_pm)
             if queryInScheme is None:
                 self.logger.error('Question was not parsed')
                 return
             self.logger.debug('Scheme query: %s', queryInScheme)
-            questionType = parsedQuestion.questionType
+            self.prescoreBoundingBoxes(features, queryInScheme)
             if questionType is None:
                 return
             answer, bb_id, expr = self.answerQuery(questionType, queryInScheme)
@@ -356,33 +651,298 @@ class PatternMatcherVqaPipeline:
         finally:
             self.atomspace = popAtomspace(self.atomspace)
 
+    def parseQuestionToQuery(self, question, use_pm=True):
+        """
+        :return: Tuple[RelexFormula, str, str]
+            relex formula, question type and query, query is None if
+            question was not parsed
+        """
+        with metrics.timer('parse'):
+            parsedQuestion = self.questionConverter.parseQuestionAndType(question)
+        relexFormula = parsedQuestion.relexFormula
+        queryInScheme = self.convertFormulaToQuery(relexFormula, use_pm)
+        return relexFormula, parsedQuestion.questionType, queryInScheme
+
+    def answerImageQuestionGroups(self, groups, use_pm=True):
+        """
+        Answer questions about several images scoring bounding boxes of
+        all images for words of all questions by single neural network
+        runner call
+
+        :param groups: List[Tuple[numpy.array, numpy.array, List[str]]]
+            features and boxes of image and questions about it
+        :param use_pm: bool
+        :return: List[List[Union[QueryProcessingData, BaseException]]]
+            result of each question in the same order, None if question
+            was not parsed, exception if answering failed
+        """
+        results = [[None] * len(questions) for _, _, questions in groups]
+        parsed = [[None] * len(questions) for _, _, questions in groups]
+        for i, (_, _, questions) in enumerate(groups):
+            for j, question in enumerate(questions):
+                try:
+                    parsed[i][j] = self.parseQuestionToQuery(question, use_pm)
+                except BaseException as e:
+                    results[i][j] = e
+        wordsByGroup = self.getGroupWords(parsed)
+
+        features = [np.asarray(groupFeatures, dtype=np.float32)
+                    for groupFeatures, _, _ in groups]
+        allWords = list(collections.OrderedDict.fromkeys(
+            word for words in wordsByGroup for word in words))
+        with metrics.timer('prescore'):
+            allScores = {}
+            if allWords and sum(len(groupFeatures) for groupFeatures in features):
+                allScores = network_runner.runner.runNeuralNetworkBatch(
+                    np.concatenate([f for f in features if len(f)]), allWords)
+
+        offset = 0
+        for i, (groupFeatures, boxes, questions) in enumerate(groups):
+            numBoxes = len(features[i])
+            scoresByWord = {word: scores[offset:offset + numBoxes]
+                            for word, scores in allScores.items()}
+            offset += numBoxes
+            self.atomspace = pushAtomspace(self.atomspace)
+            try:
+                self.addBoundingBoxesIntoAtomspace(features[i])
+                boundingBoxes = [ConceptNode('BoundingBox-' + str(boundingBoxNumber))
+                                 for boundingBoxNumber in range(numBoxes)]
+                self.setBoundingBoxScores(boundingBoxes, wordsByGroup[i], scoresByWord)
+                for j, questionParsed in enumerate(parsed[i]):
+                    if questionParsed is None or questionParsed[1] is None \
+                            or questionParsed[2] is None:
+                        continue
+                    relexFormula, questionType, queryInScheme = questionParsed
+                    try:
+                        answer, bb_id, expr = self.answerQuery(questionType, queryInScheme)
+                        results[i][j] = QueryProcessingData(relexFormula, queryInScheme,
+                            answer, boxes, answerBox=bb_id, answerExpression=expr)
+                    except BaseException as e:
+                        results[i][j] = e
+            finally:
+                self.atomspace = popAtomspace(self.atomspace)
+        return results
+
+    def getGroupWords(self, parsed):
+        """
+        Collect query words of each group of parsed questions, see
+        answerImageQuestionGroups()
+        """
+        wordsByGroup = []
+        # words are collected in child atomspace to not add concept
+        # nodes of queries into parent one
+        self.atomspace = pushAtomspace(self.atomspace)
+        try:
+            for groupParsed in parsed:
+                words = collections.OrderedDict()
+                for questionParsed in groupParsed:
+                    if questionParsed is not None and questionParsed[2] is not None:
+                        words.update((word, None) for word
+                                     in self.getQueryWords(questionParsed[2]))
+                wordsByGroup.append(list(words))
+        finally:
+            self.atomspace = popAtomspace(self.atomspace)
+        return wordsByGroup
+
     def answerQuestion(self, record, use_pm=True):
         self.logger.debug('processing question: %s', record.question)
         self.answerHandler.onNewQuestion(record)
+        with metrics.question(record) as stages:
+            try:
+                result = self.answerQuestionInChildAtomspace(record, use_pm)
+            except QueryTimeout as e:
+                result = e
+            except Exception as e:
+                self.answerHandler.onFailure(record, e)
+                raise
+        # reported after question is finished to have all stages timed
+        addTimings(result, stages)
+        reportOutcome(self.answerHandler, record, result)
+
+    def answerQuestionInChildAtomspace(self, record, use_pm=True):
+        """
+        :return: Tuple[str, str, dict]
+            see answerQuestionByFeatures()
+        """
         # Push/pop atomspace each time to not pollute it by temporary
         # bounding boxes
         self.atomspace = pushAtomspace(self.atomspace)
         try:
-            features = self.featureExtractor.getFeaturesByImageId(record.imageId)
+            features = self.loadFeatures(record.imageId)
             self.addBoundingBoxesIntoAtomspace(features)
 
-            relexFormula = self.questionConverter.parseQuestion(record.question)
+            return self.answerQuestionByFeatures(record, features, use_pm)
+        finally:
+            self.atomspace = popAtomspace(self.atomspace)
+
+    def answerQuestionByFeatures(self, record, features, use_pm=True):
+        """
+        Answer question using bounding boxes which are already added
+        into atomspace
+
+        :param record: Record
+        :param features: Iterable
+            features of bounding boxes added into atomspace
+        :param use_pm: bool
+        :return: Tuple[str, str, dict]
+            query, answer and details of answer as answerQueryByFeatures()
+            returns, (None, None, None) if question was not parsed
+        """
+        queryInScheme = self.convertQuestionToQuery(record.question, use_pm)
+        if queryInScheme is None:
+            self.logger.error('Question was not parsed')
+            return None, None, None
+        return (queryInScheme,) + self.answerQueryByFeatures(record, features, queryInScheme)
+
+    def loadFeatures(self, imageId):
+        with metrics.timer('feature_load'):
+            return self.featureExtractor.getFeaturesByImageId(imageId)
+
+    def convertQuestionToQuery(self, question, use_pm=True):
+        with metrics.timer('parse'):
+            relexFormula = self.questionConverter.parseQuestion(question)
+        return self.convertFormulaToQuery(relexFormula, use_pm)
+
+    def convertFormulaToQuery(self, relexFormula, use_pm=True):
+        with metrics.timer('convert'):
             if use_pm:
-                queryInScheme = self.questionConverter.convertToOpencogSchemePM(relexFormula)
+                return self.questionConverter.convertToOpencogSchemePM(relexFormula)
             else:
-                queryInScheme = self.questionConverter.convertToOpencogSchemeURE(relexFormula)
+                return self.questionConverter.convertToOpencogSchemeURE(relexFormula)
+
+    def answerQueryByFeatures(self, record, features, queryInScheme):
+        """
+        :return: Tuple[str, dict]
+            answer and its details: answer bounding box and query, see
+            AnswerHandler.onAnswer(); timings are added by addTimings()
+        """
+        self.logger.debug('Scheme query: %s', queryInScheme)
+        self.prescoreBoundingBoxes(features, queryInScheme)
+        answer, bb_id, _ = self.answerQuery(record.questionType, queryInScheme)
+        return answer, {'boundingBox': bb_id,
+                        'query': str(queryInScheme)}
+
+    def answerPreparedQuestion(self, prepared):
+        """
+        Answer question which features and query are prepared by
+        prefetch.QuestionPrefetcher
+
+        :param prepared: prefetch.PreparedQuestion
+        """
+        record = prepared.record
+        self.logger.debug('processing question: %s', record.question)
+        self.answerHandler.onNewQuestion(record)
+        with metrics.question(record) as stages:
+            try:
+                result = self.answerPreparedQuestionInChildAtomspace(prepared)
+            except QueryTimeout as e:
+                result = e
+            except Exception as e:
+                self.answerHandler.onFailure(record, e)
+                raise
+        addTimings(result, stages)
+        reportOutcome(self.answerHandler, record, result)
+
+    def answerPreparedQuestionInChildAtomspace(self, prepared):
+        """
+        :return: Tuple[str, str, dict]
+            see answerQuestionByFeatures()
+        """
+        record = prepared.record
+        features = prepared.features.result()
+        queryInScheme = prepared.query.result()
+        self.atomspace = pushAtomspace(self.atomspace)
+        try:
+            self.addBoundingBoxesIntoAtomspace(features)
             if queryInScheme is None:
                 self.logger.error('Question was not parsed')
-                return
-            self.logger.debug('Scheme query: %s', queryInScheme)
-            answer, _, _ = self.answerQuery(record.questionType, queryInScheme)
-            self.answerHandler.onAnswer(record, answer)
+                return None, None, None
+            return (queryInScheme,) + self.answerQueryByFeatures(record, features, queryInScheme)
+        finally:
+            self.atomspace = popAtomspace(self.atomspace)
 
-            print('{}::{}::{}::{}::{}'.format(record.questionId, record.question,
-                answer, record.answer, record.imageId))
+    def answerQuestionsWithPrefetch(self, records, use_pm=True, depth=8, featureThreads=2):
+        """
+        Answer questions in order while features and queries of next
+        questions are prepared in background, see prefetch.QuestionPrefetcher
 
+        :return: dict
+            per-stage timings and queue statistics
+        """
+        prefetcher = QuestionPrefetcher(self.featureExtractor,
+                                        lambda question: self.convertQuestionToQuery(question, use_pm),
+                                        records, depth, featureThreads)
+        for prepared in prefetcher:
+            try:
+                prefetcher.statistics.timed('answer', self.answerPreparedQuestion, prepared)
+            except BaseException as e:
+                logger.exception('Unexpected exception %s', e)
+        statistics = prefetcher.getStatistics()
+        self.logger.info('Prefetch statistics: %s', statistics)
+        return statistics
+
+    def answerImageQuestions(self, imageId, records, use_pm=True):
+        """
+        Answer all questions about the same image
+
+        Bounding boxes are added into child atomspace once and all
+        questions are answered against it, so features are loaded and
+        networks are run on bounding boxes once per image. Answer
+        handler is not notified, see answerQuestionsFromFile().
+
+        :param imageId: str
+        :param records: List[Record]
+        :param use_pm: bool
+        :return: List[Tuple[str, str, dict]]
+            query, answer and details for each record like answerQuestionByFeatures()
+            returns, QueryTimeout if question was out of time budget, None
+            if answering failed with exception
+        """
+        results = [None] * len(records)
+        self.atomspace = pushAtomspace(self.atomspace)
+        try:
+            features = self.loadFeatures(imageId)
+            self.addBoundingBoxesIntoAtomspace(features)
+            for i, record in enumerate(records):
+                self.logger.debug('processing question: %s', record.question)
+                try:
+                    with metrics.question(record) as stages:
+                        results[i] = self.answerQuestionByFeatures(record, features, use_pm)
+                    addTimings(results[i], stages)
+                except QueryTimeout as e:
+                    results[i] = e
+                except BaseException as e:
+                    logger.exception('Unexpected exception %s', e)
+        except BaseException as e:
+            logger.exception('Unexpected exception %s', e)
         finally:
             self.atomspace = popAtomspace(self.atomspace)
+        return results
+
+    def evaluateQuery(self, queryInScheme):
+        """
+        Evaluate query within self.questionTimeout
+
+        :raise QueryTimeout: if query is out of time budget
+        """
+        with metrics.timer('query_evaluation'):
+            queryWatchdog.start(self.questionTimeout)
+            try:
+                if self.queryTemplates is not None:
+                    result = self.queryTemplates.evaluate(self.atomspace, queryInScheme)
+                else:
+                    result = scheme_eval_h(self.atomspace, queryInScheme)
+            except RuntimeError:
+                # QueryTimeout raised by callback comes back as Scheme error
+                if not queryWatchdog.expired:
+                    raise
+            finally:
+                queryWatchdog.stop()
+            if queryWatchdog.expired:
+                # engine either failed or ignored error of callback
+                raise QueryTimeout('Query evaluation is out of time budget of {} seconds'
+                                   .format(self.questionTimeout))
+            return result
 
     def answerYesNoQuestion(self, queryInScheme):
         """
@@ -393,13 +953,13 @@ class PatternMatcherVqaPipeline:
         :return: Tuple[str, int, str]
             if answer was found Tuple[None, None, None] otherwise
         """
-        start = datetime.datetime.now()
+        start = time.perf_counter()
 
-        result = scheme_eval_h(self.atomspace, queryInScheme)
-        delta = datetime.datetime.now() - start
+        result = self.evaluateQuery(queryInScheme)
+        delta = time.perf_counter() - start
         self.logger.debug('The result of pattern matching is: '
-                          '%s, time: %s microseconds',
-                          result, delta.microseconds)
+                          '%s, time: %.3f milliseconds',
+                          result, delta * 1000)
         results = self.sort_results(result, a_extract_predicate=False)
         if not results:
             return 'no', None, None
@@ -418,12 +978,12 @@ class PatternMatcherVqaPipeline:
         :return: Tuple[str, int, str]
             if answer was found Tuple[None, None, None] otherwise
         """
-        start = datetime.datetime.now()
-        resultsData = scheme_eval_h(self.atomspace, queryInScheme)
-        delta = datetime.datetime.now() - start
+        start = time.perf_counter()
+        resultsData = self.evaluateQuery(queryInScheme)
+        delta = time.perf_counter() - start
         self.logger.debug('The resultsData of pattern matching contains: '
-                          '%s records, time: %s microseconds',
-                          len(resultsData.out), delta.microseconds)
+                          '%s records, time: %.3f milliseconds',
+                          len(resultsData.out), delta * 1000)
 
         results = self.sort_results(resultsData, a_extract_predicate=True)
         if not results:
@@ -433,18 +993,32 @@ class PatternMatcherVqaPipeline:
                maxResult.get_bounding_box_id(), \
                maxResult.get_expression()
 
-    def sort_results(self, resultsData, a_extract_predicate=False):
-        results = []
-        for resultData in resultsData.out:
-            out = resultData.out
-            if resultData.type == opencog.atomspace.types.AndLink:
-                # resultData is AndLink with random order of conjucts
-                results.append(ConjunctionResult(resultData))
-            else:
-                results.append(OtherDetSubjObjResult(out[0], out[1], out[2]))
-        results.sort(reverse=True)
-        for result in results:
-            self.logger.debug(str(result))
+    def sort_results(self, resultsData, a_extract_predicate=False, k=1):
+        """
+        Select k best results of query, result objects are built only
+        for selected results
+
+        :param resultsData: Atom
+            result of query evaluation
+        :param k: int
+        :return: List[OtherDetSubjObj]
+            best results in descending order
+        """
+        with metrics.timer('result_sorting'):
+            resultAtoms = resultsData.out
+            primary, secondary = getResultScores(resultAtoms)
+            results = []
+            for index in selectTopResults(primary, secondary, k):
+                resultData = resultAtoms[index]
+                out = resultData.out
+                if resultData.type == opencog.atomspace.types.AndLink:
+                    # resultData is AndLink with random order of conjucts
+                    results.append(ConjunctionResult(resultData))
+                else:
+                    results.append(OtherDetSubjObjResult(out[0], out[1], out[2]))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for result in results:
+                self.logger.debug(str(result))
         return results
 
     def answerSingleQuestion(self, question, imageId):
@@ -460,38 +1034,135 @@ class PatternMatcherVqaPipeline:
             return False
         return True
 
-    def answerQuestionsFromFile(self, questionsFileName, use_pm=True):
+    def answerQuestionsFromFile(self, questionsFileName, use_pm=True, group_by_image=False,
+                                prefetch_depth=0, prefetch_feature_threads=2,
+                                skip_question_ids=frozenset()):
+        """
+        :param skip_question_ids: Set[str]
+            ids of questions which are answered already, see --resume
+        """
+        if group_by_image:
+            self.answerQuestionsFromFileGroupedByImage(questionsFileName, use_pm,
+                                                       skip_question_ids)
+            return
+        if prefetch_depth > 0:
+            self.answerQuestionsWithPrefetch(self.readRecords(questionsFileName,
+                                                              skip_question_ids),
+                                             use_pm, prefetch_depth, prefetch_feature_threads)
+            return
         questionFile = open(questionsFileName, 'r')
         for line in questionFile:
             if not self.is_record(line):
                 continue
             try:
                 record = Record.fromString(line)
+                if record.questionId in skip_question_ids:
+                    continue
                 self.answerQuestion(record, use_pm=use_pm)
             except BaseException as e:
                 logger.exception('Unexpected exception %s', e)
                 continue
 
+    def answerQuestionsFromFileGroupedByImage(self, questionsFileName, use_pm=True,
+                                              skip_question_ids=frozenset()):
+        """
+        Answer questions grouping them by image, see answerImageQuestions()
+
+        Answer handler is notified and answers are printed in the order
+        of questions in file, as soon as all previous questions are answered.
+        """
+        records = self.readRecords(questionsFileName, skip_question_ids)
+        reportResultsInOrder(self.answerHandler, records,
+                             self.answerRecords(records, use_pm, group_by_image=True))
+
+    @classmethod
+    def readRecords(cls, questionsFileName, skipQuestionIds=frozenset()):
+        records = []
+        with open(questionsFileName, 'r') as questionFile:
+            for line in questionFile:
+                if not cls.is_record(line):
+                    continue
+                try:
+                    record = Record.fromString(line)
+                    if record.questionId not in skipQuestionIds:
+                        records.append(record)
+                except BaseException as e:
+                    logger.exception('Unexpected exception %s', e)
+        return records
+
+    @classmethod
+    def groupRecordIndexesByImage(cls, records):
+        recordIndexesByImageId = collections.OrderedDict()
+        for index, record in enumerate(records):
+            recordIndexesByImageId.setdefault(record.imageId, []).append(index)
+        return list(recordIndexesByImageId.values())
+
+    def answerRecords(self, records, use_pm=True, group_by_image=False):
+        """
+        Answer questions without notifying answer handler
+
+        :param records: List[Record]
+        :param use_pm: bool
+        :param group_by_image: bool
+            answer questions about the same image together,
+            see answerImageQuestions()
+        :return: Iterator[Tuple[int, Tuple[str, str, dict]]]
+            index of record and its result as answerImageQuestions() returns
+        """
+        if group_by_image:
+            groups = self.groupRecordIndexesByImage(records)
+        else:
+            groups = [[index] for index in range(len(records))]
+        for indexes in groups:
+            results = self.answerImageQuestions(records[indexes[0]].imageId,
+                                                [records[i] for i in indexes],
+                                                use_pm)
+            yield from zip(indexes, results)
+
 
 ### MAIN
 question2atomeseLibraryPath = (currentDir(__file__) +
     '/../question2atomese/target/question2atomese-1.0-SNAPSHOT.jar')
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(description='Load pretrained words models '
-       'and answer questions using OpenCog PatternMatcher')
+def buildArgumentParser(description='Load pretrained words models '
+                        'and answer questions using OpenCog PatternMatcher',
+                        questionsRequired=True):
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--model-kind', '-k', dest='kindOfModel',
         action='store', type=str, required=True,
-        choices=['MULTIDNN', 'HYPERNET', 'SPLITMULTIDNN'],
+        choices=['MULTIDNN', 'HYPERNET', 'SPLITMULTIDNN', 'SCRIPTED'],
         help='model kind: (1) MULTIDNN and SPLITMULTIDNN requires --model parameter only; '
-        '(2) HYPERNET requires --model, --words and --embedding parameters')
+        '(2) HYPERNET requires --model, --words and --embedding parameters; '
+        '(3) SCRIPTED requires --scripted-model parameter only')
     parser.add_argument('--questions', '-q', dest='questionsFileName',
-        action='store', type=str, required=True,
+        action='store', type=str, required=questionsRequired,
         help='parsed questions file name')
     parser.add_argument('--multidnn-model', dest='multidnnModelFileName',
         action='store', type=str,
         help='Multi DNN model file name')
+    parser.add_argument('--stacked-word-models', dest='stackedWordModels',
+        action='store_true',
+        help='keep MULTIDNN and SPLITMULTIDNN word models as stacked weight '
+        'tensors and run them by batched matrix multiplication')
+    parser.add_argument('--word-models-precision', dest='wordModelsPrecision',
+        action='store', type=str, default='float32', choices=PRECISIONS,
+        help='precision of MULTIDNN and SPLITMULTIDNN word models on CPU: int8 uses '
+        'dynamic quantization, float16 and bfloat16 keep weights and compute layers '
+        'in half precision; '
+        'int8 is not supported with --stacked-word-models')
+    parser.add_argument('--word-models-memory', dest='wordModelsMemoryMb',
+        action='store', type=int,
+        help='memory budget in megabytes for MULTIDNN and SPLITMULTIDNN word models; '
+        'models are loaded on first use and least recently used ones are evicted, '
+        'not used with --stacked-word-models')
+    parser.add_argument('--pinned-words', dest='pinnedWords',
+        action='store', type=str, default='',
+        help='comma separated words which models are loaded at start and never '
+        'evicted when --word-models-memory is set')
+    parser.add_argument('--scripted-model', dest='scriptedModelFileName',
+        action='store', type=str,
+        help='TorchScript artifact saved by model_export.py')
     parser.add_argument('--hypernet-model', dest='hypernetModelFileName',
         action='store', type=str,
         help='Hypernet model file name')
@@ -501,26 +1172,50 @@ def parse_args():
     parser.add_argument('--hypernet-embeddings', '-e',dest='hypernetWordEmbeddingsFileName',
         action='store', type=str,
         help='word embeddings')
+    parser.add_argument('--hypernet-inference-mode', dest='hypernetInferenceMode',
+        action='store_true',
+        help='load HYPERNET model without DataParallel and weight_norm and run '
+        'it under torch.inference_mode(), intended for CPU-only hosts')
+    parser.add_argument('--torch-threads', dest='torchThreads',
+        action='store', type=int,
+        help='number of threads used by torch for neural network inference, '
+        'set it to share machine between several processes')
     parser.add_argument('--features-extractor-kind', dest='kindOfFeaturesExtractor',
         action='store', type=str, required=True,
-        choices=['PRECALCULATED', 'IMAGE'],
+        choices=['PRECALCULATED', 'STORE', 'IMAGE'],
         help='features extractor type: (1) PRECALCULATED loads precalculated features; '
-        '(2) IMAGE extract features from images on the fly')
+        '(2) STORE loads precalculated features from binary features store; '
+        '(3) IMAGE extract features from images on the fly')
     parser.add_argument('--precalculated-features', '-f', dest='precalculatedFeaturesPath',
         action='store', type=str,
         help='precalculated features path (it can be either zip archive or folder name)')
     parser.add_argument('--precalculated-features-prefix', dest='precalculatedFeaturesPrefix',
         action='store', type=str, default='val2014_parsed_features/COCO_val2014_',
         help='precalculated features prefix to be merged with path to open feature')
+    parser.add_argument('--feature-store', dest='featureStorePath',
+        action='store', type=str,
+        help='binary features store folder, see feature/store.py')
     parser.add_argument('--images', '-i', dest='imagesPath',
         action='store', type=str,
         help='path to images, required only when featur')
     parser.add_argument('--images-prefix', dest='imagesPrefix',
         action='store', type=str, default='val2014/COCO_val2014_',
         help='image file prefix to be merged with path to open image')
+    parser.add_argument('--feature-cache', dest='featureCachePath',
+        action='store', type=str,
+        help='folder of persistent cache of features extracted from images, '
+        'used by IMAGE features extractor')
+    parser.add_argument('--feature-cache-size', dest='featureCacheSizeMb',
+        action='store', type=int, default=1024,
+        help='maximal size of features cache in megabytes, least recently '
+        'used images are removed when it is exceeded')
     parser.add_argument('--atomspace', '-a', dest='atomspaceFileName',
         action='store', type=str,
         help='Scheme program to fill atomspace with facts')
+    parser.add_argument('--atomspace-snapshot', dest='atomspaceSnapshot',
+        action='store_true',
+        help='load atomspace facts via binary snapshot which is compiled '
+        'next to facts file and recompiled when file changes')
     parser.add_argument('--opencog-log-level', dest='opencogLogLevel',
         action='store', type = str, default='NONE',
         choices=['FINE', 'DEBUG', 'INFO', 'ERROR', 'NONE'],
@@ -533,81 +1228,398 @@ def parse_args():
         dest='q2aJarFilenName', action='store', type = str,
         default=question2atomeseLibraryPath,
         help='path to question2atomese-<version>.jar')
+    parser.add_argument('--query-cache', dest='queryCacheFileName',
+        action='store', type=str,
+        help='SQLite file to cache parsed questions and queries in; '
+        'JVM is started only when question is not found in cache')
+    parser.add_argument('--compile-query-templates', dest='compileQueryTemplates',
+        action='store_true',
+        help='define Scheme procedure for each query template once and '
+        'evaluate queries by calling it with question words')
+    parser.add_argument('--group-by-image', dest='groupByImage', action='store_true',
+                        help='answer questions about the same image together, '
+                        'adding image bounding boxes into atomspace once')
+    parser.add_argument('--prefetch-depth', dest='prefetchDepth', action='store', type=int,
+                        default=0,
+                        help='number of next questions which features are loaded and '
+                        'queries are built in background, 0 disables prefetching; '
+                        'not used with --group-by-image and --workers')
+    parser.add_argument('--prefetch-feature-threads', dest='prefetchFeatureThreads',
+                        action='store', type=int, default=2,
+                        help='number of threads loading features when prefetching')
+    parser.add_argument('--workers', dest='workers', action='store', type=int, default=1,
+                        help='number of worker processes, each worker starts its own '
+                        'JVM, atomspace and neural network runner')
+    parser.add_argument('--shard-size', dest='shardSize', action='store', type=int, default=100,
+                        help='number of questions which are passed to worker at once')
+    parser.add_argument('--metrics-file', dest='metricsFileName', action='store', type=str,
+                        help='JSON file to write latency counters and histograms '
+                        'of pipeline stages to, metrics are not written by default')
+    parser.add_argument('--metrics-sample-rate', dest='metricsSampleRate', action='store',
+                        type=float, default=0.0,
+                        help='fraction of questions which per-stage timings are '
+                        'written into metrics file separately')
+    parser.add_argument('--question-timeout', dest='questionTimeout', action='store',
+                        type=float,
+                        help='time budget of query evaluation in seconds, questions '
+                        'which are out of budget are counted as timeouts')
+    parser.add_argument('--ure-max-iterations', dest='ureMaxIterations', action='store',
+                        type=int,
+                        help='maximal number of URE backward chainer iterations, '
+                        'overrides value of conjunction rule base config')
+    parser.add_argument('--ure-complexity-penalty', dest='ureComplexityPenalty',
+                        action='store', type=float,
+                        help='URE complexity penalty, bigger value makes backward '
+                        'chainer prefer simpler inference trees')
+    parser.add_argument('--results-file', dest='resultsFileName', action='store', type=str,
+                        help='JSON lines file to append result of each question to '
+                        'as soon as it is answered')
+    parser.add_argument('--results-include-query', dest='resultsIncludeQuery',
+                        action='store_true',
+                        help='write query of question into results file')
+    parser.add_argument('--results-fsync-interval', dest='resultsFsyncInterval',
+                        action='store', type=float, default=10.0,
+                        help='seconds between flushing results file to disk')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='skip questions which are already in results file and '
+                        'restore statistics from it')
     parser.add_argument('--use-pm', dest='use_pm', action='store_true',
                         help='use pattern matcher')
     parser.add_argument('--no-use-pm', dest='use_pm', action='store_false',
                         help='use URE instead of pattern matcher')
     parser.set_defaults(use_pm=True)
+    return parser
+
+
+def parse_args():
+    parser = buildArgumentParser()
     args = parser.parse_args()
+    if args.resume and args.resultsFileName is None:
+        parser.error('--resume requires --results-file')
+    if args.kindOfModel == 'SCRIPTED' and args.scriptedModelFileName is None:
+        parser.error('--model-kind SCRIPTED requires --scripted-model')
     return args
 
 
+def buildFeatureExtractor(args):
+    if args.kindOfFeaturesExtractor == 'IMAGE':
+        from feature.image import ImageFeatureExtractor
+        return ImageFeatureExtractor(
+            # TODO: replace by arguments
+            '/mnt/fileserver/shared/vital/image-features/test.prototxt',
+            '/mnt/fileserver/shared/vital/image-features/resnet101_faster_rcnn_final_iter_320000_for_36_bboxes.caffemodel',
+            args.imagesPath,
+            args.imagesPrefix,
+            featureCachePath=args.featureCachePath,
+            featureCacheBytes=args.featureCacheSizeMb << 20
+            )
+    elif args.kindOfFeaturesExtractor == 'PRECALCULATED':
+        return TsvFileFeatureLoader(args.precalculatedFeaturesPath,
+                                    args.precalculatedFeaturesPrefix)
+    elif args.kindOfFeaturesExtractor == 'STORE':
+        from feature.store import FeatureStoreLoader
+        return FeatureStoreLoader(args.featureStorePath)
+    else:
+        raise ValueError('Unexpected args.kindOfFeaturesExtractor value: {}'
+                         .format(args.kindOfFeaturesExtractor))
+
+
+def buildAtomspace(args):
+    if args.use_pm:
+        return initialize_atomspace_by_facts(args.atomspaceFileName,
+                                             use_snapshot=args.atomspaceSnapshot)
+    else:
+        scheme_directories = ["~/projects/opencog/examples/pln/conjunction/",
+                              "~/projects/atomspace/examples/rule-engine/rules/",
+                              "~/projects/opencog/opencog/pln/rules/"]
+
+        atomspace = initialize_atomspace_by_facts(args.atomspaceFileName,
+                                             "conjunction-rule-base-config.scm",
+                                             [os.path.expanduser(x) for x in scheme_directories],
+                                             use_snapshot=args.atomspaceSnapshot)
+        # rbs is rule base defined by conjunction-rule-base-config.scm
+        if args.ureMaxIterations is not None:
+            scheme_eval(atomspace, '(ure-set-maximum-iterations rbs {})'
+                        .format(args.ureMaxIterations))
+        if args.ureComplexityPenalty is not None:
+            scheme_eval(atomspace, '(ure-set-complexity-penalty rbs {})'
+                        .format(args.ureComplexityPenalty))
+        return atomspace
+
+
+def buildNeuralNetworkRunner(args):
+    if args.torchThreads is not None:
+        import torch
+        torch.set_num_threads(args.torchThreads)
+    maxResidentBytes = None
+    if args.wordModelsMemoryMb is not None:
+        if args.stackedWordModels:
+            logger.warning('--word-models-memory is ignored with --stacked-word-models')
+        maxResidentBytes = args.wordModelsMemoryMb << 20
+    pinnedWords = [word.strip() for word in args.pinnedWords.split(',') if word.strip()]
+    # runners are imported lazily, so SCRIPTED model does not import training code
+    if (args.kindOfModel == 'SCRIPTED'):
+        from scripted_runner import ScriptedModelRunner
+        return ScriptedModelRunner(args.scriptedModelFileName)
+    elif (args.kindOfModel == 'MULTIDNN'):
+        from multidnn import NetsVocabularyNeuralNetworkRunner
+        return NetsVocabularyNeuralNetworkRunner(args.multidnnModelFileName,
+                                                 args.stackedWordModels,
+                                                 maxResidentBytes, pinnedWords,
+                                                 args.wordModelsPrecision)
+    elif (args.kindOfModel == 'SPLITMULTIDNN'):
+        from splitnet.splitmultidnnmodel import SplitMultidnnRunner
+        return SplitMultidnnRunner(args.multidnnModelFileName,
+                                   args.stackedWordModels,
+                                   maxResidentBytes, pinnedWords,
+                                   args.wordModelsPrecision)
+    elif (args.kindOfModel == 'HYPERNET'):
+        from hypernet import HyperNetNeuralNetworkRunner
+        return HyperNetNeuralNetworkRunner(args.hypernetWordsFileName,
+                        args.hypernetWordEmbeddingsFileName, args.hypernetModelFileName,
+                        args.hypernetInferenceMode)
+    else:
+        raise ValueError('Unexpected args.kindOfModel value: {}'.format(args.kindOfModel))
+
+
+def buildQuestionConverter(args):
+    """
+    Build question converter, JVM is started on first use of converter
+    if --query-cache is set and immediately otherwise
+    """
+    def createConverter():
+        startJVM(args)
+        return jpype.JClass('org.opencog.vqa.relex.QuestionToOpencogConverter')()
+
+    if args.queryCacheFileName is None:
+        return createConverter()
+    cache = QueryCache(args.queryCacheFileName, fileVersion(args.q2aJarFilenName))
+    return CachingQuestionConverter(cache, createConverter)
+
+
+def buildPipeline(args, answerHandler):
+    """
+    Build pipeline and set network_runner.runner
+    """
+    featureExtractor = buildFeatureExtractor(args)
+    questionConverter = buildQuestionConverter(args)
+    atomspace = buildAtomspace(args)
+    network_runner.runner = buildNeuralNetworkRunner(args)
+    queryTemplates = QueryTemplateCache() if args.compileQueryTemplates else None
+    return PatternMatcherVqaPipeline(featureExtractor,
+                                     questionConverter,
+                                     atomspace,
+                                     answerHandler,
+                                     queryTemplates,
+                                     args.questionTimeout)
+
+
+def startJVM(args):
+    if not jpype.isJVMStarted():
+        jpype.startJVM(jpype.getDefaultJVMPath(),
+                       '-Djava.class.path=' + str(args.q2aJarFilenName))
+
+
+def shutdownJVM():
+    if jpype.isJVMStarted():
+        jpype.shutdownJVM()
+
+
+def shardWorker(args, shardQueue, resultQueue):
+    """
+    Worker process of sharded evaluation
+
+    JVM, atomspace and neural network runner are initialized once, then
+    worker answers shards from shardQueue until it gets None and puts
+    (record index, result) into resultQueue; ('metrics', state) and then
+    None are put when worker exits.
+    """
+    initializeRootAndOpencogLogger(args.opencogLogLevel, args.pythonLogLevel)
+    metrics.sampleRate = args.metricsSampleRate
+    try:
+        pipeline = buildPipeline(args, AnswerHandler())
+        while True:
+            shard = shardQueue.get()
+            if shard is None:
+                break
+            indexes, records = shard
+            for i, result in pipeline.answerRecords(records, args.use_pm,
+                                                    args.groupByImage):
+                if isinstance(result, tuple) and result[0] is not None:
+                    # query may be Java string which cannot be pickled
+                    result = (str(result[0]), result[1], result[2])
+                resultQueue.put((indexes[i], result))
+    except BaseException as e:
+        logger.exception('Unexpected exception in shard worker %s', e)
+    finally:
+        logRunnerStatistics()
+        resultQueue.put(('metrics', metrics.getState()))
+        resultQueue.put(None)
+        shutdownJVM()
+
+
+def splitIntoShards(records, shardSize, group_by_image):
+    if group_by_image:
+        groups = PatternMatcherVqaPipeline.groupRecordIndexesByImage(records)
+    else:
+        groups = [[index] for index in range(len(records))]
+    shards = []
+    indexes = []
+    for group in groups:
+        indexes += group
+        if len(indexes) >= shardSize:
+            shards.append(indexes)
+            indexes = []
+    if indexes:
+        shards.append(indexes)
+    return [(shard, [records[i] for i in shard]) for shard in shards]
+
+
+def collectShardResults(workers, resultQueue):
+    running = len(workers)
+    while running:
+        try:
+            item = resultQueue.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                logger.error('Shard workers exited unexpectedly')
+                return
+            continue
+        if item is None:
+            running -= 1
+            continue
+        if item[0] == 'metrics':
+            metrics.merge(item[1])
+            continue
+        yield item
+
+
+def answerQuestionsFromFileSharded(args, answerHandler, skipQuestionIds=frozenset()):
+    """
+    Answer questions by args.workers processes
+
+    Each worker has its own JVM, atomspace and neural network runner,
+    questions file is split into shards of args.shardSize questions which
+    are distributed between workers. Results are reported to answerHandler
+    in the order of questions in file.
+    """
+    records = PatternMatcherVqaPipeline.readRecords(args.questionsFileName, skipQuestionIds)
+    context = multiprocessing.get_context('spawn')
+    shardQueue = context.Queue()
+    resultQueue = context.Queue()
+    for shard in splitIntoShards(records, args.shardSize, args.groupByImage):
+        shardQueue.put(shard)
+    for _ in range(args.workers):
+        shardQueue.put(None)
+    workers = [context.Process(target=shardWorker, args=(args, shardQueue, resultQueue))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        reportResultsInOrder(answerHandler, records,
+                             collectShardResults(workers, resultQueue))
+    finally:
+        for worker in workers:
+            worker.join()
+
+
+def printStatistics(statisticsAnswerHandler):
+    print('Questions processed: {0}, answered: {1}, correct answers: {2}% ({3}), unaswered {4}%, '
+          'timeouts: {5}'
+          .format(statisticsAnswerHandler.processedQuestions,
+                  statisticsAnswerHandler.questionsAnswered,
+                  statisticsAnswerHandler.correctAnswerPercent(),
+                  statisticsAnswerHandler.correctAnswers,
+                  statisticsAnswerHandler.unanswered_percent(),
+                  statisticsAnswerHandler.timeouts))
+    with open("unanswered.txt", 'w') as f:
+        for record in statisticsAnswerHandler.getUnanswered():
+            f.write(record.toString() + '\n')
+    if statisticsAnswerHandler.timeouts:
+        with open("timeouts.txt", 'w') as f:
+            for record in statisticsAnswerHandler.getTimedOut():
+                f.write(record.toString() + '\n')
+
+
+def buildResultsSink(args):
+    if args.resultsFileName is None:
+        return None
+    return JsonlResultsSink(args.resultsFileName, args.resume,
+                            args.resultsIncludeQuery, args.resultsFsyncInterval)
+
+
+def restoreAnsweredQuestions(args, answerHandler):
+    """
+    Report results of previous run from results file when --resume is set
+
+    :return: Set[str]
+        ids of questions which should be skipped
+    """
+    if not args.resume:
+        return frozenset()
+    resultById = readResults(args.resultsFileName)
+    records = PatternMatcherVqaPipeline.readRecords(args.questionsFileName)
+    remaining = restoreResults(answerHandler, records, resultById)
+    logger.info('%s questions are restored from %s, %s questions remain',
+                len(records) - len(remaining), args.resultsFileName, len(remaining))
+    return frozenset(resultById)
+
+
+def logRunnerStatistics():
+    if network_runner.runner is None:
+        return
+    statistics = network_runner.runner.getStatistics()
+    if statistics:
+        logger.info('Neural network runner statistics: %s', statistics)
+
+
+def dumpMetrics(args):
+    if args.metricsFileName:
+        metrics.dump(args.metricsFileName)
+        logger.info('Pipeline metrics are written into %s', args.metricsFileName)
+
+
 def main():
     args = parse_args()
     initializeRootAndOpencogLogger(args.opencogLogLevel, args.pythonLogLevel)
+    metrics.sampleRate = args.metricsSampleRate
 
     logger = logging.getLogger('PatternMatcherVqaTest')
     logger.info('VqaMainLoop started')
 
-    jpype.startJVM(jpype.getDefaultJVMPath(),
-                   '-Djava.class.path=' + str(args.q2aJarFilenName))
-    try:
-
-        if args.kindOfFeaturesExtractor == 'IMAGE':
-            from feature.image import ImageFeatureExtractor
-            featureExtractor = ImageFeatureExtractor(
-                # TODO: replace by arguments
-                '/mnt/fileserver/shared/vital/image-features/test.prototxt',
-                '/mnt/fileserver/shared/vital/image-features/resnet101_faster_rcnn_final_iter_320000_for_36_bboxes.caffemodel',
-                args.imagesPath,
-                args.imagesPrefix
-                )
-        elif args.kindOfFeaturesExtractor == 'PRECALCULATED':
-            featureExtractor = TsvFileFeatureLoader(args.precalculatedFeaturesPath,
-                                             args.precalculatedFeaturesPrefix)
-        else:
-            raise ValueError('Unexpected args.kindOfFeaturesExtractor value: {}'
-                             .format(args.kindOfFeaturesExtractor))
+    statisticsAnswerHandler = StatisticsAnswerHandler()
+    skipQuestionIds = restoreAnsweredQuestions(args, statisticsAnswerHandler)
+    resultsSink = buildResultsSink(args)
+    answerHandler = statisticsAnswerHandler
+    if resultsSink is not None:
+        answerHandler = ChainAnswerHandler([statisticsAnswerHandler, resultsSink])
+    if args.workers > 1:
+        # JVM should not be started in parent process, workers start their own
+        try:
+            answerQuestionsFromFileSharded(args, answerHandler, skipQuestionIds)
+        finally:
+            if resultsSink is not None:
+                resultsSink.close()
+        printStatistics(statisticsAnswerHandler)
+        dumpMetrics(args)
+        logger.info('VqaMainLoop stopped')
+        return
 
-        questionConverter = jpype.JClass('org.opencog.vqa.relex.QuestionToOpencogConverter')()
-        if args.use_pm:
-            atomspace = initialize_atomspace_by_facts(args.atomspaceFileName)
-        else:
-            scheme_directories = ["~/projects/opencog/examples/pln/conjunction/",
-                                  "~/projects/atomspace/examples/rule-engine/rules/",
-                                  "~/projects/opencog/opencog/pln/rules/"]
-
-            atomspace = initialize_atomspace_by_facts(args.atomspaceFileName,
-                                                      "conjunction-rule-base-config.scm",
-                                                      [os.path.expanduser(x) for x in scheme_directories])
-        statisticsAnswerHandler = StatisticsAnswerHandler()
-        if (args.kindOfModel == 'MULTIDNN'):
-            network_runner.runner = NetsVocabularyNeuralNetworkRunner(args.multidnnModelFileName)
-        elif (args.kindOfModel == 'SPLITMULTIDNN'):
-            network_runner.runner = SplitMultidnnRunner(args.multidnnModelFileName)
-        elif (args.kindOfModel == 'HYPERNET'):
-            network_runner.runner = HyperNetNeuralNetworkRunner(args.hypernetWordsFileName,
-                            args.hypernetWordEmbeddingsFileName, args.hypernetModelFileName)
-        else:
-            raise ValueError('Unexpected args.kindOfModel value: {}'.format(args.kindOfModel))
-
-        pmVqaPipeline = PatternMatcherVqaPipeline(featureExtractor,
-                                                  questionConverter,
-                                                  atomspace,
-                                                  statisticsAnswerHandler)
-        pmVqaPipeline.answerQuestionsFromFile(args.questionsFileName, use_pm=args.use_pm)
-
-        print('Questions processed: {0}, answered: {1}, correct answers: {2}% ({3}), unaswered {4}%'
-              .format(statisticsAnswerHandler.processedQuestions,
-                      statisticsAnswerHandler.questionsAnswered,
-                      statisticsAnswerHandler.correctAnswerPercent(),
-                      statisticsAnswerHandler.correctAnswers,
-                      statisticsAnswerHandler.unanswered_percent()))
-        with open("unanswered.txt", 'w') as f:
-            for record in statisticsAnswerHandler.getUnanswered():
-                f.write(record.toString() + '\n')
+    try:
+        pmVqaPipeline = buildPipeline(args, answerHandler)
+        pmVqaPipeline.answerQuestionsFromFile(args.questionsFileName, use_pm=args.use_pm,
+                                              group_by_image=args.groupByImage,
+                                              prefetch_depth=args.prefetchDepth,
+                                              prefetch_feature_threads=args.prefetchFeatureThreads,
+                                              skip_question_ids=skipQuestionIds)
+
+        printStatistics(statisticsAnswerHandler)
+        logRunnerStatistics()
+        dumpMetrics(args)
     finally:
-        jpype.shutdownJVM()
+        if resultsSink is not None:
+            resultsSink.close()
+        shutdownJVM()
 
     logger.info('VqaMainLoop stopped')
 
@@ -0,0 +1,182 @@
+"""
+Accuracy check of reduced precision word models
+
+Answers held-out questions by float32 word models and by word models of
+each of --precisions (see reduced_precision.py), then compares answers,
+accuracy and word model scores on bounding boxes of the first
+--score-check-questions images with float32 baseline.
+
+Usage:
+
+    python precision_check.py --model-kind SPLITMULTIDNN --multidnn-model models \\
+        --features-extractor-kind STORE --feature-store val2014_store \\
+        --atomspace atomspace.scm -q heldout_questions.txt --precisions int8,bfloat16
+"""
+
+import json
+import time
+import logging
+
+import numpy as np
+
+import network_runner
+from interface import AnswerHandler
+from reduced_precision import PRECISIONS
+from pattern_matcher_vqa import (buildArgumentParser, buildPipeline, buildNeuralNetworkRunner,
+                                 shutdownJVM, initializeRootAndOpencogLogger,
+                                 PatternMatcherVqaPipeline)
+
+
+BASELINE_PRECISION = 'float32'
+
+logger = logging.getLogger(__name__)
+
+
+def collectScoreInputs(featureExtractor, records, limit):
+    """
+    :return: List[Tuple[numpy.array, List[str]]]
+        features of image and words of question for first limit records
+    """
+    inputs = []
+    for record in records[:limit]:
+        try:
+            features = featureExtractor.getFeaturesByImageId(record.imageId)
+        except BaseException as e:
+            logger.warning('Cannot load features of image %s: %s', record.imageId, e)
+            continue
+        inputs.append((np.asarray(features, dtype=np.float32), list(record.getWords())))
+    return inputs
+
+
+def computeScores(runner, inputs):
+    """
+    :return: Tuple[List[Dict[str, List[float]]], float]
+        scores by word for each input and seconds spent
+    """
+    start = time.perf_counter()
+    scores = [runner.runNeuralNetworkBatch(features, words) for features, words in inputs]
+    return scores, time.perf_counter() - start
+
+
+def compareScores(baselineScores, scores):
+    differences = []
+    for baselineByWord, scoresByWord in zip(baselineScores, scores):
+        for word, baseline in baselineByWord.items():
+            if word in scoresByWord:
+                differences.append(np.abs(np.asarray(baseline) - np.asarray(scoresByWord[word])))
+    differences = np.concatenate(differences) if differences else np.zeros(0)
+    return {'max_score_difference': float(differences.max()) if differences.size else 0.0,
+            'mean_score_difference': float(differences.mean()) if differences.size else 0.0}
+
+
+def answerRecords(pipeline, records, args):
+    """
+    :return: List[str]
+        answer of each record, None if question was not answered
+    """
+    answers = [None] * len(records)
+    for i, result in pipeline.answerRecords(records, args.use_pm, args.groupByImage):
+        if isinstance(result, tuple) and result[0] is not None:
+            answers[i] = result[1]
+    return answers
+
+
+def evaluatePrecision(args, pipeline, records, inputs, precision):
+    """
+    Answer records and score inputs by word models of precision
+
+    :return: Tuple[List[str], List[Dict[str, List[float]]], dict]
+        answers, scores and timings
+    """
+    if network_runner.runner is None or args.wordModelsPrecision != precision:
+        # release models of previous precision before loading next ones
+        network_runner.runner = None
+        args.wordModelsPrecision = precision
+        network_runner.runner = buildNeuralNetworkRunner(args)
+    scores, scoreSeconds = computeScores(network_runner.runner, inputs)
+    start = time.perf_counter()
+    answers = answerRecords(pipeline, records, args)
+    return answers, scores, {'score_seconds': scoreSeconds,
+                             'answer_seconds': time.perf_counter() - start}
+
+
+def summarize(records, answers, baselineAnswers):
+    numRecords = len(records)
+    correct = sum(1 for record, answer in zip(records, answers) if answer == record.answer)
+    agreed = sum(1 for answer, baseline in zip(answers, baselineAnswers) if answer == baseline)
+    return {'questions': numRecords,
+            'answered': sum(1 for answer in answers if answer is not None),
+            'correct_answers': correct,
+            'accuracy_percent': correct / numRecords * 100 if numRecords else 0.0,
+            'agreement_percent': agreed / numRecords * 100 if numRecords else 0.0,
+            'changed_answers': numRecords - agreed}
+
+
+def printReport(report):
+    for item in report:
+        print('{}: accuracy {:.2f}% ({}/{}), answered {}, agreement with {} {:.2f}% '
+              '({} changed), score difference max {:.5f} mean {:.6f}, '
+              'scoring {:.3f}s, answering {:.3f}s'
+              .format(item['precision'], item['accuracy_percent'], item['correct_answers'],
+                      item['questions'], item['answered'], BASELINE_PRECISION,
+                      item['agreement_percent'], item['changed_answers'],
+                      item['max_score_difference'], item['mean_score_difference'],
+                      item['score_seconds'], item['answer_seconds']))
+
+
+def parse_args():
+    parser = buildArgumentParser(description='Compare answers and accuracy of reduced '
+                                 'precision word models with float32 ones')
+    parser.add_argument('--precisions', dest='precisions', action='store', type=str,
+                        default='int8,bfloat16',
+                        help='comma separated precisions to check, one of {}'
+                        .format(', '.join(PRECISIONS)))
+    parser.add_argument('--score-check-questions', dest='scoreCheckQuestions',
+                        action='store', type=int, default=100,
+                        help='number of first questions which word model scores '
+                        'are compared on bounding boxes of their images')
+    parser.add_argument('--report-file', dest='reportFileName', action='store', type=str,
+                        help='JSON file to write report to')
+    args = parser.parse_args()
+    args.precisions = [precision.strip() for precision in args.precisions.split(',')
+                       if precision.strip() and precision.strip() != BASELINE_PRECISION]
+    for precision in args.precisions:
+        if precision not in PRECISIONS:
+            parser.error('unexpected precision: {}'.format(precision))
+    return args
+
+
+def main():
+    args = parse_args()
+    initializeRootAndOpencogLogger(args.opencogLogLevel, args.pythonLogLevel)
+    records = PatternMatcherVqaPipeline.readRecords(args.questionsFileName)
+
+    try:
+        args.wordModelsPrecision = BASELINE_PRECISION
+        pipeline = buildPipeline(args, AnswerHandler())
+        inputs = collectScoreInputs(pipeline.featureExtractor, records,
+                                    args.scoreCheckQuestions)
+        report = []
+        baselineAnswers = baselineScores = None
+        for precision in [BASELINE_PRECISION] + args.precisions:
+            logger.info('Evaluating %s word models', precision)
+            answers, scores, timings = evaluatePrecision(args, pipeline, records, inputs,
+                                                         precision)
+            if baselineAnswers is None:
+                baselineAnswers, baselineScores = answers, scores
+            item = {'precision': precision}
+            item.update(summarize(records, answers, baselineAnswers))
+            item.update(compareScores(baselineScores, scores))
+            item.update(timings)
+            report.append(item)
+    finally:
+        shutdownJVM()
+
+    printReport(report)
+    if args.reportFileName:
+        with open(args.reportFileName, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Prefetching of image features and question queries
+
+Features are loaded and questions are parsed and converted to queries by
+background threads for the next questions while pattern matcher answers
+the current one.
+"""
+
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import jpype
+
+from instrumentation import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class StageStatistics:
+    """
+    Thread safe counters and total time of pipeline stages
+
+    Timings are added into instrumentation.metrics as well with
+    "prefetch_" prefix.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.countByStage = collections.OrderedDict()
+        self.secondsByStage = collections.OrderedDict()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.countByStage[stage] = self.countByStage.get(stage, 0) + 1
+            self.secondsByStage[stage] = self.secondsByStage.get(stage, 0.0) + seconds
+        metrics.add('prefetch_' + stage, seconds)
+
+    def timed(self, stage, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def asDict(self):
+        with self.lock:
+            return {stage: {'count': count,
+                            'total_seconds': self.secondsByStage[stage],
+                            'mean_seconds': self.secondsByStage[stage] / count}
+                    for stage, count in self.countByStage.items()}
+
+
+class PreparedQuestion:
+    """
+    Question with features and query which are computed in background
+    """
+    __slots__ = ["index", "record", "features", "query"]
+
+    def __init__(self, index, record, features, query):
+        self.index = index
+        self.record = record
+        self.features = features
+        self.query = query
+
+
+def attachThreadToJVM():
+    # JVM may be not started yet when questions are cached
+    if jpype.isJVMStarted() and not jpype.isThreadAttachedToJVM():
+        jpype.attachThreadToJVM()
+
+
+class QuestionPrefetcher:
+    """
+    Iterates over records in order and keeps features and queries of up
+    to depth next records computing in background
+
+    Features are loaded by pool of featureThreads threads. Questions are
+    parsed by single thread because RelEx parser is not thread safe.
+    """
+
+    def __init__(self, featureExtractor, convertQuestionToQuery, records,
+                 depth=8, featureThreads=2):
+        """
+        :param featureExtractor: interface.FeatureExtractor
+        :param convertQuestionToQuery: Callable[[str], str]
+            function which converts question to query
+        :param records: Iterable[Record]
+        :param depth: int
+            maximal number of questions prepared ahead
+        :param featureThreads: int
+            number of threads loading features
+        """
+        self.featureExtractor = featureExtractor
+        self.convertQuestionToQuery = convertQuestionToQuery
+        self.records = records
+        self.depth = max(1, depth)
+        self.featureThreads = featureThreads
+        self.statistics = StageStatistics()
+        self.maxReady = 0
+        self.readySum = 0
+        self.readyCount = 0
+
+    def loadFeatures(self, imageId):
+        return self.statistics.timed('feature_load',
+                                     self.featureExtractor.getFeaturesByImageId,
+                                     imageId)
+
+    def convert(self, question):
+        attachThreadToJVM()
+        query = self.statistics.timed('parse_and_convert',
+                                      self.convertQuestionToQuery, question)
+        # convert Java string in background thread as well
+        return None if query is None else str(query)
+
+    def prepare(self, index, record, featurePool, parsePool):
+        return PreparedQuestion(index, record,
+                                featurePool.submit(self.loadFeatures, record.imageId),
+                                parsePool.submit(self.convert, record.question))
+
+    def updateQueueDepth(self, pending):
+        ready = sum(1 for prepared in pending
+                    if prepared.features.done() and prepared.query.done())
+        self.maxReady = max(self.maxReady, ready)
+        self.readySum += ready
+        self.readyCount += 1
+
+    def __iter__(self):
+        """
+        :return: Iterator[PreparedQuestion]
+            questions in the order of records, features and query are
+            futures which are done or will be done soon
+        """
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.featureThreads) as featurePool, \
+                ThreadPoolExecutor(1) as parsePool:
+            try:
+                for index, record in enumerate(self.records):
+                    pending.append(self.prepare(index, record, featurePool, parsePool))
+                    if len(pending) >= self.depth:
+                        yield self.next(pending)
+                while pending:
+                    yield self.next(pending)
+            finally:
+                for prepared in pending:
+                    prepared.features.cancel()
+                    prepared.query.cancel()
+
+    def next(self, pending):
+        self.updateQueueDepth(pending)
+        prepared = pending.popleft()
+        start = time.perf_counter()
+        # wait for both futures, exceptions are raised by consumer
+        for future in (prepared.features, prepared.query):
+            future.exception()
+        self.statistics.add('wait', time.perf_counter() - start)
+        return prepared
+
+    def getStatistics(self):
+        """
+        :return: dict
+            per-stage timings and number of ready questions in queue
+        """
+        result = self.statistics.asDict()
+        result['queue'] = {'depth': self.depth,
+                           'max_ready': self.maxReady,
+                           'mean_ready': self.readySum / self.readyCount
+                                         if self.readyCount else 0.0}
+        return result
@@ -0,0 +1,164 @@
+"""
+Persistent cache of parsed questions and Scheme queries
+
+Cache allows answering questions which were already parsed by
+question2atomese without starting JVM.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def fileVersion(fileName):
+    """
+    Version of the converter library, changes when library file changes
+    """
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class CachedRelexFormula:
+    """
+    Python replacement of org.opencog.vqa.relex.RelexFormula which keeps
+    results of question conversion
+    """
+    __slots__ = ["fullFormula", "groundedFormula", "questionType", "queryPM", "queryURE"]
+
+    def __init__(self, fullFormula, groundedFormula, questionType, queryPM, queryURE):
+        self.fullFormula = fullFormula
+        self.groundedFormula = groundedFormula
+        self.questionType = questionType
+        self.queryPM = queryPM
+        self.queryURE = queryURE
+
+    def getFullFormula(self):
+        return self.fullFormula
+
+    def getGroundedFormula(self):
+        return self.groundedFormula
+
+    def __str__(self):
+        return self.fullFormula
+
+
+class CachedParsedQuestion:
+    """
+    Python replacement of QuestionToOpencogConverter.ParsedQuestion
+    """
+    __slots__ = ["relexFormula", "questionType"]
+
+    def __init__(self, relexFormula, questionType):
+        self.relexFormula = relexFormula
+        self.questionType = questionType
+
+
+def toStr(javaString):
+    return None if javaString is None else str(javaString)
+
+
+class QueryCache:
+    """
+    SQLite table of converted questions keyed by question text and
+    converter version
+    """
+
+    def __init__(self, fileName, version):
+        self.version = version
+        self.lock = threading.Lock()
+        # connection is shared by pipeline and prefetching threads
+        self.connection = sqlite3.connect(fileName, timeout=60,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS queries ('
+                                    'question TEXT, version TEXT, '
+                                    'full_formula TEXT, grounded_formula TEXT, '
+                                    'question_type TEXT, query_pm TEXT, query_ure TEXT, '
+                                    'PRIMARY KEY (question, version))')
+
+    def get(self, question):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT full_formula, grounded_formula, question_type, query_pm, query_ure '
+                'FROM queries WHERE question = ? AND version = ?',
+                (question, self.version)).fetchone()
+        if row is None:
+            return None
+        return CachedRelexFormula(*row)
+
+    def put(self, question, formula):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (question, self.version, formula.fullFormula, formula.groundedFormula,
+                 formula.questionType, formula.queryPM, formula.queryURE))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class CachingQuestionConverter:
+    """
+    Replacement of org.opencog.vqa.relex.QuestionToOpencogConverter which
+    looks for question in QueryCache first
+
+    Java converter is created by createConverter() on first cache miss,
+    so JVM is not required when all questions are cached.
+    """
+
+    def __init__(self, cache, createConverter):
+        """
+        :param cache: QueryCache
+        :param createConverter: Callable[[], QuestionToOpencogConverter]
+            function which starts JVM if needed and creates Java converter
+        """
+        self.cache = cache
+        self.createConverter = createConverter
+        self.converter = None
+        self.hits = 0
+        self.misses = 0
+
+    def getConverter(self):
+        if self.converter is None:
+            logger.info('Question is not cached, creating question converter')
+            self.converter = self.createConverter()
+        return self.converter
+
+    def convert(self, question):
+        converter = self.getConverter()
+        parsedQuestion = converter.parseQuestionAndType(question)
+        relexFormula = parsedQuestion.relexFormula
+        return CachedRelexFormula(toStr(relexFormula.getFullFormula()),
+                                  toStr(relexFormula.getGroundedFormula()),
+                                  toStr(parsedQuestion.questionType),
+                                  toStr(converter.convertToOpencogSchemePM(relexFormula)),
+                                  toStr(converter.convertToOpencogSchemeURE(relexFormula)))
+
+    def parseQuestion(self, question):
+        formula = self.cache.get(question)
+        if formula is not None:
+            self.hits += 1
+            return formula
+        self.misses += 1
+        formula = self.convert(question)
+        self.cache.put(question, formula)
+        return formula
+
+    def parseQuestionAndType(self, question):
+        formula = self.parseQuestion(question)
+        return CachedParsedQuestion(formula, formula.questionType)
+
+    def convertToOpencogSchemePM(self, formula):
+        return formula.queryPM
+
+    def convertToOpencogSchemeURE(self, formula):
+        return formula.queryURE
@@ -0,0 +1,81 @@
+"""
+Cache of compiled query templates
+
+Queries generated by question2atomese for the same relex formula differ
+only by words, for instance queries for "Are the zebras fat?" and "Is the
+plane red?" are built from the same _predadj(A, B) template. Each template
+is defined once as Scheme procedure which takes words as arguments, so
+Guile doesn't read and parse whole query text for each question.
+"""
+
+import re
+import logging
+
+from opencog.scheme_wrapper import scheme_eval, scheme_eval_h
+
+
+conceptNodeRegex = re.compile(r'\(ConceptNode "([^"]+)"\)')
+
+# concept nodes which are part of template and not replaced by parameters
+TEMPLATE_CONCEPTS = frozenset(['BoundingBox'])
+
+logger = logging.getLogger(__name__)
+
+
+def schemeString(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class QueryTemplateCache:
+
+    def __init__(self, procedurePrefix='vqa-query-template'):
+        self.procedurePrefix = procedurePrefix
+        self.procedureByTemplate = {}
+
+    def parametrize(self, queryInScheme):
+        """
+        Replace words of query by parameters
+
+        :param queryInScheme: str
+        :return: Tuple[str, List[str]]
+            template text with parameters w0, w1, ... and words to pass
+            as parameters
+        """
+        words = []
+
+        def replace(match):
+            word = match.group(1)
+            if word in TEMPLATE_CONCEPTS:
+                return match.group(0)
+            if word not in words:
+                words.append(word)
+            return '(ConceptNode w{})'.format(words.index(word))
+
+        template = conceptNodeRegex.sub(replace, queryInScheme)
+        return template, words
+
+    def getProcedure(self, atomspace, template, numberOfWords):
+        procedure = self.procedureByTemplate.get(template)
+        if procedure is None:
+            procedure = '{}-{}'.format(self.procedurePrefix, len(self.procedureByTemplate))
+            parameters = ' '.join('w{}'.format(i) for i in range(numberOfWords))
+            definition = '(define ({} {}) {})'.format(procedure, parameters, template)
+            logger.debug('Defining query template: %s', definition)
+            scheme_eval(atomspace, definition)
+            self.procedureByTemplate[template] = procedure
+        return procedure
+
+    def evaluate(self, atomspace, queryInScheme):
+        """
+        Evaluate query by calling procedure of its template
+
+        :param atomspace: AtomSpace
+        :param queryInScheme: str
+            query to pattern matcher or ure
+        :return: Atom
+            result of the query as scheme_eval_h() returns
+        """
+        template, words = self.parametrize(queryInScheme)
+        procedure = self.getProcedure(atomspace, template, len(words))
+        call = '({} {})'.format(procedure, ' '.join(schemeString(word) for word in words))
+        return scheme_eval_h(atomspace, call)
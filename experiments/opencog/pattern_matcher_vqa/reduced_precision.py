@@ -0,0 +1,108 @@
+"""
+Reduced precision CPU inference of word models
+
+Almost all time of 2048 -> 64 -> 32 -> 1 word model is spent reading
+weights of the first layer, so keeping weights in int8 (dynamic
+quantization of nn.Linear) or in float16/bfloat16 cuts memory bandwidth
+and resident memory. Half precision models are computed natively in
+weights type: activations between layers are half precision, inputs
+and outputs are float32. When PyTorch build cannot multiply matrices
+of the type on the device, models are kept in float32 with warning.
+Use precision_check.py to compare answers, accuracy and speed with
+float32 models before switching.
+"""
+
+import logging
+import functools
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+PRECISIONS = ['float32', 'int8', 'float16', 'bfloat16']
+
+DTYPE_BY_PRECISION = {'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+logger = logging.getLogger(__name__)
+
+
+def isComputeSupported(dtype, device):
+    """
+    Check that linear layer and batched matrix multiplication are
+    implemented for dtype on device, half precision CPU kernels are
+    missing in older PyTorch versions
+    """
+    try:
+        x = torch.ones(1, 1, 2, dtype=dtype, device=device)
+        F.linear(x[0], x[0])
+        torch.bmm(x, x.transpose(1, 2))
+        return True
+    except RuntimeError:
+        return False
+
+
+@functools.lru_cache()
+def getComputeDtype(dtype, device):
+    """
+    :param device: str
+    :return: torch.dtype
+        dtype if models can be computed in it on device, float32 otherwise
+    """
+    if isComputeSupported(dtype, device):
+        return dtype
+    logger.warning('%s matrix multiplication is not supported on %s by this PyTorch build, '
+                   'word models are kept in float32', dtype, device)
+    return torch.float32
+
+
+class ReducedPrecisionModel(nn.Module):
+    """
+    Model which weights are kept and computed in float16 or bfloat16,
+    input is converted to weights type and output is converted back
+    to float32
+    """
+
+    def __init__(self, model, dtype):
+        super().__init__()
+        self.model = model.to(dtype)
+        self.dtype = dtype
+
+    def forward(self, x):
+        return self.model(x.to(self.dtype)).float()
+
+
+def convertWordModel(model, precision):
+    """
+    :param model: torch.nn.Module
+        word model in inference mode
+    :param precision: str
+        one of PRECISIONS
+    :return: torch.nn.Module
+        model which accepts and returns float32 tensors
+    """
+    if precision == 'float32':
+        return model
+    if precision == 'int8':
+        return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if precision in DTYPE_BY_PRECISION:
+        device = next(model.parameters()).device
+        dtype = getComputeDtype(DTYPE_BY_PRECISION[precision], str(device))
+        return model if dtype == torch.float32 else ReducedPrecisionModel(model, dtype)
+    raise ValueError('Unexpected precision: {}'.format(precision))
+
+
+def convertStackedModels(stackedModels, precision):
+    """
+    :param stackedModels: netsvocabulary.StackedModels
+    :raise ValueError: for int8 precision, dynamic quantization supports
+        nn.Linear modules only
+    """
+    if precision == 'float32':
+        return stackedModels
+    if precision in DTYPE_BY_PRECISION:
+        dtype = getComputeDtype(DTYPE_BY_PRECISION[precision],
+                                str(stackedModels.weights[0].device))
+        return stackedModels.to(dtype)
+    raise ValueError('{} precision is not supported for stacked word models'
+                     .format(precision))
@@ -0,0 +1,153 @@
+"""
+Streaming sink of question results
+
+Each processed question (answered, timed out, not parsed or failed) is
+appended to JSON lines file as
+soon as it is reported, file is flushed and fsync'ed periodically, so
+results of long evaluation survive crash or preemption of the machine.
+Run with --resume skips questions which are already in the file and
+restores final statistics from it.
+"""
+
+import os
+import json
+import time
+import logging
+
+from interface import AnswerHandler
+
+
+STATUS_ANSWERED = 'answered'
+STATUS_TIMEOUT = 'timeout'
+STATUS_NOT_PARSED = 'not_parsed'
+STATUS_FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def truncateIncompleteLine(fileName):
+    """
+    Remove last line of file if it was not completely written
+    """
+    with open(fileName, 'rb+') as file:
+        size = file.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(end - 4096, 0)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            logger.warning('Removing incomplete last line of %s', fileName)
+            file.truncate(end)
+
+
+def readResults(fileName):
+    """
+    :return: Dict[str, dict]
+        results by question id, empty if file doesn't exist
+    """
+    resultById = {}
+    if not os.path.isfile(fileName):
+        return resultById
+    with open(fileName, 'r') as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # incomplete line written before crash
+                logger.warning('Skipping broken line of %s', fileName)
+                continue
+            resultById[result['questionId']] = result
+    return resultById
+
+
+def restoreResults(answerHandler, records, resultById):
+    """
+    Report results read by readResults() to answer handler
+
+    :param records: List[Record]
+        questions in order of questions file
+    :return: List[Record]
+        records which have no result yet
+    """
+    remaining = []
+    for record in records:
+        result = resultById.get(record.questionId)
+        if result is None:
+            remaining.append(record)
+            continue
+        answerHandler.onNewQuestion(record)
+        if result['status'] == STATUS_TIMEOUT:
+            answerHandler.onTimeout(record)
+        elif result['status'] == STATUS_NOT_PARSED:
+            answerHandler.onNotParsed(record)
+        elif result['status'] == STATUS_FAILED:
+            answerHandler.onFailure(record)
+        else:
+            answerHandler.onAnswer(record, result['answer'])
+    return remaining
+
+
+class JsonlResultsSink(AnswerHandler):
+
+    def __init__(self, fileName, append=False, includeQuery=False, fsyncInterval=10.0):
+        """
+        :param fileName: str
+        :param append: bool
+            keep results which are already in file
+        :param includeQuery: bool
+            write query of question into result
+        :param fsyncInterval: float
+            seconds between file fsync() calls
+        """
+        if append and os.path.isfile(fileName):
+            truncateIncompleteLine(fileName)
+        self.file = open(fileName, 'a' if append else 'w')
+        self.includeQuery = includeQuery
+        self.fsyncInterval = fsyncInterval
+        self.lastSync = time.monotonic()
+
+    def onAnswer(self, record, answer, details=None):
+        self.write(record, STATUS_ANSWERED, answer, details)
+
+    def onTimeout(self, record):
+        self.write(record, STATUS_TIMEOUT, None, None)
+
+    def onNotParsed(self, record):
+        self.write(record, STATUS_NOT_PARSED, None, None)
+
+    def onFailure(self, record, error=None):
+        self.write(record, STATUS_FAILED, None, None,
+                   None if error is None else repr(error))
+
+    def write(self, record, status, answer, details, error=None):
+        result = {'questionId': record.questionId,
+                  'imageId': record.imageId,
+                  'question': record.question,
+                  'status': status,
+                  'answer': answer,
+                  'expected': record.answer}
+        if error is not None:
+            result['error'] = error
+        if details is not None:
+            result['boundingBox'] = details.get('boundingBox')
+            result['timings'] = details.get('timings')
+            if self.includeQuery:
+                result['query'] = details.get('query')
+        self.file.write(json.dumps(result) + '\n')
+        if time.monotonic() - self.lastSync >= self.fsyncInterval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lastSync = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
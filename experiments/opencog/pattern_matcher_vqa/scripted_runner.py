@@ -0,0 +1,70 @@
+"""
+Runner of word models exported by model_export.py
+
+Artifact is TorchScript module which contains vocabulary lookup and
+scores computation, so it is loaded by torch.jit.load() only and
+neither training code nor checkpoints of original model are imported.
+"""
+
+import logging
+import torch
+
+from interface import NeuralNetworkRunner, NoModelException
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScriptedModelRunner(NeuralNetworkRunner):
+
+    def __init__(self, modelFileName):
+        """
+        :param modelFileName: str
+            artifact saved by model_export.py
+        """
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = torch.jit.load(modelFileName, map_location=self.device)
+        self.model.eval()
+        self.modelKind = self.model.modelKind
+        self.unknownWordsScoredZero = self.model.unknownWordsScoredZero
+        # word lookups are cached to avoid call of scripted method per word
+        self.indexByWord = {}
+        logger.info('%s model is loaded from %s', self.modelKind, modelFileName)
+
+    def getWordIndexes(self, words):
+        unknownWords = [word for word in words if word not in self.indexByWord]
+        if unknownWords:
+            self.indexByWord.update(zip(unknownWords, self.model.getWordIndexes(unknownWords)))
+        return [self.indexByWord[word] for word in words]
+
+    def runModel(self, features, indexes):
+        """
+        :return: torch.Tensor
+            numBoxes x len(indexes) scores
+        """
+        featuresTensor = torch.as_tensor(features, dtype=torch.float32).to(self.device)
+        indexesTensor = torch.tensor(indexes, dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            return self.model(featuresTensor.view(-1, featuresTensor.shape[-1]),
+                              indexesTensor).cpu()
+
+    def runNeuralNetwork(self, features, word):
+        index, = self.getWordIndexes([word])
+        if index < 0:
+            if self.unknownWordsScoredZero:
+                logger.debug('no model found, return FALSE')
+                return torch.zeros(1)
+            raise NoModelException("No model for word: {0}".format(word))
+        return self.runModel(features, [index]).view(-1)
+
+    def runNeuralNetworkBatch(self, features, words):
+        indexes = self.getWordIndexes(words)
+        knownWords = [word for word, index in zip(words, indexes) if index >= 0]
+        result = {}
+        if self.unknownWordsScoredZero:
+            result = {word: [0.0] * len(features) for word in words}
+        if not knownWords:
+            return result
+        scores = self.runModel(features, [index for index in indexes if index >= 0])
+        result.update(zip(knownWords, scores.t().tolist()))
+        return result
@@ -0,0 +1,207 @@
+"""
+Packed checkpoint of SplitNetsVocab word models
+
+Directory of split models keeps each word network in separate
+networks/best_loss_model_<word id>.pth file and thresholds in
+thresholds/best_th.json. Packing tool merges them into single file:
+
+    magic, header length, JSON header, parameters
+
+Header lists word ids, thresholds and for each parameter of word network
+(0.weight, 0.bias, ...) its shape and offset. Parameter of all words is
+kept as contiguous float32 array nWords x shape which starts at 64 bytes
+aligned offset, so file is memory mapped and network of word is
+materialised only when it is requested first time. Header also keeps
+number and maximal modification time of source files, so packed file
+which is older than retrained models is detected, see isPackUpToDate().
+
+Usage:
+
+    python -m splitnet.packed <models directory>
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import struct
+import logging
+import collections
+
+import numpy
+import torch
+
+
+PACKED_FILE_NAME = 'networks.pack'
+PACKED_FORMAT_VERSION = 1
+MAGIC = b'SNVPACK\0'
+ALIGNMENT = 64
+
+logger = logging.getLogger(__name__)
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def listModelFiles(path_to_models, prefix='best_loss_model'):
+    """
+    :return: Dict[int, str]
+        model file name by word id
+    """
+    fileNameByKey = {}
+    for fileName in glob.glob(path_to_models + "/" + prefix + "_*.pth"):
+        fileNameByKey[int(re.findall(r"_(\d+)\.pth", fileName)[0])] = fileName
+    return fileNameByKey
+
+
+def readThresholds(models_directory):
+    fileName = os.path.join(models_directory, 'thresholds/best_th.json')
+    if not os.path.isfile(fileName):
+        return {}
+    with open(fileName, 'r') as file:
+        return {int(k): float(v) for (k, v) in json.load(file).items()}
+
+
+def getSourceVersion(models_directory):
+    """
+    :return: dict
+        number and maximal modification time of model and thresholds
+        files which packed file is built from
+    """
+    fileNames = list(listModelFiles(os.path.join(models_directory, 'networks')).values())
+    thresholdsFileName = os.path.join(models_directory, 'thresholds/best_th.json')
+    if os.path.isfile(thresholdsFileName):
+        fileNames.append(thresholdsFileName)
+    mtimes = [os.stat(fileName).st_mtime_ns for fileName in fileNames]
+    return {'files': len(fileNames), 'mtime_ns': max(mtimes, default=0)}
+
+
+def isPackUpToDate(models_directory, packedModels):
+    """
+    Check that no source file is newer than packed file and number of
+    source files is the same; older modification times (files copied
+    without preserving them) are accepted. Packed file without source
+    files (deployed alone) is up to date.
+    """
+    sourceVersion = getSourceVersion(models_directory)
+    if sourceVersion['files'] == 0:
+        return True
+    if packedModels.source is None:
+        return False
+    return (sourceVersion['files'] == packedModels.source['files']
+            and sourceVersion['mtime_ns'] <= packedModels.source['mtime_ns'])
+
+
+def packModels(models_directory, packedFileName=None):
+    """
+    Pack word models and thresholds of split models directory
+
+    Each model file is loaded once and its parameters are written into
+    their places in parameter arrays.
+
+    :return: str
+        packed file name
+    """
+    if packedFileName is None:
+        packedFileName = os.path.join(models_directory, PACKED_FILE_NAME)
+    fileNameByKey = listModelFiles(os.path.join(models_directory, 'networks'))
+    if not fileNameByKey:
+        raise ValueError('No models found in {}'.format(models_directory))
+    keys = sorted(fileNameByKey)
+    firstStateDict = torch.load(fileNameByKey[keys[0]], map_location='cpu')
+    parameters = []
+    offset = 0
+    for name, tensor in firstStateDict.items():
+        parameters.append({'name': name, 'shape': list(tensor.shape), 'offset': offset})
+        offset = align(offset + len(keys) * tensor.numel() * 4)
+    header = json.dumps({'version': PACKED_FORMAT_VERSION,
+                         'source': getSourceVersion(models_directory),
+                         'keys': keys,
+                         'thresholds': {str(k): v for k, v
+                                        in readThresholds(models_directory).items()},
+                         'parameters': parameters}).encode('utf-8')
+    dataOffset = align(len(MAGIC) + 8 + len(header))
+
+    temporaryFileName = packedFileName + '.tmp'
+    with open(temporaryFileName, 'wb') as file:
+        file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        file.truncate(dataOffset + offset)
+        for index, key in enumerate(keys):
+            stateDict = torch.load(fileNameByKey[key], map_location='cpu')
+            for parameter in parameters:
+                array = stateDict[parameter['name']].numpy().astype('<f4')
+                if list(array.shape) != parameter['shape']:
+                    raise ValueError('Unexpected shape of {} in {}'
+                                     .format(parameter['name'], fileNameByKey[key]))
+                file.seek(dataOffset + parameter['offset'] + index * array.nbytes)
+                file.write(array.tobytes())
+            if (index + 1) % 1000 == 0:
+                logger.info('%s of %s models packed', index + 1, len(keys))
+    os.replace(temporaryFileName, packedFileName)
+    logger.info('%s models are packed into %s', len(keys), packedFileName)
+    return packedFileName
+
+
+class PackedModels:
+    """
+    Memory mapped packed file, see packModels()
+    """
+
+    def __init__(self, fileName):
+        with open(fileName, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not packed models file'.format(fileName))
+            headerLength, = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(headerLength).decode('utf-8'))
+        if header['version'] != PACKED_FORMAT_VERSION:
+            raise ValueError('Unsupported packed models version {}'.format(header['version']))
+        dataOffset = align(len(MAGIC) + 8 + headerLength)
+        self.keys = header['keys']
+        self.indexByKey = {key: index for index, key in enumerate(self.keys)}
+        self.thresholds = {int(k): v for k, v in header['thresholds'].items()}
+        # None for files packed before source version was recorded
+        self.source = header.get('source')
+        self.arrayByName = collections.OrderedDict()
+        for parameter in header['parameters']:
+            self.arrayByName[parameter['name']] = numpy.memmap(
+                fileName, dtype='<f4', mode='r', offset=dataOffset + parameter['offset'],
+                shape=tuple([len(self.keys)] + parameter['shape']))
+
+    def getStateDict(self, key):
+        """
+        Copy parameters of word model out of mapped file
+
+        :raise KeyError: if there is no model for key
+        """
+        index = self.indexByKey[key]
+        return collections.OrderedDict((name, torch.from_numpy(numpy.array(array[index])))
+                                       for name, array in self.arrayByName.items())
+
+    def getStackedParameters(self):
+        """
+        :return: Tuple[List[torch.Tensor], List[torch.Tensor]]
+            weights and biases of linear layers of all words as
+            netsvocabulary.StackedModels expects them
+        """
+        layers = sorted(int(name.split('.')[0]) for name in self.arrayByName
+                        if name.endswith('.weight'))
+        weights = [torch.from_numpy(numpy.ascontiguousarray(
+                       self.arrayByName['{}.weight'.format(layer)].transpose(0, 2, 1)))
+                   for layer in layers]
+        biases = [torch.from_numpy(numpy.array(self.arrayByName['{}.bias'.format(layer)]))
+                  for layer in layers]
+        return weights, biases
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2:
+        print('usage: python -m splitnet.packed <models directory>')
+        sys.exit(1)
+    packModels(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -6,18 +6,19 @@ import json
 import torch
 import torch.nn as nn
 import os
-import glob
-import re
 import sys
 import logging
 
 from splitnet.dictionary import Dictionary
+from splitnet.packed import PACKED_FILE_NAME, PackedModels, listModelFiles, isPackUpToDate
 
 from interface import NeuralNetworkRunner, NoModelException
+from model_residency import ModelResidency
+from reduced_precision import convertWordModel, convertStackedModels
 import numpy
 
 sys.path.insert(0, os.path.dirname(__file__) + '/../../DNNs/vqa_multi_dnn')
-from netsvocabulary import INetsVocab
+from netsvocabulary import INetsVocab, StackedModels
 
 logger = logging.getLogger(__name__)
 
@@ -26,17 +27,39 @@ class SplitNetsVocab(INetsVocab):
     """
     Class for loading and using pytorch models with custom
     thresholds
+
+    If models directory contains packed file (see splitnet/packed.py)
+    models are loaded from it lazily, otherwise from separate files.
+    When max_resident_bytes is set models are loaded on first use and
+    least recently used ones are evicted, see model_residency.py.
+    Models are converted to precision, see reduced_precision.py.
     """
-    def __init__(self, models_directory):
+    def __init__(self, models_directory, stacked=False, max_resident_bytes=None,
+                 pinned_words=(), precision='float32'):
         super().__init__()
+        self.precision = precision
         path = os.path.join(models_directory, 'dictionary.pkl')
         self.dictionary = Dictionary.load_from_file(path)
         self.modelIndexByWord = self.dictionary.word2idx
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.models = self.load_models(os.path.join(models_directory, 'networks'),
-                                         prefix='best_loss_model',
-                                         device=device)
-        self.thresholds_by_id = self.load_threshold(models_directory)
+        pinned_ids = [self.dictionary.word2idx[word] for word in pinned_words
+                      if word in self.dictionary.word2idx]
+        packedModels = self.load_packed_file(models_directory)
+        if packedModels is not None:
+            self.models = self.load_packed_models(packedModels, device, stacked,
+                                                  max_resident_bytes, pinned_ids)
+            self.thresholds_by_id = dict(packedModels.thresholds)
+        elif max_resident_bytes is not None and not stacked:
+            self.models = self.load_models_on_demand(os.path.join(models_directory, 'networks'),
+                                                     'best_loss_model', device,
+                                                     max_resident_bytes, pinned_ids)
+            self.thresholds_by_id = self.load_threshold(models_directory)
+        else:
+            self.models = self.load_models(os.path.join(models_directory, 'networks'),
+                                             prefix='best_loss_model',
+                                             device=device,
+                                             stacked=stacked)
+            self.thresholds_by_id = self.load_threshold(models_directory)
         model_list = sorted(self.models.keys())
         th_list = sorted(self.thresholds_by_id.keys())
         if len(th_list):
@@ -49,20 +72,42 @@ class SplitNetsVocab(INetsVocab):
                 logger.warning("no threshold for {0}, using mean value {1}".format(i, mean_th))
                 self.thresholds_by_id[i] = mean_th
 
+    def load_packed_file(self, models_directory):
+        """
+        :return: splitnet.packed.PackedModels
+            None if there is no packed file or it is older than model files
+        """
+        packedFileName = os.path.join(models_directory, PACKED_FILE_NAME)
+        if not os.path.isfile(packedFileName):
+            return None
+        packedModels = PackedModels(packedFileName)
+        if not isPackUpToDate(models_directory, packedModels):
+            logger.warning("%s is out of date, models are loaded from separate files; "
+                           "run python -m splitnet.packed %s to repack them",
+                           packedFileName, models_directory)
+            return None
+        return packedModels
+
+    def create_network(self, device):
+        return nn.Sequential(
+            nn.Linear(2048, 64),
+            nn.ReLU(),
+            nn.Linear(64, 32),
+            nn.ReLU(),
+            nn.Linear(32, 1),
+            nn.Sigmoid()
+        ).to(device)
+
     def create_networks(self, all_words, device):
         nets = dict()
         for k in all_words:
-            model = nn.Sequential(
-                nn.Linear(2048, 64),
-                nn.ReLU(),
-                nn.Linear(64, 32),
-                nn.ReLU(),
-                nn.Linear(32, 1),
-                nn.Sigmoid()
-            ).to(device)
-            nets[k] = model
+            nets[k] = self.create_network(device)
         return nets
 
+    def prepare_network(self, model):
+        model.train(False)
+        return convertWordModel(model, self.precision)
+
     def get_parameters(self, nets):
         rez = []
         for k in nets:
@@ -73,19 +118,56 @@ class SplitNetsVocab(INetsVocab):
         for k in nets:
             nets[k].train(is_train)
 
-    def load_models(self, path_to_models, prefix, device):
-        list_of_files = glob.glob(path_to_models + "/" + prefix + "_*.pth")
-        list_of_words = []
-        for f in list_of_files:
-            rez = int(re.findall("_(\d+)\.pth", f)[0])
-            list_of_words.append(rez)
+    def load_models(self, path_to_models, prefix, device, stacked=False):
+        fileNameByWord = listModelFiles(path_to_models, prefix)
+        list_of_words = list(fileNameByWord.keys())
+        list_of_files = list(fileNameByWord.values())
+
+        if stacked:
+            state_dicts = {w: torch.load(f, map_location='cpu')
+                           for f, w in zip(list_of_files, list_of_words)}
+            return convertStackedModels(
+                StackedModels.fromStateDicts(state_dicts, sigmoid=True).to(device),
+                self.precision)
 
         nets = self.create_networks(list_of_words, device)
 
         for f, w in zip(list_of_files, list_of_words):
             nets[w].load_state_dict(torch.load(f, map_location='cpu'))
 
-        return nets
+        return {w: self.prepare_network(net) for w, net in nets.items()}
+
+    def load_models_on_demand(self, path_to_models, prefix, device, max_resident_bytes=None,
+                              pinned_ids=()):
+        fileNameByWord = listModelFiles(path_to_models, prefix)
+
+        def loadModel(word_id):
+            model = self.create_network(device)
+            model.load_state_dict(torch.load(fileNameByWord[word_id], map_location='cpu'))
+            return self.prepare_network(model)
+
+        return ModelResidency(sorted(fileNameByWord), loadModel, max_resident_bytes, pinned_ids)
+
+    def load_packed_models(self, packedModels, device, stacked=False, max_resident_bytes=None,
+                           pinned_ids=()):
+        """
+        :param packedModels: splitnet.packed.PackedModels
+        :return: Union[StackedModels, ModelResidency]
+            all models stacked or models which are materialised on
+            first use
+        """
+        if stacked:
+            weights, biases = packedModels.getStackedParameters()
+            return convertStackedModels(
+                StackedModels(packedModels.keys, weights, biases, sigmoid=True).to(device),
+                self.precision)
+
+        def loadModel(word_id):
+            model = self.create_network(device)
+            model.load_state_dict(packedModels.getStateDict(word_id))
+            return self.prepare_network(model)
+
+        return ModelResidency(packedModels.keys, loadModel, max_resident_bytes, pinned_ids)
 
     def load_threshold(self, directory):
         with open(os.path.join(directory, 'thresholds/best_th.json'), 'r') as f:
@@ -106,8 +188,15 @@ class SplitMultidnnRunner(NeuralNetworkRunner):
     """
     Class for running multi-nn models with custom thresholds
     """
-    def __init__(self, models_directory):
-        self.nets_vocabulary = SplitNetsVocab(models_directory)
+    def __init__(self, models_directory, stacked=False, max_resident_bytes=None,
+                 pinned_words=(), precision='float32'):
+        self.nets_vocabulary = SplitNetsVocab(models_directory, stacked,
+                                              max_resident_bytes, pinned_words, precision)
+
+    def getStatistics(self):
+        if isinstance(self.nets_vocabulary.models, ModelResidency):
+            return {'word_models': self.nets_vocabulary.models.getStatistics()}
+        return {}
 
     def runNeuralNetwork(self, features, word):
         logger.debug("processing word {0}".format(word))
@@ -127,6 +216,18 @@ class SplitMultidnnRunner(NeuralNetworkRunner):
         # instead of f(x) > 0.5 + delta
         # we will check for f(x) - delta > 0.5, where delta = threshold - 0.5
         delta = threshold - 0.5
-        result = model(torch.Tensor(features))
+        result = model(torch.as_tensor(features, dtype=torch.float32))
         # take max to keep values in valid range (0, 1)
         return max(torch.tensor(0.0), result - delta)
+
+    def runNeuralNetworkBatch(self, features, words):
+        featuresTensor = torch.as_tensor(features, dtype=torch.float32)
+        known_words = [word for word in words if self.nets_vocabulary.has_model(word)]
+        if not known_words:
+            return {}
+        deltas = torch.Tensor([self.nets_vocabulary.get_threshold_by_word(word) - 0.5
+                               for word in known_words])
+        with torch.no_grad():
+            scores = self.nets_vocabulary.get_models_output(featuresTensor, known_words)
+            scores = torch.clamp(scores - deltas, min=0.0)
+        return dict(zip(known_words, scores.t().tolist()))
@@ -0,0 +1,69 @@
+"""
+Process-local registry of tensors referenced from atoms by handle
+
+Atom keeps only FloatValue with integer handle while tensor itself (numpy
+array or torch tensor) is kept in registry, so neither putting tensor into
+atomspace nor getting it back in grounded callback copies it element by
+element. Tensors are registered in scopes, scope is opened when child
+atomspace is pushed and all tensors of the scope are released when it is
+popped, see pattern_matcher_vqa.pushAtomspace() and popAtomspace().
+"""
+
+from opencog.type_constructors import FloatValue
+
+
+class TensorRegistry:
+
+    def __init__(self):
+        self.nextHandle = 0
+        self.tensorByHandle = {}
+        self.scopes = [[]]
+
+    def addTensor(self, tensor):
+        handle = self.nextHandle
+        self.nextHandle += 1
+        self.tensorByHandle[handle] = tensor
+        self.scopes[-1].append(handle)
+        return handle
+
+    def getTensor(self, handle):
+        return self.tensorByHandle[handle]
+
+    def pushScope(self):
+        self.scopes.append([])
+
+    def popScope(self):
+        """
+        Release tensors added after the last pushScope() call
+        """
+        if len(self.scopes) == 1:
+            raise RuntimeError('Cannot pop root scope of tensor registry')
+        for handle in self.scopes.pop():
+            del self.tensorByHandle[handle]
+
+    def __len__(self):
+        return len(self.tensorByHandle)
+
+
+tensorRegistry = TensorRegistry()
+
+
+def setTensorValue(atom, key, tensor):
+    """
+    Register tensor and keep its handle in atom value by key
+    """
+    handle = tensorRegistry.addTensor(tensor)
+    atom.set_value(key, FloatValue(handle))
+    return handle
+
+
+def getTensorValue(atom, key):
+    """
+    Get tensor which handle is kept in atom value by key
+
+    :return: tensor or None if atom has no value by key
+    """
+    value = atom.get_value(key)
+    if value is None:
+        return None
+    return tensorRegistry.getTensor(int(value.to_list()[0]))
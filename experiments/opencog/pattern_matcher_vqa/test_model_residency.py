@@ -0,0 +1,87 @@
+import unittest
+
+from model_residency import ModelResidency
+
+
+class FakeTensor:
+
+    def __init__(self, numel):
+        self.size = numel
+
+    def numel(self):
+        return self.size
+
+    def element_size(self):
+        return 4
+
+
+class FakeModel:
+    """
+    Model with single parameter of 100 bytes
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def parameters(self):
+        return [FakeTensor(25)]
+
+    def state_dict(self):
+        return {'weight': FakeTensor(25)}
+
+
+class ModelResidencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loaded = []
+
+    def loadModel(self, key):
+        self.loaded.append(key)
+        return FakeModel(key)
+
+    def test_mapping_methods(self):
+        residency = ModelResidency([3, 1, 2], self.loadModel)
+        self.assertEqual(list(residency.keys()), [3, 1, 2])
+        self.assertEqual(len(residency), 3)
+        self.assertIn(1, residency)
+        self.assertNotIn(4, residency)
+        self.assertEqual([(key, model.key) for key, model in residency.items()],
+                         [(3, 3), (1, 1), (2, 2)])
+        with self.assertRaises(KeyError):
+            residency[4]
+
+    def test_least_recently_used_is_evicted(self):
+        residency = ModelResidency([1, 2, 3], self.loadModel, maxBytes=200)
+        residency[1]
+        residency[2]
+        residency[1]
+        residency[3]
+        self.assertEqual(list(residency.modelByKey), [1, 3])
+        residency[2]
+        self.assertEqual(self.loaded, [1, 2, 3, 2])
+        self.assertEqual(residency.getStatistics()['resident_bytes'], 200)
+
+    def test_pinned_models_are_not_evicted(self):
+        residency = ModelResidency([1, 2, 3], self.loadModel, maxBytes=200, pinnedKeys=[1, 4])
+        self.assertEqual(self.loaded, [1])
+        residency[2]
+        residency[3]
+        self.assertEqual(list(residency.modelByKey), [1, 3])
+        self.assertEqual(residency.getStatistics()['pinned_models'], 1)
+
+    def test_statistics(self):
+        residency = ModelResidency([1, 2], self.loadModel, maxBytes=100)
+        residency[1]
+        residency[1]
+        residency[2]
+        statistics = residency.getStatistics()
+        self.assertEqual(statistics['hits'], 1)
+        self.assertEqual(statistics['misses'], 2)
+        self.assertEqual(statistics['evictions'], 1)
+        self.assertEqual(statistics['resident_models'], 1)
+        self.assertEqual(statistics['resident_bytes'], 100)
+        self.assertEqual(statistics['max_bytes'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
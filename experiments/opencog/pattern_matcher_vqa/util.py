@@ -1,6 +1,10 @@
 import os
+import io
 import math
+import zlib
+import struct
 import zipfile
+import threading
 from opencog.scheme_wrapper import scheme_eval_as, scheme_eval
 
 
@@ -16,17 +20,111 @@ def addLeadingZeros(number, requriedLength):
     return result + str(number)
 
 
+class ZipArchiveIndex:
+    """
+    Opened zip archive with parsed central directory
+
+    Members are read by offset using os.pread(), so single index can be
+    used from many threads and from forked processes without locking.
+    """
+
+    LOCAL_HEADER_SIZE = 30
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.version = (stat.st_mtime, stat.st_size)
+        with zipfile.ZipFile(path, 'r') as archive:
+            self.infoByName = {info.filename: info for info in archive.infolist()}
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def isUpToDate(self):
+        stat = os.stat(self.path)
+        return self.version == (stat.st_mtime, stat.st_size)
+
+    def read(self, fileName):
+        info = self.infoByName[fileName]
+        if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED,
+                                                             zipfile.ZIP_DEFLATED):
+            # encrypted or unusual compression, let zipfile handle it
+            with zipfile.ZipFile(self.path, 'r') as archive:
+                return archive.read(fileName)
+        header = os.pread(self.fd, self.LOCAL_HEADER_SIZE, info.header_offset)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        dataOffset = info.header_offset + self.LOCAL_HEADER_SIZE + nameLength + extraLength
+        data = os.pread(self.fd, info.compress_size, dataOffset)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ZipArchiveCache:
+    """
+    Keeps ZipArchiveIndex opened for each archive path, so central
+    directory is parsed once per archive instead of once per read
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexByPath = {}
+
+    def getIndex(self, path):
+        path = os.path.realpath(path)
+        with self.lock:
+            index = self.indexByPath.get(path)
+            if index is None or not index.isUpToDate():
+                if index is not None:
+                    index.close()
+                index = ZipArchiveIndex(path)
+                self.indexByPath[path] = index
+            return index
+
+    def open(self, path, fileName):
+        return io.BytesIO(self.getIndex(path).read(fileName))
+
+    def clear(self):
+        with self.lock:
+            for index in self.indexByPath.values():
+                index.close()
+            self.indexByPath.clear()
+
+
+zipArchiveCache = ZipArchiveCache()
+
+
 def loadDataFromZipOrFolder(folderOrZip, fileName, loadProcedure):
     if (os.path.isdir(folderOrZip)):
         with open(folderOrZip + '/' + fileName, 'rb') as file:
             return loadProcedure(file)
     else:
-        with zipfile.ZipFile(folderOrZip, 'r') as archive:
-            with archive.open(fileName) as file:
-                return loadProcedure(file)
+        with zipArchiveCache.open(folderOrZip, fileName) as file:
+            return loadProcedure(file)
+
+
+def getFileVersionInZipOrFolder(folderOrZip, fileName):
+    """
+    Get full name, modification time and size of the file in folder or
+    of the zip archive which contains the file
+    """
+    if (os.path.isdir(folderOrZip)):
+        path = folderOrZip + '/' + fileName
+    else:
+        path = folderOrZip
+    stat = os.stat(path)
+    return folderOrZip + '/' + fileName, stat.st_mtime_ns, stat.st_size
+
 
+def initialize_atomspace_by_facts(atomspaceFileName=None, ure_config=None, directories=[],
+                                  use_snapshot=False):
+    """
+    Load Scheme modules and facts file into atomspace
 
-def initialize_atomspace_by_facts(atomspaceFileName=None, ure_config=None, directories=[]):
+    If use_snapshot is True facts file is loaded via binary snapshot,
+    see atomspace_snapshot.py
+    """
     atomspace = scheme_eval_as('(cog-atomspace)')
     scheme_eval(atomspace, '(use-modules (opencog))')
     scheme_eval(atomspace, '(use-modules (opencog exec))')
@@ -36,7 +134,12 @@ def initialize_atomspace_by_facts(atomspaceFileName=None, ure_config=None, direc
     for item in directories:
         scheme_eval(atomspace, '(add-to-load-path "{0}")'.format(item))
     if atomspaceFileName is not None:
-        scheme_eval(atomspace, '(load-from-path "' + atomspaceFileName + '")')
+        loaded = False
+        if use_snapshot:
+            from atomspace_snapshot import loadFactsUsingSnapshot
+            loaded = loadFactsUsingSnapshot(atomspace, atomspaceFileName)
+        if not loaded:
+            scheme_eval(atomspace, '(load-from-path "' + atomspaceFileName + '")')
     if ure_config is not None:
         scheme_eval(atomspace, '(load-from-path "' + ure_config + '")')
     return atomspace